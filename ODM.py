@@ -1,19 +1,76 @@
 __author__ = 'Antonio Cabrera y Alejandro Gómez'
 
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
+from typing import Generator, Iterable, Callable, Sequence
+from itertools import islice
+import random
 import time
-from typing import Generator, Any
-from geojson import Point
+from geojson import Point, Polygon
 import pymongo
+import bson
+from pymongo.errors import BulkWriteError, OperationFailure
 import redis
 from bson import ObjectId      #Aqui permitimos que redis elimine los LRU (Least Recently Used) para que se mantenga en 150mb
+from bson.raw_bson import RawBSONDocument
+from geocoding import get_geocoder
+from ingest import iter_documents
+from cache_codecs import CacheCodec, BsonCodec
+from concurrency import SingleFlight
+from schema import ModelSchema, plan_indexes
+from query_cache import QueryCache
+from local_cache import LocalCache, CacheInvalidator, CacheStats
+from instrumentation import metrics
+
+# Valor guardado en la cache para los ids que no existen en la BBDD
+_NO_EXISTE = b""
+
+# Prefijo de las claves de los documentos en redis: odm:<Modelo>:<id>
+CACHE_PREFIX = "odm"
+
+# Guarda documentos en la cache de un modelo con un numero maximo de
+# entradas. Un sorted set guarda el momento en que se escribio cada
+# clave y, si se supera el maximo, se descartan las escritas hace mas
+# tiempo. Las entradas que ya han caducado se quitan antes del indice
+# KEYS: indice, documentos
+# ARGV: maximo, ahora, escritas antes de esto ya han caducado, (valor, ttl) de cada documento
+CAPPED_SET_SCRIPT = """
+for i = 2, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[2 * i], 'EX', ARGV[2 * i + 1])
+    redis.call('ZADD', KEYS[1], ARGV[2], KEYS[i])
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[3])
+local sobran = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[1])
+if sobran <= 0 then
+    return 0
+end
+local antiguas = redis.call('ZPOPMIN', KEYS[1], sobran)
+for i = 1, #antiguas, 2 do
+    redis.call('UNLINK', antiguas[i])
+end
+return sobran
+"""
+
+# Lectura de un documento de la cache renovando su expiracion en un unico
+# viaje. Los ids inexistentes recordados no se renuevan, asi negative_ttl
+# acota el tiempo hasta que se vuelve a consultar mongo
+# KEYS: documento   ARGV: ttl
+READ_SCRIPT = """
+local valor = redis.call('GET', KEYS[1])
+if valor and valor ~= '' then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return valor
+"""
+
+# Construccion de modelos sin pasar por __init__ ni __setattr__
+_nuevo = object.__new__
+_asignar = object.__setattr__
 
 def getLocationPoint(address: str) -> Point:
     """ 
     Obtiene las coordenadas de una dirección en formato geojson.Point
-    Utilizar la API de geopy para obtener las coordenadas de la direccion
-    Cuidado, la API es publica tiene limite de peticiones, utilizar sleeps.
+    Delega en el geocodificador configurado (ver geocoding.py), que
+    cachea las direcciones normalizadas en memoria y en redis y limita
+    las peticiones a la API publica con un token bucket.
 
     Parameters
     ----------
@@ -24,21 +81,101 @@ def getLocationPoint(address: str) -> Point:
         geojson.Point
             coordenadas del punto de la direccion
     """
-    location = None
-    while location is None:
-        try:
-            time.sleep(1)
-
-            # Es necesario proporcionar un user_agent para utilizar la API
-            # Utilizar un nombre aleatorio para el user_agent
-            location = Nominatim(user_agent="Alberto Gutierrez").geocode(address)
-        except GeocoderTimedOut:
-            # Puede lanzar una excepcion si se supera el tiempo de espera
-            # Volver a intentarlo
-            continue
-        
-    # Devolver un GeoJSON de tipo punto con la latitud y longitud almacenadas
-    return Point((location.latitude, location.longitude))
+    latitude, longitude = get_geocoder().geocode(address)
+
+    # Devolver un GeoJSON de tipo punto, que ordena las coordenadas
+    # como (longitud, latitud)
+    return Point((longitude, latitude))
+
+def getLocationPoints(addresses: list[str], return_exceptions: bool = False) -> list[Point | None | Exception]:
+    """ 
+    Version por lotes de getLocationPoint. Las direcciones repetidas
+    o ya cacheadas no generan peticiones a la API.
+
+    Parameters
+    ----------
+        addresses : list[str]
+            direcciones completas de las que obtener las coordenadas
+        return_exceptions : bool
+            si se devuelve el error del geocodificador en la posicion de
+            cada direccion que ha fallado en lugar de lanzar el primero
+    Returns
+    -------
+        list[geojson.Point | None | Exception]
+            coordenadas de cada direccion en el mismo orden, None para
+            las direcciones que no se han encontrado
+    """
+    return [coordenadas if coordenadas is None or isinstance(coordenadas, Exception)
+            else Point((coordenadas[1], coordenadas[0]))
+            for coordenadas in get_geocoder().geocode_many(addresses, return_exceptions=return_exceptions)]
+
+def _geocode_documents(documentos: list, posiciones: Sequence[int], resultado: "BulkResult") -> set[int]:
+    """
+    Sustituye por su punto las direcciones en texto de los documentos
+    (diccionarios) de un lote, geocodificandolas todas juntas. Los
+    documentos cuya direccion no se encuentra o falla en el
+    geocodificador se registran en resultado.errors con su posicion en
+    la entrada, el resto del lote no se ve afectado.
+    Devuelve los indices en documentos de los que han fallado.
+    """
+    pendientes = [i for i, documento in enumerate(documentos)
+                  if isinstance(documento, dict) and isinstance(documento.get("direccion"), str)]
+    fallidos = set()
+    if not pendientes:
+        return fallidos
+
+    puntos = getLocationPoints([documentos[i]["direccion"] for i in pendientes], return_exceptions=True)
+    for i, punto in zip(pendientes, puntos):
+        if isinstance(punto, Exception):
+            resultado.errors.append((posiciones[i], f"Error de geocodificación: {punto}"))
+            fallidos.add(i)
+        elif punto is None:
+            resultado.errors.append((posiciones[i], f"Dirección no encontrada: {documentos[i]['direccion']}"))
+            fallidos.add(i)
+        else:
+            documentos[i] = {**documentos[i], "direccion": punto}
+    return fallidos
+
+def _unlink_matching(r: redis.client.Redis, pattern: str, batch_size: int = 500) -> int:
+    """
+    Elimina las claves que cumplen pattern de forma incremental con SCAN
+    y UNLINK, sin bloquear redis como KEYS o FLUSHALL.
+    Devuelve el numero de claves eliminadas.
+    """
+    eliminadas, lote = 0, []
+    for key in r.scan_iter(match=pattern, count=batch_size):
+        lote.append(key)
+        if len(lote) >= batch_size:
+            eliminadas += r.unlink(*lote)
+            lote = []
+    if lote:
+        eliminadas += r.unlink(*lote)
+    return eliminadas
+
+def _result_ttl(cache_results: bool | int) -> int | None:
+    """ Segundos de un resultado cacheado, None para el ttl por defecto """
+    return None if cache_results is True else int(cache_results)
+
+def _raw_collection(coleccion):
+    """ La misma coleccion (sincrona o asincrona) devolviendo los documentos como RawBSONDocument """
+    return coleccion.with_options(codec_options=coleccion.codec_options.with_options(document_class=RawBSONDocument))
+
+def _as_point(point: "Point | dict | tuple[float, float] | str") -> Point | dict:
+    """ Convierte una direccion o un par (longitud, latitud) en un geojson.Point """
+    if isinstance(point, str):
+        return getLocationPoint(point)
+    if isinstance(point, dict):
+        return point
+    return Point(tuple(point))
+
+def _as_polygon(polygon: "Polygon | dict | list[tuple[float, float]]") -> Polygon | dict:
+    """ Convierte una lista de pares (longitud, latitud) en un geojson.Polygon cerrado """
+    if isinstance(polygon, dict):
+        return polygon
+    anillo = [tuple(punto) for punto in polygon]
+    if anillo and anillo[0] != anillo[-1]:
+        anillo.append(anillo[0])
+    return Polygon([anillo])
 
 class Model:
     """ 
@@ -48,12 +185,33 @@ class Model:
 
     Attributes
     ----------
-        required_vars : set[str]
+        required_vars : frozenset[str]
             conjunto de variables requeridas por el modelo
-        admissible_vars : set[str]
+        admissible_vars : frozenset[str]
             conjunto de variables admitidas por el modelo
+        schema : ModelSchema | None
+            definicion compilada del modelo con tipos y valores por defecto
         db : pymongo.collection.Collection
             conexion a la coleccion de la base de datos
+        codec : CacheCodec
+            codificador de los documentos guardados en la cache
+        cache_ttl : int
+            tiempo de expiracion de los documentos en la cache, en segundos
+        cache_jitter : float
+            variacion aleatoria de cache_ttl, como fraccion de este
+        cache_max_entries : int | None
+            numero maximo de documentos del modelo en la cache, None
+            para no limitarlo
+        negative_ttl : int | None
+            tiempo durante el que se recuerda en la cache que un id no
+            existe, None para no cachear los ids inexistentes
+        query_cache : QueryCache | None
+            cache de resultados de find y aggregate, None si esta desactivada
+        local_cache : LocalCache | None
+            cache en memoria del proceso delante de redis para find_by_id
+            y find_by_ids, None si esta desactivada
+        invalidator : CacheInvalidator | None
+            propaga las invalidaciones de local_cache al resto de procesos
     
     Methods
     -------
@@ -62,10 +220,14 @@ class Model:
             variables del objeto con el fin de controlar las variables
             que se asignan al modelo y cuando son modificadas.
         save()  -> None
-            Guarda el modelo en la base de datos
+            Guarda el modelo en la base de datos, enviando solo los cambios
+        save_many(documents: Iterable[dict | Model], batch_size: int) -> BulkResult
+            Guarda muchos documentos en lotes con bulk_write.
+        load_file(path: str, batch_size: int) -> BulkResult
+            Carga en la base de datos un fichero JSON o NDJSON.
         delete() -> None
             Elimina el modelo de la base de datos
-        find(filter: dict[str, str | dict]) -> ModelCursor
+        find(filter: dict[str, str | dict], projection, limit, skip, sort, batch_size, cache) -> ModelCursor
             Realiza una consulta de lectura en la BBDD.
             Devuelve un cursor de modelos ModelCursor
         aggregate(pipeline: list[dict]) -> pymongo.command_cursor.CommandCursor
@@ -73,14 +235,45 @@ class Model:
         find_by_id(id: str) -> dict | None
             Busca un documento por su id utilizando la cache y lo devuelve.
             Si no se encuentra el documento, devuelve None.
-        init_class(db_collection: pymongo.collection.Collection, required_vars: set[str], admissible_vars: set[str]) -> None
+        cache_key(id: str) -> str
+            Clave en la cache del documento con un id.
+        cache_clear(batch_size: int) -> int
+            Elimina de la cache los documentos del modelo.
+        near(point, max_distance: float | None, ...) -> ModelCursor
+            Documentos cercanos a un punto, del mas cercano al mas lejano.
+        within(polygon, ...) -> ModelCursor
+            Documentos dentro de un poligono.
+        ensure_indexes(drop_unknown: bool) -> dict[str, list]
+            Crea o modifica los indices declarados en models.yml.
+        init_class(db_collection: pymongo.collection.Collection, required_vars: Iterable[str], admissible_vars: Iterable[str], schema: ModelSchema | None) -> None
             Inicializa las variables de clase en la inicializacion del sistema.
 
     """
-    required_vars: set[str]
-    admissible_vars: set[str]
+    # Estado interno fuera de __dict__ para que no se guarde en la BBDD
+    __slots__ = ("__dict__", "_modificados", "_eliminados", "_parcial")
+
+    required_vars: frozenset[str]
+    admissible_vars: frozenset[str]
+    schema: ModelSchema | None = None
     db: pymongo.collection.Collection
     r: redis.client.Redis
+    codec: CacheCodec = BsonCodec()
+    cache_ttl: int = 86400
+    cache_jitter: float = 0.0
+    cache_max_entries: int | None = None
+    negative_ttl: int | None = None
+    query_cache: QueryCache | None = None
+    local_cache: LocalCache | None = None
+    invalidator: CacheInvalidator | None = None
+    _estadisticas: CacheStats = CacheStats()
+    _en_vuelo: SingleFlight = SingleFlight()
+    _leer_cache: Callable       # READ_SCRIPT registrado en init_class
+
+    # Compilados en init_class: todas las variables permitidas, las
+    # requeridas sin valor por defecto y los validadores de tipo
+    _variables: frozenset[str] = frozenset()
+    _requeridas: frozenset[str] = frozenset()
+    _validadores: dict[str, Callable] = {}
 
     def __init__(self, **kwargs: dict[str, str | dict]):
         """
@@ -96,9 +289,15 @@ class Model:
 
         # Realizar las comprabociones y gestiones necesarias
         # antes de la asignacion.
-        if not all(name in kwargs for name in self.required_vars):
-            print(kwargs, self.required_vars)
-            raise ValueError("Faltan variables requeridas")
+        faltan = self._requeridas - kwargs.keys()
+        if faltan:
+            raise ValueError(f"Faltan variables requeridas: {', '.join(sorted(faltan))}")
+
+        if self.schema is not None and self.schema.defaults:
+            kwargs = self.schema.apply_defaults(kwargs)
+
+        self._limpiar()
+        object.__setattr__(self, "_parcial", False)
         
         # Asigna todos los valores en kwargs a las variables con 
         # nombre las claves en kwargs
@@ -115,7 +314,7 @@ class Model:
         # antes de la asignacion.
         
         # Ver si la variable a asignar es admitida
-        if not (name in self.admissible_vars or name in self.required_vars):
+        if name not in self._variables:
             raise ValueError("Variable no admitida")
         
         # Ver si el valor a asignar es información nueva
@@ -123,68 +322,416 @@ class Model:
             raise ValueError("Variable ya asignada, solo se puede enviar información nueva a la BBDD")
 
         if name == "direccion" and type(value) == str: # Si la direccion nos viene dada como string, la convertimos en un punto
-            self.__dict__[name] = getLocationPoint(value)
-            return
+            value = getLocationPoint(value)
+
+        # Ver si el valor es del tipo declarado en models.yml
+        validar = self._validadores.get(name)
+        if validar is not None:
+            validar(value)
 
-        # Asigna el valor value a la variable name
+        # Asigna el valor value a la variable name y la marca como modificada
         self.__dict__[name] = value
+        self._modificados.add(name)
+        self._eliminados.discard(name)
+
+    def __delattr__(self, name: str) -> None:
+        """ Elimina una variable del modelo, en el siguiente save()
+        se eliminara tambien de la BBDD con $unset.
+        """
+        if name == "_id" or name in self.required_vars:
+            raise ValueError("No se puede eliminar una variable requerida")
+        if name not in self.__dict__:
+            raise AttributeError(name)
+
+        del self.__dict__[name]
+        self._modificados.discard(name)
+        self._eliminados.add(name)
+
+    def _limpiar(self) -> None:
+        """ Marca el modelo como sincronizado con la BBDD """
+        object.__setattr__(self, "_modificados", set())
+        object.__setattr__(self, "_eliminados", set())
+
+    @property
+    def is_dirty(self) -> bool:
+        """ Indica si hay cambios pendientes de guardar """
+        return bool(self._modificados or self._eliminados)
         
     def save(self) -> None:
         """
         Guarda el modelo en la base de datos
         Si el modelo no existe en la base de datos, se crea un nuevo
         documento con los valores del modelo. En caso contrario, se
-        actualiza el documento existente con los nuevos valores del
-        modelo.
+        envian solo las variables modificadas ($set) y eliminadas
+        ($unset) desde la ultima vez que se guardo o se leyo.
+        Si no hay cambios no se hace nada.
+        Las modificaciones dentro de listas o diccionarios no se
+        detectan, hay que volver a asignar la variable.
         """
-        
+        _id = self.__dict__.get('_id')
+
+        if _id:    # Si existe el id, se actualizan solo los cambios
+            if not self.is_dirty:
+                return
+
+            cambios = {}
+            modificados = {name: self.__dict__[name] for name in self._modificados if name != "_id"}
+            if modificados:
+                cambios["$set"] = modificados
+            if self._eliminados:
+                cambios["$unset"] = {name: "" for name in self._eliminados}
 
-        if self.__dict__.get('_id'):    # Si existe el id, se actualiza
-            self.db.update_one({"_id": self.__dict__.get("_id")}, {"$set": self.__dict__})
+            if cambios:
+                self.db.update_one({"_id": _id}, cambios, upsert=not self._parcial)
 
         else:   # Si no existe, se inserta creando un id nuevo en el proceso
             self.db.insert_one(self.__dict__)
-       
 
-        key = str(self.__dict__.get('_id'))
-        valor = self.r.get(key)
+        self._limpiar()
 
-        if valor is not None:
-            print("Save: Estaba en caché, reactualizando caché")
-            self.r.expire(key, 86400)  
-        else:                   #Lo añadimos también a la caché
-            print("Save: Añadiendo a caché")
-            self.r.setex( key,86400, str(self.__dict__))     
+        # El modelo en memoria es el documento actualizado, se sobreescribe
+        # la caché en un unico viaje. Si el modelo viene de una proyeccion
+        # esta incompleto y se invalida la entrada en su lugar.
+        key = str(self.__dict__.get('_id'))
+        if self._parcial:
+            if self.r.delete(self.cache_key(key)) and metrics.enabled:
+                metrics.count("odm_cache_evictions_total", model=type(self).__name__, reason="partial_save")
+            self._local_delete(key)
+        else:
+            valor = self.codec.encode(self.__dict__)
+            self._cache_set(self.r, [(key, valor)])
+            self._local_set(key, valor)
 
+        self._publish_invalidation([key])
+        self._invalidate_queries()
 
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.__dict__})"
 
     def delete(self) -> None:
         """
         Elimina el modelo de la base de datos
         """
-        key = str(self.__dict__.get("_id"))
-        eliminado = self.r.delete(key)  
-        
-        if eliminado > 0:              #Comprobante de que se ha eliminado correctamente un archivo
-            print(f"La clave se ha eliminado correctamente de la caché.")
+        _id = self.__dict__.get("_id")
+        key = str(_id)
+        eliminado = self.r.delete(self.cache_key(key))
+        self._local_delete(key)
+        if eliminado and metrics.enabled:
+            metrics.count("odm_cache_evictions_total", model=type(self).__name__, reason="delete")
+
+        # Se filtra por _id: filtrar por el documento entero falla si ha
+        # cambiado en la base de datos desde que se leyo
+        self.db.delete_one({"_id": _id})
+        self._publish_invalidation([key])
+        self._invalidate_queries()
+
+    # Claves de la cache con espacio de nombres por modelo, para no
+    # mezclarse con las sesiones y tickets ni con otros modelos. La cache
+    # en memoria (L1), compartida por todos los modelos, usa las mismas
+    # claves, asi clear_cache puede borrar un modelo por su prefijo.
+
+    @classmethod
+    def cache_key(cls, id: str) -> str:
+        """ Clave en la caché del documento con el id dado """
+        return f"{CACHE_PREFIX}:{cls.__name__}:{id}"
+
+    @classmethod
+    def _cache_index_key(cls) -> str:
+        # Orden de escritura de los documentos cuando se limita su numero
+        return cls.cache_key("#escritos")
+
+    @classmethod
+    def _cache_ttl(cls) -> int:
+        """ Expiracion de un documento con la variacion aleatoria del modelo """
+        if not cls.cache_jitter:
+            return cls.cache_ttl
+        return max(1, round(cls.cache_ttl * random.uniform(1 - cls.cache_jitter, 1 + cls.cache_jitter)))
+
+    @classmethod
+    def _capped_set_args(cls, entradas: list[tuple[str, bytes]]) -> tuple[list[str], list]:
+        ahora = time.time()
+        # Una entrada escrita antes de esto ha caducado aunque tenga el ttl
+        # maximo. Si find_by_id ha renovado su expiracion sale del indice
+        # antes de caducar, pero sigue acotada por su ttl
+        caducadas = ahora - cls.cache_ttl * (1 + cls.cache_jitter)
+        claves, argumentos = [cls._cache_index_key()], [cls.cache_max_entries, ahora, caducadas]
+        for id, valor in entradas:
+            claves.append(cls.cache_key(id))
+            argumentos += [valor, cls._cache_ttl()]
+        return claves, argumentos
+
+    @classmethod
+    def _cache_set(cls, cliente, entradas: list[tuple[str, bytes]]) -> None:
+        """
+        Guarda documentos codificados en la caché con el ttl del modelo y
+        respetando su numero maximo de entradas. cliente es el cliente de
+        redis o un pipeline, sincrono o asincrono, en el que se añaden
+        los comandos.
+        """
+        if not entradas:
+            return
+        if metrics.enabled:
+            metrics.count("odm_cache_writes_total", len(entradas), model=cls.__name__)
+            metrics.count("odm_cache_bytes_written_total", sum(len(valor) for _, valor in entradas), model=cls.__name__)
+        if cls.cache_max_entries is None:
+            for id, valor in entradas:
+                cliente.setex(cls.cache_key(id), cls._cache_ttl(), valor)
         else:
-            print(f"La clave no existe en la caché o no se pudo eliminar.")
-     
-        self.db.delete_one(self.__dict__)
-    
+            claves, argumentos = cls._capped_set_args(entradas)
+            # EVAL en lugar de un Script registrado para poder añadirlo
+            # tambien a los pipelines asincronos sin esperar el resultado
+            cliente.eval(CAPPED_SET_SCRIPT, len(claves), *claves, *argumentos)
+
+    @classmethod
+    def cache_clear(cls, batch_size: int = 500) -> int:
+        """
+        Elimina de la caché los documentos del modelo de forma incremental
+        (SCAN y UNLINK), sin bloquear redis ni tocar el resto de claves.
+        Tambien se descartan las copias en memoria de todos los procesos.
+
+        Parameters
+        ----------
+            batch_size : int
+                claves que se recorren y eliminan en cada paso
+        Returns
+        -------
+            int
+                numero de claves eliminadas
+        """
+        eliminadas = _unlink_matching(cls.r, cls.cache_key("*"), batch_size)
+        if cls.local_cache is not None:
+            cls.local_cache.delete_prefix(cls.cache_key(""))
+        cls._publish_invalidation(["*"])
+        return eliminadas
+
+    # Cache en memoria (L1)
+
+    @classmethod
+    def _local_get(cls, key: str) -> bytes | None:
+        if cls.local_cache is None:
+            return None
+        valor = cls.local_cache.get(cls.cache_key(key))
+        cls._estadisticas.count("l1_misses" if valor is None else "l1_hits")
+        return valor
+
+    @classmethod
+    def _local_set(cls, key: str, valor: bytes) -> None:
+        if cls.local_cache is not None:
+            cls.local_cache.set(cls.cache_key(key), valor)
+
+    @classmethod
+    def _local_delete(cls, key: str) -> None:
+        if cls.local_cache is not None:
+            cls.local_cache.delete(cls.cache_key(key))
+
+    @classmethod
+    def _publish_invalidation(cls, keys: list[str]) -> None:
+        """ Anuncia a los demas procesos que descarten sus copias en memoria """
+        if cls.invalidator is not None:
+            cls.invalidator.publish([cls.cache_key(key) for key in keys])
+
+    @classmethod
+    def cache_stats(cls) -> dict:
+        """
+        Estadisticas de la cache de documentos del modelo.
+
+        Returns
+        -------
+            dict
+                aciertos, fallos y tasas de acierto de la cache en
+                memoria (l1) y de redis (l2), y el tamaño de la cache en
+                memoria (compartida por todos los modelos)
+        """
+        estadisticas = cls._estadisticas.snapshot()
+        estadisticas["l1_size"] = len(cls.local_cache) if cls.local_cache is not None else 0
+        return estadisticas
+
+    @classmethod
+    def _invalidate_queries(cls) -> None:
+        """ Invalida los resultados cacheados que leen la coleccion del modelo """
+        if cls.query_cache is not None:
+            cls.query_cache.invalidate(cls.db.name)
+
+    @classmethod
+    def save_many(cls, documents: Iterable["dict | Model"], batch_size: int = 1000,
+                  progress: Callable[[dict], None] | None = None) -> "BulkResult":
+        """
+        Guarda muchos documentos agrupando las escrituras en lotes
+        bulk_write no ordenados. Cada lote se valida contra required_vars
+        y admissible_vars, geocodifica sus direcciones de una vez y se
+        añade a la caché con un unico pipeline de SETEX.
+        Los documentos erroneos se registran en el resultado sin
+        detener la carga.
+
+        Parameters
+        ----------
+            documents : Iterable[dict | Model]
+                documentos (diccionarios o modelos) a guardar
+            batch_size : int
+                numero de documentos por lote
+            progress : Callable[[dict], None] | None
+                funcion a la que se pasan las estadisticas de cada lote
+        Returns
+        -------
+            BulkResult
+                documentos escritos, errores por documento y
+                estadisticas de cada lote
+        """
+        resultado = BulkResult()
+        documents = iter(documents)
+        inicio_lote = 0
+
+        while True:
+            lote = list(islice(documents, batch_size))
+            if not lote:
+                break
+
+            inicio = time.perf_counter()
+            modelos, indices = cls._build_batch(lote, inicio_lote, resultado)
+
+            operaciones = cls._bulk_operations(modelos)
+
+            fallidos = set()
+            if operaciones:
+                try:
+                    cls.db.bulk_write(operaciones, ordered=False)
+                except BulkWriteError as e:
+                    fallidos = cls._bulk_failures(e, indices, resultado)
+
+            # Rellenar la caché con un unico viaje a redis por lote
+            pipe = cls.r.pipeline(transaction=False)
+            escritos = cls._cache_written(pipe, modelos, fallidos)
+            pipe.execute()
+            if escritos:
+                cls._publish_invalidation([str(modelo._id) for i, modelo in enumerate(modelos) if i not in fallidos])
+                cls._invalidate_queries()
+
+            estadisticas = resultado.add_batch(len(lote), escritos, time.perf_counter() - inicio)
+            if progress is not None:
+                progress(estadisticas)
+
+            inicio_lote += len(lote)
+
+        return resultado
+
+    @staticmethod
+    def _bulk_operations(modelos: list["Model"]) -> list:
+        """ Operaciones de bulk_write para guardar un lote de modelos """
+        operaciones = []
+        for modelo in modelos:
+            documento = modelo.__dict__
+            if documento.get("_id") is not None:
+                operaciones.append(pymongo.ReplaceOne({"_id": documento["_id"]}, documento, upsert=True))
+            else:   # bulk_write añade el _id al documento al insertarlo
+                operaciones.append(pymongo.InsertOne(documento))
+        return operaciones
+
+    @staticmethod
+    def _bulk_failures(error: BulkWriteError, indices: list[int], resultado: "BulkResult") -> set[int]:
+        """ Registra los documentos rechazados por bulk_write y devuelve su posicion en el lote """
+        fallidos = set()
+        for fallo in error.details.get("writeErrors", []):
+            fallidos.add(fallo["index"])
+            resultado.errors.append((indices[fallo["index"]], fallo.get("errmsg", str(fallo))))
+        return fallidos
+
+    @classmethod
+    def _cache_written(cls, pipe, modelos: list["Model"], fallidos: set[int]) -> int:
+        """ Añade al pipeline los modelos escritos y devuelve cuantos son """
+        escritos, entradas = 0, []
+        for i, modelo in enumerate(modelos):
+            if i not in fallidos:
+                escritos += 1
+                modelo._limpiar()
+                entradas.append((str(modelo._id), cls.codec.encode(modelo.__dict__)))
+                cls._local_delete(str(modelo._id))
+        cls._cache_set(pipe, entradas)
+        return escritos
 
+    @classmethod
+    def _build_batch(cls, lote: list, inicio_lote: int, resultado: "BulkResult") -> tuple[list["Model"], list[int]]:
+        """
+        Convierte un lote de documentos en modelos validados. Las
+        direcciones en texto se geocodifican todas juntas antes de
+        construir los modelos (ver _geocode_documents).
+        Devuelve los modelos validos y su posicion en la entrada.
+        """
+        fallidos = _geocode_documents(lote, range(inicio_lote, inicio_lote + len(lote)), resultado)
+
+        modelos, indices = [], []
+        for i, documento in enumerate(lote):
+            if i in fallidos:
+                continue
+            try:
+                modelo = documento if isinstance(documento, Model) else cls(**documento)
+            except (ValueError, TypeError) as e:
+                resultado.errors.append((inicio_lote + i, str(e)))
+                continue
+            modelos.append(modelo)
+            indices.append(inicio_lote + i)
+
+        return modelos, indices
+
+    @classmethod
+    def load_file(cls, path: str, batch_size: int = 1000,
+                  progress: Callable[[dict], None] | None = None) -> "BulkResult":
+        """
+        Carga en la base de datos los documentos de un fichero JSON
+        (array de objetos) o NDJSON leyendolo en streaming.
+
+        Parameters
+        ----------
+            path : str
+                ruta al fichero de documentos
+            batch_size : int
+                numero de documentos por lote
+            progress : Callable[[dict], None] | None
+                funcion a la que se pasan las estadisticas de cada lote
+        Returns
+        -------
+            BulkResult
+                resultado de save_many
+        """
+        return cls.save_many(iter_documents(path), batch_size=batch_size, progress=progress)
 
     @classmethod
-    def find(cls, filter: dict[str, str | dict]) -> Any:
+    def find(cls, filter: dict[str, str | dict], projection: dict | list | None = None,
+             limit: int = 0, skip: int = 0, sort: list[tuple[str, int]] | None = None,
+             batch_size: int = 100, cache: bool = True, cache_results: bool | int = False,
+             lazy: bool = False) -> "ModelCursor":
         """ 
         Utiliza el metodo find de pymongo para realizar una consulta
         de lectura en la BBDD.
         find debe devolver un cursor de modelos ModelCurso
+        Con cache_results el resultado completo se guarda en la cache de
+        consultas (si esta activada en initApp) hasta que se modifique la
+        coleccion o caduque.
 
         Parameters
         ----------
             filter : dict[str, str | dict]
                 diccionario con el criterio de busqueda de la consulta
+            projection : dict | list | None
+                campos a devolver, por defecto el documento completo
+            limit : int
+                numero maximo de documentos, 0 sin limite
+            skip : int
+                numero de documentos a saltar
+            sort : list[tuple[str, int]] | None
+                criterio de ordenacion de pymongo
+            batch_size : int
+                documentos por lote, tanto en mongo como en redis
+            cache : bool
+                si se añaden los documentos a la caché. Con una
+                proyeccion nunca se cachean, los documentos estan incompletos
+            cache_results : bool | int
+                si se cachea el resultado de la consulta, un entero indica
+                los segundos que se guarda en lugar del ttl por defecto.
+                Los resultados cacheados no se añaden a la caché de documentos
+            lazy : bool
+                si se devuelven vistas de solo lectura (ModelView) que
+                decodifican los campos al acceder a ellos, para recorridos
+                grandes que solo leen. No se aplica con cache_results
         Returns
         -------
             ModelCursor
@@ -192,12 +739,156 @@ class Model:
         """ 
 
         # cls es el puntero a la clase
-        
-        return ModelCursor(cls, cls.db.find(filter))
+        consulta = None
+        if cache_results and cls.query_cache is not None:
+            consulta = cls.query_cache.find_key(cls.db.name, filter, projection, limit, skip, sort)
+        if consulta is not None:
+            clave, colecciones = consulta
+            documentos, generaciones = cls.query_cache.get(clave, colecciones)
+            if documentos is None:
+                documentos = list(cls.db.find(filter, projection, limit=limit, skip=skip, sort=sort, batch_size=batch_size))
+                cls.query_cache.set(clave, colecciones, generaciones, documentos, _result_ttl(cache_results))
+            return ModelCursor(cls, iter(documentos), batch_size=batch_size, cache=False, partial=projection is not None)
+
+        coleccion = _raw_collection(cls.db) if lazy else cls.db
+        cursor = coleccion.find(filter, projection, limit=limit, skip=skip, sort=sort, batch_size=batch_size)
+        return ModelCursor(cls, cursor, batch_size=batch_size, cache=cache and projection is None, partial=projection is not None, lazy=lazy)
+
+    @classmethod
+    def _from_document(cls, documento: dict, parcial: bool = False) -> "Model":
+        """
+        Construye un modelo a partir de un documento leido de la BBDD
+        sin pasar por __setattr__, ya que sus campos ya fueron validados
+        al guardarlo. parcial indica que el documento viene de una
+        proyeccion y no tiene todos los campos.
+        El modelo adopta el documento como su __dict__ sin copiarlo, por
+        lo que no se debe reutilizar el mismo documento para dos modelos.
+        """
+        modelo = _nuevo(cls)
+        _asignar(modelo, "__dict__", documento)
+        _asignar(modelo, "_modificados", set())
+        _asignar(modelo, "_eliminados", set())
+        _asignar(modelo, "_parcial", parcial)
+        return modelo
+
+    @classmethod
+    def near(cls, point: "Point | dict | tuple[float, float] | str", max_distance: float | None = None,
+             min_distance: float | None = None, filter: dict | None = None, field: str | None = None,
+             **kwargs) -> "ModelCursor":
+        """
+        Busca los documentos cercanos a un punto con $near, ordenados del
+        mas cercano al mas lejano. Utiliza el indice 2dsphere del modelo.
+
+        Parameters
+        ----------
+            point : geojson.Point | dict | tuple[float, float] | str
+                punto de referencia, un par (longitud, latitud) o una
+                direccion a geocodificar
+            max_distance : float | None
+                distancia maxima en metros
+            min_distance : float | None
+                distancia minima en metros
+            filter : dict | None
+                criterio de busqueda adicional
+            field : str | None
+                campo geoespacial, por defecto el del indice 2dsphere
+            kwargs : dict
+                resto de parametros de find (projection, limit...)
+        Returns
+        -------
+            ModelCursor
+                cursor de modelos
+        """
+        consulta = {"$geometry": _as_point(point)}
+        if max_distance is not None:
+            consulta["$maxDistance"] = max_distance
+        if min_distance is not None:
+            consulta["$minDistance"] = min_distance
+        return cls.find({**(filter or {}), cls._geo_field(field): {"$near": consulta}}, **kwargs)
+
+    @classmethod
+    def within(cls, polygon: "Polygon | dict | list[tuple[float, float]]", filter: dict | None = None,
+               field: str | None = None, **kwargs) -> "ModelCursor":
+        """
+        Busca los documentos dentro de un poligono con $geoWithin.
+
+        Parameters
+        ----------
+            polygon : geojson.Polygon | dict | list[tuple[float, float]]
+                poligono o lista de vertices (longitud, latitud), que se
+                cierra si no lo esta
+            filter : dict | None
+                criterio de busqueda adicional
+            field : str | None
+                campo geoespacial, por defecto el del indice 2dsphere
+            kwargs : dict
+                resto de parametros de find (projection, limit...)
+        Returns
+        -------
+            ModelCursor
+                cursor de modelos
+        """
+        consulta = {"$geoWithin": {"$geometry": _as_polygon(polygon)}}
+        return cls.find({**(filter or {}), cls._geo_field(field): consulta}, **kwargs)
+
+    @classmethod
+    def _geo_field(cls, field: str | None) -> str:
+        """ Campo de las consultas geoespaciales """
+        field = field or (cls.schema.geo_field if cls.schema is not None else None)
+        if field is None:
+            raise ValueError(f"El modelo {cls.__name__} no tiene un indice 2dsphere declarado")
+        return field
+
+    @classmethod
+    def ensure_indexes(cls, drop_unknown: bool = False) -> dict[str, list]:
+        """
+        Reconcilia los indices declarados en models.yml con los de la
+        coleccion: crea los que faltan, recrea los que han cambiado y
+        modifica la expiracion de los TTL con collMod. Un indice que no
+        se puede crear (por ejemplo unico con valores repetidos) se
+        registra en errors sin impedir crear el resto.
+
+        Parameters
+        ----------
+            drop_unknown : bool
+                si se eliminan los indices que no estan declarados
+        Returns
+        -------
+            dict[str, list]
+                nombres de los indices creados, eliminados y modificados y
+                (nombre, mensaje) de los que no se han podido crear
+        """
+        plan = plan_indexes(cls.schema.indexes if cls.schema is not None else [],
+                            cls.db.index_information(), drop_unknown)
+
+        for nombre in plan["drop"]:
+            cls.db.drop_index(nombre)
+        for nombre, segundos in plan["ttl"]:
+            cls.db.database.command("collMod", cls.db.name, index={"name": nombre, "expireAfterSeconds": segundos})
+
+        errores = []
+        for indice in plan["create"]:
+            try:
+                cls.db.create_index(indice.keys, name=indice.name, **indice.options)
+            except OperationFailure as e:
+                errores.append((indice.name, str(e)))
+
+        return cls._index_summary(plan, errores)
 
+    @staticmethod
+    def _index_summary(plan: dict[str, list], errores: list[tuple[str, str]]) -> dict[str, list]:
+        """ Resumen de ensure_indexes, los indices recreados cuentan como modificados """
+        fallidos = {nombre for nombre, _ in errores}
+        creados = [indice.name for indice in plan["create"] if indice.name not in fallidos]
+        return {
+            "created": [nombre for nombre in creados if nombre not in plan["drop"]],
+            "dropped": [nombre for nombre in plan["drop"] if nombre not in creados],
+            "modified": [nombre for nombre, _ in plan["ttl"]] + [nombre for nombre in creados if nombre in plan["drop"]],
+            "errors": errores,
+        }
 
     @classmethod
-    def aggregate(cls, pipeline: list[dict]) -> pymongo.command_cursor.CommandCursor:
+    def aggregate(cls, pipeline: list[dict], cache_results: bool | int = False) -> "pymongo.command_cursor.CommandCursor | list[dict]":
         """ 
         Devuelve el resultado de una consulta aggregate. 
         No hay nada que hacer en esta funcion.
@@ -208,16 +899,31 @@ class Model:
         ----------
             pipeline : list[dict]
                 lista de etapas de la consulta aggregate 
+            cache_results : bool | int
+                si se cachea el resultado, como en find. Los pipelines
+                con $out o $merge nunca se cachean. Las colecciones de
+                $lookup, $graphLookup y $unionWith tambien invalidan el
+                resultado al modificarse
         Returns
         -------
-            pymongo.command_cursor.CommandCursor
-                cursor de pymongo con el resultado de la consulta
+            pymongo.command_cursor.CommandCursor | list[dict]
+                cursor de pymongo con el resultado de la consulta, o la
+                lista de documentos del resultado si se ha cacheado
         """ 
+        if cache_results and cls.query_cache is not None:
+            consulta = cls.query_cache.aggregate_key(cls.db.name, pipeline)
+            if consulta is not None:
+                clave, colecciones = consulta
+                documentos, generaciones = cls.query_cache.get(clave, colecciones)
+                if documentos is None:
+                    documentos = list(cls.db.aggregate(pipeline))
+                    cls.query_cache.set(clave, colecciones, generaciones, documentos, _result_ttl(cache_results))
+                return documentos
+
         return cls.db.aggregate(pipeline)
     @classmethod
-    def find_by_id(cls, id: str) -> dict | None:
+    def find_by_id(cls, id: str) -> "Model | None":
         """ 
-        NO IMPLEMENTAR HASTA LA SEGUNDA PRACTICA
         Busca un documento por su id utilizando la cache y lo devuelve.
         Si no se encuentra el documento, devuelve None.
         
@@ -227,44 +933,280 @@ class Model:
                 id del documento a buscar
         Returns
         -------
-            dict | None
-                documento encontrado o None si no se encuentra
+            Model | None
+                modelo del documento encontrado o None si no se encuentra
+        """
+        # Primero la cache en memoria y despues redis, con la lectura y
+        # renovacion de la expiracion en un unico viaje
+        valor = cls._local_get(id)
+        if valor is None:
+            valor = cls._leer_cache(keys=[cls.cache_key(id)], args=[cls._cache_ttl()])
+            cls._estadisticas.count("l2_misses" if valor is None else "l2_hits")
+            if valor is not None:
+                cls._local_set(id, valor)
+
+        if valor == _NO_EXISTE:
+            return None
+        if valor is not None:
+            return cls._from_document(cls.codec.decode(valor))               #Se reconstruye el modelo a partir de la caché
+
+        # Si no está en caché se busca en mongo. Las busquedas concurrentes
+        # del mismo id comparten una unica consulta.
+        documento = cls._en_vuelo.do((cls.__name__, id), lambda: cls._load_by_id(id))
+        if documento is None:
+            return None
+        return cls._from_document(dict(documento))     # Compartido con las llamadas concurrentes
+
+    @classmethod
+    def find_by_ids(cls, ids: Iterable[str]) -> list["Model | None"]:
+        """ 
+        Version por lotes de find_by_id. Los documentos en cache se
+        obtienen con un unico MGET, los que faltan con una unica consulta
+        $in a mongo y la cache se actualiza con un unico pipeline.
+
+        Parameters
+        ----------
+            ids : Iterable[str]
+                ids de los documentos a buscar
+        Returns
+        -------
+            list[Model | None]
+                modelos encontrados en el mismo orden que ids, None para
+                los ids que no existen
+        """
+        ids = list(ids)
+        unicos = list(dict.fromkeys(ids))
+        if not unicos:
+            return []
+
+        documentos, en_redis = cls._local_get_many(unicos)
+        faltan, aciertos = [], []
+        if en_redis:
+            for id, valor in zip(en_redis, cls.r.mget([cls.cache_key(id) for id in en_redis])):
+                cls._estadisticas.count("l2_misses" if valor is None else "l2_hits")
+                if valor is None:
+                    faltan.append(id)
+                    continue
+                cls._local_set(id, valor)
+                if valor != _NO_EXISTE:
+                    documentos[id] = cls.codec.decode(valor)
+                    aciertos.append(id)
+
+        # Se renuevan las expiraciones de los aciertos de redis y se rellenan los fallos
+        pipe = cls.r.pipeline(transaction=False)
+        for id in aciertos:
+            pipe.expire(cls.cache_key(id), cls._cache_ttl())
+
+        if faltan:
+            entradas = []
+            for documento in cls.db.find({"_id": {"$in": [ObjectId(id) for id in faltan]}}):
+                id = str(documento["_id"])
+                documentos[id] = documento
+                valor = cls.codec.encode(documento)
+                entradas.append((id, valor))
+                cls._local_set(id, valor)
+            cls._cache_set(pipe, entradas)
+
+            if cls.negative_ttl:
+                for id in faltan:
+                    if id not in documentos:
+                        pipe.setex(cls.cache_key(id), cls.negative_ttl, _NO_EXISTE)
+
+        if len(pipe):
+            pipe.execute()
+
+        # Los ids repetidos no comparten el mismo documento
+        return [cls._from_document(dict(documentos[id])) if id in documentos else None for id in ids]
+
+    @classmethod
+    def _local_get_many(cls, ids: list[str]) -> tuple[dict[str, dict], list[str]]:
+        """ Documentos de la cache en memoria y ids que hay que buscar en redis """
+        if cls.local_cache is None:
+            return {}, ids
+        documentos, faltan = {}, []
+        for id in ids:
+            valor = cls._local_get(id)
+            if valor is None:
+                faltan.append(id)
+            elif valor != _NO_EXISTE:
+                documentos[id] = cls.codec.decode(valor)
+        return documentos, faltan
+
+    @classmethod
+    def _load_by_id(cls, id: str) -> dict | None:
+        """
+        Busca un documento en mongo y lo añade a la caché. Si no existe
+        y esta activada la caché negativa, se recuerda que no existe.
         """
-        valor = cls.r.get(id)
         documento = cls.db.find_one({"_id": ObjectId(id)})
 
-        if valor is not None:                                  #Si existe en la caché, recarga el tiempo de expiración
-            cls.r.expire(id, 86400)
-            return cls.r.get(id)                                #Tras buscarlo, actualiza la caché y desde ahí lo obtiene
-        else:  
-            if documento is not None:    #Si no está en caché la busca en mongo
-                cls.r.setex(id, 86400, str(documento))
-                return cls.r.get(id) 
-            else:          
-                print("find_by_id(): No encontrado")                                 #Si no existe, devuelve None            
-                return None
+        if documento is not None:
+            valor = cls.codec.encode(documento)
+            cls._cache_set(cls.r, [(id, valor)])
+            cls._local_set(id, valor)
+        else:
+            if metrics.enabled:                                 #Si no existe, devuelve None
+                metrics.count("odm_documents_not_found_total", model=cls.__name__)
+            if cls.negative_ttl:
+                cls.r.setex(cls.cache_key(id), cls.negative_ttl, _NO_EXISTE)
+
+        return documento
 
     @classmethod
-    def init_class(cls, db_collection: pymongo.collection.Collection, redis_client: redis.client.Redis, required_vars: set[str], admissible_vars: set[str]) -> None:
+    def init_class(cls, db_collection: pymongo.collection.Collection, redis_client: redis.client.Redis, required_vars: Iterable[str], admissible_vars: Iterable[str], codec: CacheCodec | None = None, negative_ttl: int | None = None, schema: ModelSchema | None = None, query_cache: QueryCache | None = None, local_cache: LocalCache | None = None, invalidator: CacheInvalidator | None = None) -> None:
         """ 
         Inicializa las variables de clase en la inicializacion del sistema.
-        En principio nada que hacer aqui salvo que se quieran realizar
-        comprobaciones o cambios adicionales.
+        Las variables se guardan como frozensets y se precalculan las
+        comprobaciones de __init__ y __setattr__.
 
         Parameters
         ----------
             db_collection : pymongo.collection.Collection
                 Conexion a la collecion de la base de datos.
-            required_vars : set[str]
-                Set de variables requeridas por el modelo
-            admissible_vars : set[str] 
-                Set de variables admitidas por el modelo
+            required_vars : Iterable[str]
+                Variables requeridas por el modelo
+            admissible_vars : Iterable[str]
+                Variables admitidas por el modelo
+            codec : CacheCodec | None
+                Codificador de la cache, por defecto BSON
+            negative_ttl : int | None
+                Segundos que se recuerdan los ids inexistentes, None para desactivarlo
+            schema : ModelSchema | None
+                Definicion compilada con tipos y valores por defecto, se
+                suman sus variables a required_vars y admissible_vars. Su
+                politica de cache fija el ttl, el jitter y el maximo de
+                documentos del modelo en la caché
+            query_cache : QueryCache | None
+                Cache de resultados de consultas, None para desactivarla
+            local_cache : LocalCache | None
+                Cache en memoria delante de redis, None para desactivarla
+            invalidator : CacheInvalidator | None
+                Invalidacion de local_cache entre procesos
         """
         cls.db = db_collection
         cls.r = redis_client
-        cls.required_vars = required_vars
-        cls.admissible_vars = admissible_vars
+        cls._leer_cache = redis_client.register_script(READ_SCRIPT)
+        cls.schema = schema
+        cls.required_vars = frozenset(required_vars) | (schema.required if schema else frozenset())
+        cls.admissible_vars = (frozenset(admissible_vars) | (schema.admissible if schema else frozenset())) - cls.required_vars
+        cls._variables = cls.required_vars | cls.admissible_vars
+        cls._requeridas = cls.required_vars - (schema.defaults.keys() if schema else set())
+        cls._validadores = dict(schema.validators) if schema else {}
+        if schema is not None:
+            cls.cache_ttl = schema.cache.ttl
+            cls.cache_jitter = schema.cache.jitter
+            cls.cache_max_entries = schema.cache.max_entries
+        if codec is not None:
+            cls.codec = codec
+        cls.negative_ttl = negative_ttl
+        cls.query_cache = query_cache
+        cls.local_cache = local_cache
+        cls.invalidator = invalidator
+        cls._estadisticas = CacheStats(cls.__name__)
         
+class BulkResult:
+    """ 
+    Resultado de una carga masiva con Model.save_many
+
+    Attributes
+    ----------
+        written : int
+            numero de documentos escritos en la base de datos
+        errors : list[tuple[int, str]]
+            posicion en la entrada y mensaje de cada documento erroneo
+        batches : list[dict]
+            estadisticas de cada lote (tamaño, escritos, errores,
+            segundos y documentos por segundo)
+    """
+
+    def __init__(self):
+        self.written = 0
+        self.errors = []
+        self.batches = []
+
+    def add_batch(self, size: int, written: int, seconds: float) -> dict:
+        """ Registra las estadisticas de un lote y las devuelve """
+        estadisticas = {
+            "batch": len(self.batches),
+            "size": size,
+            "written": written,
+            "errors": size - written,
+            "seconds": seconds,
+            "docs_per_second": size / seconds if seconds > 0 else float("inf"),
+        }
+        self.written += written
+        self.batches.append(estadisticas)
+        return estadisticas
+
+    @property
+    def docs_per_second(self) -> float:
+        """ Rendimiento medio de la carga completa """
+        segundos = sum(lote["seconds"] for lote in self.batches)
+        return sum(lote["size"] for lote in self.batches) / segundos if segundos > 0 else 0.0
+
+    def __repr__(self) -> str:
+        return f"BulkResult(written={self.written}, errors={len(self.errors)}, batches={len(self.batches)})"
+
+class ModelView:
+    """
+    Vista de solo lectura de un documento leido como RawBSONDocument.
+    Los campos se leen con la misma sintaxis que en el modelo pero solo
+    se decodifican al acceder a ellos, sin las comprobaciones de
+    __setattr__ ni geocodificacion. Los subdocumentos se devuelven
+    tambien como RawBSONDocument (Mapping de solo lectura).
+    La primera asignacion o eliminacion de una variable, o el uso de un
+    metodo del modelo (save, delete...), decodifica el documento
+    completo en un modelo, al que la vista delega a partir de entonces.
+
+    Los atributos de la vista empiezan por _ para no ocultar campos
+    del documento.
+
+    Methods
+    -------
+        to_model() -> Model
+            Modelo modificable con el contenido de la vista.
+    """
+    __slots__ = ("_clase", "_raw", "_parcial", "_modelo")
+
+    def __init__(self, model_class: type[Model], raw: RawBSONDocument, partial: bool = False):
+        _asignar(self, "_clase", model_class)
+        _asignar(self, "_raw", raw)
+        _asignar(self, "_parcial", partial)
+        _asignar(self, "_modelo", None)
+
+    def to_model(self) -> Model:
+        """
+        Decodifica el documento en un modelo, solo la primera vez. Los
+        cambios posteriores se hacen sobre el modelo y se ven en la vista.
+        """
+        if self._modelo is None:
+            documento = bson.decode(self._raw.raw) if isinstance(self._raw, RawBSONDocument) else dict(self._raw)
+            _asignar(self, "_modelo", self._clase._from_document(documento, self._parcial))
+        return self._modelo
+
+    def __getattr__(self, name: str):
+        # Solo se llama para lo que no es un slot: campos y metodos del modelo
+        if self._modelo is not None:
+            return getattr(self._modelo, name)
+        try:
+            return self._raw[name]
+        except KeyError:
+            pass
+        if name in self._clase._variables:
+            raise AttributeError(name)
+        return getattr(self.to_model(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self.to_model(), name, value)
+
+    def __delattr__(self, name: str) -> None:
+        delattr(self.to_model(), name)
+
+    def __repr__(self) -> str:
+        if self._modelo is not None:
+            return repr(self._modelo)
+        return f"{self._clase.__name__}View(_id={self._raw.get('_id')!r})"
+
 class ModelCursor:
     """ 
     Cursor para iterar sobre los documentos del resultado de una
@@ -277,6 +1219,12 @@ class ModelCursor:
             Clase para crear los modelos de los documentos que se iteran.
         cursor : pymongo.cursor.Cursor
             Cursor de pymongo a iterar
+        batch_size : int
+            Numero de documentos que se procesan y cachean a la vez
+        cache : bool
+            Si se añaden los documentos a la caché
+        lazy : bool
+            Si se devuelven vistas ModelView en lugar de modelos
 
     Methods
     -------
@@ -285,7 +1233,7 @@ class ModelCursor:
             y devuelve los documentos en forma de objetos modelo.
     """
 
-    def __init__(self, model_class: Model, cursor: pymongo.cursor.Cursor):
+    def __init__(self, model_class: Model, cursor: pymongo.cursor.Cursor, batch_size: int = 100, cache: bool = True, partial: bool = False, lazy: bool = False):
         """
         Inicializa el cursor con la clase de modelo y el cursor de pymongo
 
@@ -295,23 +1243,46 @@ class ModelCursor:
                 Clase para crear los modelos de los documentos que se iteran.
             cursor: pymongo.cursor.Cursor
                 Cursor de pymongo a iterar
+            batch_size : int
+                Numero de documentos que se procesan y cachean a la vez
+            cache : bool
+                Si se añaden los documentos a la caché, desactivar en
+                recorridos grandes para no desplazar la caché LRU
+            partial : bool
+                Si los documentos vienen de una proyeccion
+            lazy : bool
+                Si los documentos son RawBSONDocument y se devuelven
+                como vistas ModelView sin decodificarlos
         """
         self.model = model_class
         self.cursor = cursor
+        self.batch_size = batch_size
+        self.cache = cache
+        self.partial = partial
+        self.lazy = lazy
     
     def __iter__(self) -> Generator:
         """
         Devuelve un iterador que recorre los elementos del cursor
         y devuelve los documentos en forma de objetos modelo.
-        Utilizar yield para generar el iterador
-        Utilizar la funcion next para obtener el siguiente documento del cursor
-        Utilizar alive para comprobar si existen mas documentos.
+        Los documentos se leen en lotes de batch_size y cada lote se
+        añade a la caché con un unico pipeline de redis.
         """
-        
-        while self.cursor.alive:
-            siguiente = next(self.cursor)
-            modelo = self.model(**siguiente)
+        cursor = iter(self.cursor)
+
+        while True:
+            lote = list(islice(cursor, self.batch_size))
+            if not lote:
+                return
 
-            self.r.setex( str(modelo._id), 86400 , str(modelo.__dict__))  #setex permite añadir tiempo de expiración
+            if self.cache:
+                pipe = self.model.r.pipeline(transaction=False)
+                self.model._cache_set(pipe, [(str(documento["_id"]), self.model.codec.encode(documento)) for documento in lote])
+                pipe.execute()
 
-            yield modelo
\ No newline at end of file
+            if self.lazy:
+                for documento in lote:
+                    yield ModelView(self.model, documento, self.partial)
+            else:
+                for documento in lote:
+                    yield self.model._from_document(documento, self.partial)
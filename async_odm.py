@@ -0,0 +1,464 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import asyncio
+import time
+from itertools import islice
+from typing import AsyncGenerator, Callable, Iterable
+
+import redis.asyncio
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, OperationFailure
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.command_cursor import AsyncCommandCursor
+from pymongo.asynchronous.cursor import AsyncCursor
+
+from ODM import Model, BulkResult, ModelView, _NO_EXISTE, _raw_collection, _result_ttl
+from schema import plan_indexes
+from ingest import iter_documents
+from concurrency import AsyncSingleFlight
+from instrumentation import metrics
+
+
+class AsyncModel(Model):
+    """
+    Version asyncio de Model, construida sobre el cliente asincrono de
+    pymongo (AsyncMongoClient) y redis.asyncio.
+    La validacion, el seguimiento de cambios y el formato de la cache
+    son los de Model, solo cambian las operaciones de entrada/salida,
+    que pasan a ser corrutinas.
+    La geocodificacion de direcciones en texto en __setattr__ es
+    bloqueante, en codigo asincrono conviene asignar directamente el
+    geojson.Point (por ejemplo con asyncio.to_thread(getLocationPoint, ...)).
+
+    Attributes
+    ----------
+        db : pymongo.asynchronous.collection.AsyncCollection
+            conexion asincrona a la coleccion de la base de datos
+        r : redis.asyncio.Redis
+            cliente asincrono de redis
+
+    Methods
+    -------
+        save() -> None
+            Guarda el modelo en la base de datos, enviando solo los cambios
+        delete() -> None
+            Elimina el modelo de la base de datos
+        find(filter: dict[str, str | dict], ...) -> AsyncModelCursor
+            Realiza una consulta de lectura en la BBDD.
+        aggregate(pipeline: list[dict]) -> AsyncCommandCursor
+            Devuelve el resultado de una consulta aggregate.
+        find_by_id(id: str) -> AsyncModel | None
+            Busca un documento por su id utilizando la cache.
+        find_by_ids(ids: Iterable[str]) -> list[AsyncModel | None]
+            Busca varios documentos por su id con un MGET y una consulta $in.
+        save_many(documents: Iterable[dict | Model], batch_size: int) -> BulkResult
+            Guarda muchos documentos en lotes con bulk_write.
+        ensure_indexes(drop_unknown: bool) -> dict[str, list]
+            Crea o modifica los indices declarados en models.yml.
+
+    near() y within() son los de Model y devuelven un AsyncModelCursor.
+    """
+    db: AsyncCollection
+    r: redis.asyncio.Redis
+    _en_vuelo_async: AsyncSingleFlight = AsyncSingleFlight()
+
+    async def save(self) -> None:
+        """
+        Guarda el modelo en la base de datos
+        Si el modelo no existe en la base de datos, se crea un nuevo
+        documento. En caso contrario se envian solo las variables
+        modificadas ($set) y eliminadas ($unset).
+        """
+        _id = self.__dict__.get('_id')
+
+        if _id:    # Si existe el id, se actualizan solo los cambios
+            if not self.is_dirty:
+                return
+
+            cambios = {}
+            modificados = {name: self.__dict__[name] for name in self._modificados if name != "_id"}
+            if modificados:
+                cambios["$set"] = modificados
+            if self._eliminados:
+                cambios["$unset"] = {name: "" for name in self._eliminados}
+
+            if cambios:
+                await self.db.update_one({"_id": _id}, cambios, upsert=not self._parcial)
+
+        else:   # Si no existe, se inserta creando un id nuevo en el proceso
+            await self.db.insert_one(self.__dict__)
+
+        self._limpiar()
+
+        key = str(self.__dict__.get('_id'))
+        if self._parcial:
+            if await self.r.delete(self.cache_key(key)) and metrics.enabled:
+                metrics.count("odm_cache_evictions_total", model=type(self).__name__, reason="partial_save")
+            self._local_delete(key)
+        else:
+            valor = self.codec.encode(self.__dict__)
+            pipe = self.r.pipeline(transaction=False)
+            self._cache_set(pipe, [(key, valor)])
+            await pipe.execute()
+            self._local_set(key, valor)
+
+        await self._publish_invalidation([key])
+        await self._invalidate_queries()
+
+    async def delete(self) -> None:
+        """
+        Elimina el modelo de la base de datos y de la caché
+        """
+        _id = self.__dict__.get("_id")
+        if await self.r.delete(self.cache_key(str(_id))) and metrics.enabled:
+            metrics.count("odm_cache_evictions_total", model=type(self).__name__, reason="delete")
+        self._local_delete(str(_id))
+        await self.db.delete_one({"_id": _id})
+        await self._publish_invalidation([str(_id)])
+        await self._invalidate_queries()
+
+    @classmethod
+    async def _publish_invalidation(cls, keys: list[str]) -> None:
+        if cls.invalidator is not None and keys:
+            await cls.r.publish(cls.invalidator.channel, cls.invalidator.message([cls.cache_key(key) for key in keys]))
+
+    @classmethod
+    async def cache_clear(cls, batch_size: int = 500) -> int:
+        """
+        Elimina de la caché los documentos del modelo con SCAN y UNLINK.
+        Devuelve el numero de claves eliminadas.
+        """
+        eliminadas, lote = 0, []
+        async for key in cls.r.scan_iter(match=cls.cache_key("*"), count=batch_size):
+            lote.append(key)
+            if len(lote) >= batch_size:
+                eliminadas += await cls.r.unlink(*lote)
+                lote = []
+        if lote:
+            eliminadas += await cls.r.unlink(*lote)
+        if cls.local_cache is not None:
+            cls.local_cache.delete_prefix(cls.cache_key(""))
+        await cls._publish_invalidation(["*"])
+        return eliminadas
+
+    @classmethod
+    async def _invalidate_queries(cls) -> None:
+        if cls.query_cache is not None:
+            await cls.query_cache.invalidate(cls.db.name)
+
+    @classmethod
+    async def save_many(cls, documents: Iterable["dict | Model"], batch_size: int = 1000,
+                        progress: Callable[[dict], None] | None = None) -> BulkResult:
+        """
+        Version asincrona de Model.save_many: lotes bulk_write no
+        ordenados y un unico pipeline de redis por lote. Cada lote se
+        valida y geocodifica en un hilo, el geocodificador es sincrono
+        y respeta el limite de peticiones de la API con esperas.
+
+        Returns
+        -------
+            BulkResult
+                documentos escritos, errores por documento y
+                estadisticas de cada lote
+        """
+        resultado = BulkResult()
+        documents = iter(documents)
+        inicio_lote = 0
+
+        while True:
+            lote = list(islice(documents, batch_size))
+            if not lote:
+                break
+
+            inicio = time.perf_counter()
+            modelos, indices = await asyncio.to_thread(cls._build_batch, lote, inicio_lote, resultado)
+            operaciones = cls._bulk_operations(modelos)
+
+            fallidos = set()
+            if operaciones:
+                try:
+                    await cls.db.bulk_write(operaciones, ordered=False)
+                except BulkWriteError as e:
+                    fallidos = cls._bulk_failures(e, indices, resultado)
+
+            pipe = cls.r.pipeline(transaction=False)
+            escritos = cls._cache_written(pipe, modelos, fallidos)
+            await pipe.execute()
+            if escritos:
+                await cls._publish_invalidation([str(modelo._id) for i, modelo in enumerate(modelos) if i not in fallidos])
+                await cls._invalidate_queries()
+
+            estadisticas = resultado.add_batch(len(lote), escritos, time.perf_counter() - inicio)
+            if progress is not None:
+                progress(estadisticas)
+
+            inicio_lote += len(lote)
+
+        return resultado
+
+    @classmethod
+    async def load_file(cls, path: str, batch_size: int = 1000,
+                        progress: Callable[[dict], None] | None = None) -> BulkResult:
+        """
+        Carga en la base de datos los documentos de un fichero JSON o NDJSON.
+        """
+        return await cls.save_many(iter_documents(path), batch_size=batch_size, progress=progress)
+
+    @classmethod
+    def find(cls, filter: dict[str, str | dict], projection: dict | list | None = None,
+             limit: int = 0, skip: int = 0, sort: list[tuple[str, int]] | None = None,
+             batch_size: int = 100, cache: bool = True, cache_results: bool | int = False,
+             lazy: bool = False) -> "AsyncModelCursor":
+        """
+        Realiza una consulta de lectura en la BBDD, con los mismos
+        parametros que Model.find. Con cache_results la consulta a la
+        cache de resultados se hace al empezar a recorrer el cursor.
+
+        Returns
+        -------
+            AsyncModelCursor
+                cursor asincrono de modelos, se recorre con async for
+        """
+        consulta = None
+        if cache_results and cls.query_cache is not None:
+            consulta = cls.query_cache.find_key(cls.db.name, filter, projection, limit, skip, sort)
+        if consulta is not None:
+            documentos = cls._find_cached(consulta, filter, projection, limit, skip, sort, batch_size, _result_ttl(cache_results))
+            return AsyncModelCursor(cls, documentos, batch_size=batch_size, cache=False, partial=projection is not None)
+
+        coleccion = _raw_collection(cls.db) if lazy else cls.db
+        cursor = coleccion.find(filter, projection, limit=limit, skip=skip, sort=sort, batch_size=batch_size)
+        return AsyncModelCursor(cls, cursor, batch_size=batch_size, cache=cache and projection is None, partial=projection is not None, lazy=lazy)
+
+    @classmethod
+    async def _find_cached(cls, consulta, filter, projection, limit, skip, sort, batch_size, ttl) -> AsyncGenerator:
+        """ Documentos de una consulta find a traves de la cache de resultados """
+        clave, colecciones = consulta
+        documentos, generaciones = await cls.query_cache.get(clave, colecciones)
+        if documentos is None:
+            documentos = await cls.db.find(filter, projection, limit=limit, skip=skip, sort=sort, batch_size=batch_size).to_list()
+            await cls.query_cache.set(clave, colecciones, generaciones, documentos, ttl)
+        for documento in documentos:
+            yield documento
+
+    @classmethod
+    async def ensure_indexes(cls, drop_unknown: bool = False) -> dict[str, list]:
+        """
+        Version asincrona de Model.ensure_indexes.
+        """
+        plan = plan_indexes(cls.schema.indexes if cls.schema is not None else [],
+                            await cls.db.index_information(), drop_unknown)
+
+        for nombre in plan["drop"]:
+            await cls.db.drop_index(nombre)
+        for nombre, segundos in plan["ttl"]:
+            await cls.db.database.command("collMod", cls.db.name, index={"name": nombre, "expireAfterSeconds": segundos})
+
+        errores = []
+        for indice in plan["create"]:
+            try:
+                await cls.db.create_index(indice.keys, name=indice.name, **indice.options)
+            except OperationFailure as e:
+                errores.append((indice.name, str(e)))
+
+        return cls._index_summary(plan, errores)
+
+    @classmethod
+    async def aggregate(cls, pipeline: list[dict], cache_results: bool | int = False) -> "AsyncCommandCursor | list[dict]":
+        """
+        Devuelve el resultado de una consulta aggregate.
+
+        Parameters
+        ----------
+            pipeline : list[dict]
+                lista de etapas de la consulta aggregate
+            cache_results : bool | int
+                si se cachea el resultado, como en Model.aggregate
+        Returns
+        -------
+            AsyncCommandCursor | list[dict]
+                cursor asincrono de pymongo con el resultado de la consulta,
+                o la lista de documentos si se ha cacheado
+        """
+        if cache_results and cls.query_cache is not None:
+            consulta = cls.query_cache.aggregate_key(cls.db.name, pipeline)
+            if consulta is not None:
+                clave, colecciones = consulta
+                documentos, generaciones = await cls.query_cache.get(clave, colecciones)
+                if documentos is None:
+                    documentos = await (await cls.db.aggregate(pipeline)).to_list()
+                    await cls.query_cache.set(clave, colecciones, generaciones, documentos, _result_ttl(cache_results))
+                return documentos
+
+        return await cls.db.aggregate(pipeline)
+
+    @classmethod
+    async def find_by_id(cls, id: str) -> "AsyncModel | None":
+        """
+        Busca un documento por su id utilizando la cache y lo devuelve.
+        Un acierto es un unico viaje a redis, los fallos concurrentes del mismo
+        id comparten una unica consulta a mongo.
+
+        Parameters
+        ----------
+            id : str
+                id del documento a buscar
+        Returns
+        -------
+            AsyncModel | None
+                modelo del documento encontrado o None si no se encuentra
+        """
+        valor = cls._local_get(id)
+        if valor is None:
+            valor = await cls._leer_cache(keys=[cls.cache_key(id)], args=[cls._cache_ttl()])
+            cls._estadisticas.count("l2_misses" if valor is None else "l2_hits")
+            if valor is not None:
+                cls._local_set(id, valor)
+
+        if valor == _NO_EXISTE:
+            return None
+        if valor is not None:
+            return cls._from_document(cls.codec.decode(valor))
+
+        documento = await cls._en_vuelo_async.do((cls.__name__, id), lambda: cls._load_by_id(id))
+        if documento is None:
+            return None
+        return cls._from_document(dict(documento))     # Compartido con las llamadas concurrentes
+
+    @classmethod
+    async def _load_by_id(cls, id: str) -> dict | None:
+        documento = await cls.db.find_one({"_id": ObjectId(id)})
+
+        if documento is not None:
+            valor = cls.codec.encode(documento)
+            pipe = cls.r.pipeline(transaction=False)
+            cls._cache_set(pipe, [(id, valor)])
+            await pipe.execute()
+            cls._local_set(id, valor)
+        else:
+            if metrics.enabled:
+                metrics.count("odm_documents_not_found_total", model=cls.__name__)
+            if cls.negative_ttl:
+                await cls.r.setex(cls.cache_key(id), cls.negative_ttl, _NO_EXISTE)
+
+        return documento
+
+    @classmethod
+    async def find_by_ids(cls, ids: Iterable[str]) -> list["AsyncModel | None"]:
+        """
+        Version por lotes de find_by_id: un MGET para los aciertos, una
+        consulta $in para los fallos y un pipeline para la caché.
+
+        Parameters
+        ----------
+            ids : Iterable[str]
+                ids de los documentos a buscar
+        Returns
+        -------
+            list[AsyncModel | None]
+                modelos encontrados en el mismo orden que ids
+        """
+        ids = list(ids)
+        unicos = list(dict.fromkeys(ids))
+        if not unicos:
+            return []
+
+        documentos, en_redis = cls._local_get_many(unicos)
+        faltan, aciertos = [], []
+        if en_redis:
+            for id, valor in zip(en_redis, await cls.r.mget([cls.cache_key(id) for id in en_redis])):
+                cls._estadisticas.count("l2_misses" if valor is None else "l2_hits")
+                if valor is None:
+                    faltan.append(id)
+                    continue
+                cls._local_set(id, valor)
+                if valor != _NO_EXISTE:
+                    documentos[id] = cls.codec.decode(valor)
+                    aciertos.append(id)
+
+        pipe = cls.r.pipeline(transaction=False)
+        for id in aciertos:
+            pipe.expire(cls.cache_key(id), cls._cache_ttl())
+
+        if faltan:
+            entradas = []
+            async for documento in cls.db.find({"_id": {"$in": [ObjectId(id) for id in faltan]}}):
+                id = str(documento["_id"])
+                documentos[id] = documento
+                valor = cls.codec.encode(documento)
+                entradas.append((id, valor))
+                cls._local_set(id, valor)
+            cls._cache_set(pipe, entradas)
+
+            if cls.negative_ttl:
+                for id in faltan:
+                    if id not in documentos:
+                        pipe.setex(cls.cache_key(id), cls.negative_ttl, _NO_EXISTE)
+
+        if len(pipe):
+            await pipe.execute()
+
+        return [cls._from_document(dict(documentos[id])) if id in documentos else None for id in ids]
+
+
+class AsyncModelCursor:
+    """
+    Cursor asincrono para iterar sobre los documentos del resultado de
+    una consulta con async for. Igual que ModelCursor, lee los
+    documentos por lotes y cachea cada lote con un unico pipeline.
+
+    Attributes
+    ----------
+        model_class : AsyncModel
+            Clase para crear los modelos de los documentos que se iteran.
+        cursor : pymongo.asynchronous.cursor.AsyncCursor
+            Cursor asincrono de pymongo a iterar
+        batch_size : int
+            Numero de documentos que se procesan y cachean a la vez
+        cache : bool
+            Si se añaden los documentos a la caché
+        lazy : bool
+            Si se devuelven vistas ModelView en lugar de modelos
+    """
+
+    def __init__(self, model_class: type[AsyncModel], cursor: AsyncCursor, batch_size: int = 100, cache: bool = True, partial: bool = False, lazy: bool = False):
+        self.model = model_class
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.cache = cache
+        self.partial = partial
+        self.lazy = lazy
+
+    def _modelo(self, documento):
+        if self.lazy:
+            return ModelView(self.model, documento, self.partial)
+        return self.model._from_document(documento, self.partial)
+
+    async def _cachear(self, lote: list[dict]) -> None:
+        pipe = self.model.r.pipeline(transaction=False)
+        self.model._cache_set(pipe, [(str(documento["_id"]), self.model.codec.encode(documento)) for documento in lote])
+        await pipe.execute()
+
+    def __aiter__(self) -> AsyncGenerator:
+        return self._iterar()
+
+    async def _iterar(self) -> AsyncGenerator:
+        lote = []
+        async for documento in self.cursor:
+            lote.append(documento)
+            if len(lote) == self.batch_size:
+                if self.cache:
+                    await self._cachear(lote)
+                for documento in lote:
+                    yield self._modelo(documento)
+                lote = []
+
+        if lote:
+            if self.cache:
+                await self._cachear(lote)
+            for documento in lote:
+                yield self._modelo(documento)
+
+    async def to_list(self) -> list[AsyncModel]:
+        """ Devuelve todos los modelos del cursor en una lista """
+        return [modelo async for modelo in self]
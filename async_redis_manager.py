@@ -0,0 +1,471 @@
+import asyncio
+import itertools
+import time
+import uuid
+import connections
+from passwords import hash_password, is_hashed, verify_password
+from redis_manager import (BLOQUEO_MAXIMO, SESSION_TTL, USERS_KEY, REGISTER_SCRIPT, EDIT_SCRIPT,
+                           TICKET_VISIBILITY, AVISOS_MAXIMOS, CREATE_TICKET_SCRIPT,
+                           CLAIM_SCRIPT, ACK_SCRIPT, REQUEUE_SCRIPT, RATE_LIMIT_SCRIPT, REFRESH_SESSION_SCRIPT, Keyspace, RateLimitExceeded,
+                           session_key, user_sessions_key, user_key, decode_user, is_cluster,
+                           rate_limit_key, parse_rate_limits, claim_order, merge_page,
+                           prefix_range, name_entry_user, user_tickets_key, check_priority, decode_ticket,
+                           count_event)
+
+# Version asyncio de RedisManager con los mismos metodos y el mismo
+# formato de datos en redis, todos los metodos son corrutinas.
+# El hash de las contraseñas es costoso a proposito y se calcula en
+# un hilo para no bloquear el bucle de eventos
+
+class AsyncRedisManager():
+    # db: cliente asincrono, admite un redis.asyncio.cluster.RedisCluster
+    # (ver connections.get_async_redis_cluster). El resto de parametros
+    # como en RedisManager
+    def __init__(self, db=None, ticket_shards=1, user_partitions=1, rate_limits=None):
+        self.db = db if db is not None else connections.get_async_redis()
+        self.cluster = is_cluster(self.db)
+        self.keys = Keyspace(ticket_shards, user_partitions, self.cluster)
+        self.rate_limits = parse_rate_limits(rate_limits)
+        self._turno = itertools.count()
+        self._register = self.db.register_script(REGISTER_SCRIPT)
+        self._edit = self.db.register_script(EDIT_SCRIPT)
+        self._create_ticket = self.db.register_script(CREATE_TICKET_SCRIPT)
+        self._claim = self.db.register_script(CLAIM_SCRIPT)
+        self._ack = self.db.register_script(ACK_SCRIPT)
+        self._requeue = self.db.register_script(REQUEUE_SCRIPT)
+        self._rate_limit = self.db.register_script(RATE_LIMIT_SCRIPT)
+
+    async def _check_rate(self, accion, nombre_usuario):
+        limite = self.rate_limits.get(accion)
+        if limite is None:
+            return
+        espera = await self._rate_limit(keys=[rate_limit_key(accion, nombre_usuario)], args=limite)
+        if espera:
+            count_event(accion + "_rate_limited")
+            raise RateLimitExceeded(accion, espera / 1000)
+
+    async def register(self, nombre_usuario, nombre_completo, contraseña, privilegios):
+        if not await self._create_user(nombre_usuario, nombre_completo, await asyncio.to_thread(hash_password, contraseña), privilegios, 0):
+            raise ValueError("El usuario ya existe")
+
+        count_event("user_registered")
+
+    async def _create_user(self, nombre_usuario, nombre_completo, contraseña, privilegios, version):
+        campos = ["nombre_completo", nombre_completo, "contraseña", contraseña, "privilegios", privilegios, "version", version]
+
+        claves, argumentos = self.keys.register_args(nombre_usuario, nombre_completo, privilegios)
+
+        if not await self._register(keys=claves, args=argumentos + campos):
+            return False
+
+        if not self.keys.script_indexes:
+            pipe = self.db.pipeline(transaction=False)
+            self.keys.add_user_to_indexes(pipe, nombre_usuario, nombre_completo, privilegios)
+            await pipe.execute()
+        return True
+
+    async def user_exists(self, nombre_usuario):
+        return await self.db.exists(user_key(nombre_usuario)) == 1
+
+    async def _verify(self, nombre_usuario, contraseña):
+        await self._check_rate("login", nombre_usuario)
+
+        almacenada, privilegios, version = await self.db.hmget(user_key(nombre_usuario), "contraseña", "privilegios", "version")
+
+        if almacenada is None:
+            count_event("login_unknown_user")
+            return None
+
+        almacenada = almacenada.decode("utf-8")
+
+        if not await asyncio.to_thread(verify_password, contraseña, almacenada):
+            count_event("login_wrong_password")
+            return None
+
+        if not is_hashed(almacenada):
+            await self.db.hset(user_key(nombre_usuario), "contraseña", await asyncio.to_thread(hash_password, contraseña))
+
+        return {"privilegios": int(privilegios), "version": int(version or 0)}
+
+    async def _create_session(self, nombre_usuario, user_info):
+        token = str(uuid.uuid4())
+        sesion = {"nombre_usuario": nombre_usuario, "privilegios": user_info["privilegios"], "version": user_info.get("version", 0)}
+
+        pipe = self.db.pipeline()
+        pipe.sadd(user_sessions_key(nombre_usuario), token)
+        pipe.hset(session_key(token), mapping=sesion)
+        pipe.expire(session_key(token), SESSION_TTL)
+        await pipe.execute()
+
+        privilegios, version = await self.db.hmget(user_key(nombre_usuario), "privilegios", "version")
+        if privilegios is None or int(version or 0) != sesion["version"]:
+            pipe = self.db.pipeline()
+            pipe.delete(session_key(token))
+            pipe.srem(user_sessions_key(nombre_usuario), token)
+            await pipe.execute()
+            return None
+
+        return token
+
+    async def _login_session(self, nombre_usuario, contraseña):
+        while True:
+            user_info = await self._verify(nombre_usuario, contraseña)
+            if user_info is None:
+                return None
+
+            token = await self._create_session(nombre_usuario, user_info)
+            if token is not None:
+                return user_info, token
+
+    async def generate_token(self, nombre_usuario, contraseña):
+        sesion = await self._login_session(nombre_usuario, contraseña)
+
+        if sesion is None:
+            raise ValueError("Usuario o contraseña incorrectos")
+
+        return sesion[1]
+
+    async def login(self, nombre_usuario, contraseña):
+        user_info = await self._verify(nombre_usuario, contraseña)
+
+        if user_info is None:
+            return -1
+
+        return user_info["privilegios"]
+
+    async def login_and_generate_token(self, nombre_usuario, contraseña):
+        sesion = await self._login_session(nombre_usuario, contraseña)
+
+        if sesion is None:
+            return -1
+
+        user_info, token = sesion
+        return user_info["privilegios"], token
+
+    async def login_with_token(self, token):
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hgetall(session_key(token))
+        pipe.expire(session_key(token), SESSION_TTL)
+        sesion = (await pipe.execute())[0]
+
+        if b"nombre_usuario" not in sesion:
+            return -1
+
+        return int(sesion[b"privilegios"])
+
+    async def _active_sessions(self, nombre_usuario):
+        tokens = [token.decode("utf-8") for token in await self.db.smembers(user_sessions_key(nombre_usuario))]
+        if not tokens:
+            return []
+
+        pipe = self.db.pipeline(transaction=False)
+        for token in tokens:
+            pipe.exists(session_key(token))
+        existe = await pipe.execute()
+
+        caducadas = [token for token, activa in zip(tokens, existe) if not activa]
+        if caducadas:
+            await self.db.srem(user_sessions_key(nombre_usuario), *caducadas)
+
+        return [token for token, activa in zip(tokens, existe) if activa]
+
+    async def _refresh_sessions(self, nombre_usuario, privilegios, version):
+        tokens = await self._active_sessions(nombre_usuario)
+        if not tokens:
+            return
+
+        pipe = self.db.pipeline(transaction=False)
+        for token in tokens:
+            pipe.eval(REFRESH_SESSION_SCRIPT, 1, session_key(token), privilegios, version)
+        await pipe.execute()
+
+    async def _invalidate_sessions(self, nombre_usuario):
+        tokens = [token.decode("utf-8") for token in await self.db.smembers(user_sessions_key(nombre_usuario))]
+
+        pipe = self.db.pipeline(transaction=False)
+        for token in tokens:
+            pipe.delete(session_key(token))
+        pipe.delete(user_sessions_key(nombre_usuario))
+        await pipe.execute()
+
+    async def edit_user_info(self, nombre_usuario, nombre_completo=None, contraseña=None, privilegios=None):
+        campos = []
+
+        if(nombre_completo != None):
+            campos += ["nombre_completo", nombre_completo]
+
+        if(contraseña != None):
+            campos += ["contraseña", await asyncio.to_thread(hash_password, contraseña)]
+
+        if(privilegios != None):
+            campos += ["privilegios", privilegios]
+
+        incrementar = "1" if contraseña != None or privilegios != None else "0"
+        version = -2
+        while version == -2:
+            anterior = None
+            if self.keys.edit_reads_previous(nombre_completo, privilegios):
+                anterior = await self.db.hmget(user_key(nombre_usuario), "privilegios", "nombre_completo")
+                anterior = [valor.decode("utf-8") if valor is not None else None for valor in anterior]
+            claves, argumentos = self.keys.edit_args(nombre_usuario, anterior, nombre_completo, privilegios)
+            version, *anterior = await self._edit(keys=claves, args=[incrementar] + argumentos + campos)
+
+        if version == -1:
+            raise ValueError("El usuario no existe")
+
+        if not self.keys.script_indexes:
+            anterior = [valor.decode("utf-8") if valor is not None else None for valor in anterior]
+            pipe = self.db.pipeline(transaction=False)
+            self.keys.update_user_indexes(pipe, nombre_usuario, anterior, nombre_completo, privilegios)
+            if len(pipe):
+                await pipe.execute()
+
+        if contraseña != None:
+            await self._invalidate_sessions(nombre_usuario)
+        elif privilegios != None:
+            await self._refresh_sessions(nombre_usuario, privilegios, version)
+
+        count_event("user_updated")
+
+    # Funciones Help Desk
+
+    async def create_ticket(self, nombre_usuario, titulo, descripcion, prioridad):
+        check_priority(prioridad)
+        await self._check_rate("create_ticket", nombre_usuario)
+
+        shard = next(self._turno) % self.keys.ticket_shards
+        if self.keys.tagged and not await self.user_exists(nombre_usuario):
+            raise ValueError("El usuario no existe")
+
+        numero = await self.db.incr(self.keys.ticket_shard(shard)[3])
+        if not await self._create_ticket(keys=self.keys.create_ticket_keys(shard, numero, nombre_usuario),
+                                         args=[numero, nombre_usuario, prioridad, titulo, descripcion, AVISOS_MAXIMOS]):
+            raise ValueError("El usuario no existe")
+
+        ticket_id = self.keys.ticket_id(shard, numero)
+        if self.keys.tagged:
+            await self.db.zadd(user_tickets_key(nombre_usuario), {ticket_id: time.time()})
+
+        count_event("ticket_created")
+        return ticket_id
+
+    async def _claim_order(self, turno):
+        if self.keys.ticket_shards == 1:
+            return [0]
+
+        ahora = int(time.time() * 1000)
+        pipe = self.db.pipeline(transaction=False)
+        for _, (pendientes, reclamados, _, _, _) in self.keys.shards():
+            pipe.zrange(pendientes, -1, -1, withscores=True)
+            pipe.zcount(reclamados, "-inf", ahora)
+        resultados = await pipe.execute()
+        return claim_order(resultados[::2], resultados[1::2], turno)
+
+    # timeout: None para no esperar, segundos de espera si no hay tickets
+    # o 0 para esperar indefinidamente
+    async def claim_ticket(self, timeout=None, visibility=TICKET_VISIBILITY):
+        reclamacion = str(uuid.uuid4())
+        limite = None if not timeout else time.monotonic() + timeout
+
+        while True:
+            turno = next(self._turno)
+            for shard in await self._claim_order(turno):
+                pendientes, reclamados, avisos, _, prefijo = self.keys.ticket_shard(shard)
+                ticket = await self._claim(keys=[pendientes, reclamados, avisos], args=[prefijo, int(visibility * 1000), reclamacion])
+                if ticket is not None:
+                    numero, campos = ticket
+                    return self.keys.ticket_id(shard, numero.decode("utf-8")), reclamacion, decode_ticket(campos)
+
+            if timeout is None:
+                return None
+
+            espera = BLOQUEO_MAXIMO
+            if limite is not None:
+                espera = min(espera, limite - time.monotonic())
+                if espera <= 0:
+                    return None
+            await self.db.blpop(self.keys.notify_keys(turno, self.cluster), espera)
+
+    async def ack_ticket(self, ticket_id, reclamacion, nombre_usuario=None):
+        if nombre_usuario is None and not self.keys.tagged:
+            nombre_usuario = await self.db.hget(self.keys.ticket_key(ticket_id), "usuario")
+            if nombre_usuario is None:
+                return False
+            nombre_usuario = nombre_usuario.decode("utf-8")
+
+        usuario = await self._ack(keys=self.keys.ack_keys(ticket_id, nombre_usuario),
+                                  args=[self.keys.split_ticket_id(ticket_id)[1], reclamacion, nombre_usuario or ""])
+        if usuario == -1:
+            raise ValueError("El ticket no es del usuario " + nombre_usuario)
+        if usuario == 0:
+            return False
+
+        if self.keys.tagged:
+            await self.db.zrem(user_tickets_key(usuario.decode("utf-8")), ticket_id)
+        return True
+
+    async def requeue_expired_tickets(self):
+        devueltos = 0
+        for _, (pendientes, reclamados, _, _, prefijo) in self.keys.shards():
+            devueltos += await self._requeue(keys=[pendientes, reclamados], args=[prefijo])
+        return devueltos
+
+    # timeout: segundos de espera si no hay tickets, 0 para esperar indefinidamente
+    async def attend_ticket(self, timeout=0):
+
+        ticket = await self.claim_ticket()
+
+        if ticket is None:
+            # Si no hay tickets se queda en espera sin bloquear el bucle de eventos
+            count_event("tickets_empty_wait")
+            ticket = await self.claim_ticket(timeout)
+
+            if ticket is None:
+                count_event("tickets_empty")
+                return None
+
+        ticket_id, reclamacion, ticket_info = ticket
+        await self.ack_ticket(ticket_id, reclamacion, ticket_info["usuario"])
+
+        count_event("ticket_attended")
+
+        return ticket_info["usuario"]
+
+    async def user_tickets(self, nombre_usuario, offset=0, count=50):
+        ids = [ticket_id.decode("utf-8") for ticket_id in await self.db.zrange(user_tickets_key(nombre_usuario), offset, offset + count - 1)]
+
+        pipe = self.db.pipeline(transaction=False)
+        for ticket_id in ids:
+            pipe.hgetall(self.keys.ticket_key(ticket_id))
+
+        return [(ticket_id, decode_ticket(ticket_info)) for ticket_id, ticket_info in zip(ids, await pipe.execute()) if ticket_info]
+
+    async def ticket_counts(self):
+        pipe = self.db.pipeline(transaction=False)
+        for _, (pendientes, reclamados, _, _, _) in self.keys.shards():
+            pipe.zcard(pendientes)
+            pipe.zcard(reclamados)
+        cantidades = await pipe.execute()
+        return {"pendientes": sum(cantidades[::2]), "atendiendo": sum(cantidades[1::2])}
+
+    # Atiende tickets con varios atendientes concurrentes hasta que la cola
+    # quede vacia durante timeout segundos. Devuelve los usuarios atendidos
+    async def serve_tickets(self, workers=4, timeout=1):
+        atendidos = []
+
+        async def atendiente():
+            while True:
+                id_usuario = await self.attend_ticket(timeout)
+                if id_usuario is None:
+                    return
+                atendidos.append(id_usuario)
+
+        await asyncio.gather(*(atendiente() for _ in range(workers)))
+
+        return atendidos
+
+    # Funciones extra
+
+    async def get_user_info(self, nombre_usuario):
+        user_info = await self.db.hgetall(user_key(nombre_usuario))
+        if not user_info:
+            raise ValueError("El usuario no existe")
+        return decode_user(user_info)
+
+    async def get_all_users(self):
+        async for nombre, user_info in self.iter_users():
+            print(nombre, user_info)
+
+    async def iter_users(self, batch=100):
+        lote = []
+        for particion in range(self.keys.user_partitions):
+            async for nombre in self.db.sscan_iter(self.keys.users_key(particion), count=batch):
+                lote.append(nombre.decode("utf-8"))
+                if len(lote) == batch:
+                    for usuario in await self._fetch_users(lote):
+                        yield usuario
+                    lote = []
+
+        if lote:
+            for usuario in await self._fetch_users(lote):
+                yield usuario
+
+    async def _fetch_users(self, nombres):
+        pipe = self.db.pipeline(transaction=False)
+        for nombre in nombres:
+            pipe.hgetall(user_key(nombre))
+
+        return [(nombre, decode_user(user_info)) for nombre, user_info in zip(nombres, await pipe.execute()) if user_info]
+
+    async def _lex_page(self, claves, inicio, fin, offset, count):
+        if len(claves) == 1:
+            return await self.db.zrange(claves[0], inicio, fin, bylex=True, offset=offset, num=count)
+
+        pipe = self.db.pipeline(transaction=False)
+        for clave in claves:
+            pipe.zrange(clave, inicio, fin, bylex=True, offset=0, num=offset + count)
+        return merge_page(await pipe.execute(), offset, count)
+
+    async def users_by_privileges(self, privilegios, offset=0, count=50):
+        claves = [self.keys.users_by_privileges_key(privilegios, particion) for particion in range(self.keys.user_partitions)]
+        nombres = await self._lex_page(claves, "-", "+", offset, count)
+        return await self._fetch_users([nombre.decode("utf-8") for nombre in nombres])
+
+    async def count_users_by_privileges(self, privilegios):
+        pipe = self.db.pipeline(transaction=False)
+        for particion in range(self.keys.user_partitions):
+            pipe.zcard(self.keys.users_by_privileges_key(privilegios, particion))
+        return sum(await pipe.execute())
+
+    async def search_users(self, prefijo, offset=0, count=50):
+        inicio, fin = prefix_range(prefijo)
+        claves = [self.keys.users_by_name_key(particion) for particion in range(self.keys.user_partitions)]
+        entradas = await self._lex_page(claves, inicio, fin, offset, count)
+        return await self._fetch_users([name_entry_user(entrada) for entrada in entradas])
+
+    async def rebuild_user_indexes(self, batch=100):
+        pipe = self.db.pipeline(transaction=False)
+        pipe.unlink(USERS_KEY)
+        async for clave in self.db.scan_iter(match=USERS_KEY + ":*", count=batch):
+            pipe.unlink(clave)
+        await pipe.execute()
+
+        lote = []
+        async for clave in self.db.scan_iter(match=user_key("*"), count=batch):
+            lote.append(clave.decode("utf-8")[len(user_key("")):])
+            if len(lote) == batch:
+                await self._index_users(pipe, lote)
+                lote = []
+        await self._index_users(pipe, lote)
+
+    async def _index_users(self, pipe, nombres):
+        for nombre, user_info in await self._fetch_users(nombres):
+            self.keys.add_user_to_indexes(pipe, nombre, user_info.get("nombre_completo", ""), user_info["privilegios"])
+        await pipe.execute()
+
+    async def logout(self, token):
+        nombre_usuario = await self.db.hget(session_key(token), "nombre_usuario")
+
+        pipe = self.db.pipeline()
+        pipe.delete(session_key(token))
+        if nombre_usuario is not None:
+            pipe.srem(user_sessions_key(nombre_usuario.decode("utf-8")), token)
+        await pipe.execute()
+        count_event("logout")
+
+    async def delete_user(self, nombre_usuario):
+        pipe = self.db.pipeline()
+        pipe.hmget(user_key(nombre_usuario), "nombre_completo", "privilegios")
+        pipe.delete(user_key(nombre_usuario))
+        (nombre_completo, privilegios), eliminado = await pipe.execute()
+
+        if(eliminado):
+            pipe = self.db.pipeline()
+            self.keys.remove_user_from_indexes(pipe, nombre_usuario,
+                                     nombre_completo.decode("utf-8") if nombre_completo is not None else None,
+                                     privilegios.decode("utf-8") if privilegios is not None else None)
+            await pipe.execute()
+            await self._invalidate_sessions(nombre_usuario)
+            count_event("user_deleted")
+        else:
+            raise ValueError("El usuario no existe")
@@ -0,0 +1,586 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Iterable, Iterator
+
+import pymongo
+import pymongo.monitoring
+import redis
+from pymongo.errors import PyMongoError
+from geojson import Point
+
+import connections
+import main
+from geocoding import StubBackend
+from redis_manager import RedisManager
+
+# Viajes de ida y vuelta a cada servidor desde el arranque del benchmark
+_viajes = {"redis": 0, "mongo": 0}
+_viajes_lock = threading.Lock()
+
+# Datos para generar personas con la forma de data.json
+_NOMBRES = ["Saul", "Mirian", "Gonzalo", "Carla", "Lucia", "Hugo", "Marta", "Pablo", "Elena", "Javier",
+            "Sara", "Diego", "Paula", "Adrian", "Irene", "Mario", "Laura", "Alvaro", "Nerea", "Raul"]
+_APELLIDOS = ["Espejo", "Santana", "Lara", "Pastor", "Garcia", "Lopez", "Martin", "Sanchez", "Romero", "Navarro",
+              "Torres", "Dominguez", "Vazquez", "Ramos", "Gil", "Serrano", "Blanco", "Molina", "Ortega", "Delgado"]
+_CIUDADES = {"Madrid": (-3.7038, 40.4168), "Barcelona": (2.1734, 41.3851), "Valencia": (-0.3763, 39.4699),
+             "Sevilla": (-5.9845, 37.3891), "Bilbao": (-2.9350, 43.2630), "Girona": (2.8214, 41.9794),
+             "Ourense": (-7.8641, 42.3358), "Zaragoza": (-0.8891, 41.6488), "Malaga": (-4.4214, 36.7213)}
+_CALLES = ["Calle Mayor", "Passeig Catalunya", "Calleja Real", "Cuesta Iglesia", "Estrada Mayor", "Avenida America"]
+_UNIVERSIDADES = ["UPM", "U-Tad", "UAM", "UCM", "UPC", "UV", "US"]
+_DESCRIPCIONES = ["Big Data", "Artes", "Física cuantica", "Videojuegos", "Medicina", "Derecho", "Arquitectura"]
+_EMPRESAS = ["Nvidia", "MSI", "Zara", "Intel", "Google", "McDonalds", "Telefonica", "Indra", "Mercadona"]
+_CARRERAS = ["MAIS", "Videojuegos", "DIDI", "Animacion", "FIIS", "INSO", "Medicina", "Derecho"]
+_LETRAS_DNI = "TRWAGMYFPDXBNJZSQVHLCKE"
+
+
+def _medir(funcion: Callable[[], object], repeticiones: int) -> dict:
+    """
+    Ejecuta funcion repeticiones veces y devuelve la media y la
+    mediana de los tiempos en milisegundos.
+    """
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return {"mean_ms": statistics.mean(tiempos), "p50_ms": statistics.median(tiempos)}
+
+
+def _contar(servidor: str) -> None:
+    with _viajes_lock:
+        _viajes[servidor] += 1
+
+
+class _ContadorMongo(pymongo.monitoring.CommandListener):
+    """ Cuenta los comandos enviados a mongo (cada getMore es otro viaje) """
+
+    def started(self, event) -> None:
+        _contar("mongo")
+
+    def succeeded(self, event) -> None:
+        pass
+
+    def failed(self, event) -> None:
+        pass
+
+
+def _conexion_contada(base: type) -> type:
+    """ Conexion de redis que cuenta los envios al servidor, un pipeline es un unico envio """
+    class ConexionContada(base):
+        def send_packed_command(self, command, check_health=True):
+            _contar("redis")
+            super().send_packed_command(command, check_health)
+    return ConexionContada
+
+
+def _puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _esperar(comprobar: Callable[[], object], segundos: float = 30) -> None:
+    limite = time.monotonic() + segundos
+    while True:
+        try:
+            comprobar()
+            return
+        except (redis.ConnectionError, PyMongoError):
+            if time.monotonic() > limite:
+                raise
+            time.sleep(0.2)
+
+
+@contextlib.contextmanager
+def _servidores_locales() -> Iterator[tuple[int, str]]:
+    """
+    Arranca un redis-server y un mongod temporales, sin persistencia y en
+    puertos libres, y los detiene al salir. Devuelve el puerto de redis y
+    la uri de mongo.
+    """
+    for programa in ("redis-server", "mongod"):
+        if shutil.which(programa) is None:
+            raise ValueError(f"No se encuentra {programa} en el PATH")
+
+    puerto_redis, puerto_mongo = _puerto_libre(), _puerto_libre()
+    with tempfile.TemporaryDirectory(prefix="odm-bench-") as directorio:
+        os.mkdir(os.path.join(directorio, "mongo"))
+        procesos = [
+            subprocess.Popen(["redis-server", "--port", str(puerto_redis), "--bind", "127.0.0.1",
+                              "--save", "", "--appendonly", "no", "--dir", directorio],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+            subprocess.Popen(["mongod", "--port", str(puerto_mongo), "--bind_ip", "127.0.0.1",
+                              "--dbpath", os.path.join(directorio, "mongo")],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+        ]
+        uri = f"mongodb://127.0.0.1:{puerto_mongo}/"
+        try:
+            _esperar(lambda: redis.Redis(port=puerto_redis).ping())
+            _esperar(lambda: pymongo.MongoClient(uri, serverSelectionTimeoutMS=500).admin.command("ping"))
+            yield puerto_redis, uri
+        finally:
+            for proceso in procesos:
+                proceso.terminate()
+            for proceso in procesos:
+                try:
+                    proceso.wait(10)
+                except subprocess.TimeoutExpired:
+                    proceso.kill()
+
+
+def _cluster_formado(puerto: int) -> None:
+    if redis.Redis(port=puerto).cluster("info").get("cluster_state") != "ok":
+        raise redis.ConnectionError("El cluster aun no tiene todos sus slots asignados")
+
+
+@contextlib.contextmanager
+def _cluster_local(nodos: int = 3) -> Iterator[list[int]]:
+    """
+    Arranca un redis cluster temporal de nodos maestros sin replicas ni
+    persistencia en puertos libres de localhost, y lo detiene al salir.
+    Devuelve los puertos de los nodos.
+    """
+    for programa in ("redis-server", "redis-cli"):
+        if shutil.which(programa) is None:
+            raise ValueError(f"No se encuentra {programa} en el PATH")
+    if nodos < 3:
+        raise ValueError("Un redis cluster necesita al menos 3 nodos maestros")
+
+    puertos = [_puerto_libre() for _ in range(nodos)]
+    with tempfile.TemporaryDirectory(prefix="odm-cluster-") as directorio:
+        procesos = [subprocess.Popen(["redis-server", "--port", str(puerto), "--bind", "127.0.0.1",
+                                      "--cluster-enabled", "yes", "--cluster-config-file", f"nodes-{puerto}.conf",
+                                      "--save", "", "--appendonly", "no", "--dir", directorio],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    for puerto in puertos]
+        try:
+            for puerto in puertos:
+                _esperar(lambda: redis.Redis(port=puerto).ping())
+            subprocess.run(["redis-cli", "--cluster", "create", *[f"127.0.0.1:{puerto}" for puerto in puertos],
+                            "--cluster-replicas", "0", "--cluster-yes"],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for puerto in puertos:
+                _esperar(lambda: _cluster_formado(puerto))
+            yield puertos
+        finally:
+            for proceso in procesos:
+                proceso.terminate()
+            for proceso in procesos:
+                try:
+                    proceso.wait(10)
+                except subprocess.TimeoutExpired:
+                    proceso.kill()
+
+
+@contextlib.contextmanager
+def _backend(nombre: str) -> Iterator[str]:
+    """
+    Prepara las conexiones compartidas (ver connections.use_clients) con
+    contadores de viajes y devuelve la uri de mongo:
+        existing: mongo y redis ya arrancados en localhost
+        local: mongod y redis-server temporales
+        fake: mongomock y fakeredis en el proceso, sin servidores (CI).
+              Necesita pip install mongomock fakeredis[lua]
+    """
+    with contextlib.ExitStack() as pila:
+        if nombre == "fake":
+            import fakeredis
+            import mongomock
+            uri = "mongodb://fake/"
+            pool = redis.ConnectionPool(connection_class=_conexion_contada(fakeredis.FakeRedisConnection),
+                                        server=fakeredis.FakeServer())
+            mongo = mongomock.MongoClient()
+        else:
+            if nombre == "local":
+                puerto_redis, uri = pila.enter_context(_servidores_locales())
+            elif nombre == "existing":
+                puerto_redis, uri = 6379, "mongodb://localhost:27017/"
+            else:
+                raise ValueError(f"Backend desconocido: {nombre}")
+            pool = redis.BlockingConnectionPool(connection_class=_conexion_contada(redis.Connection),
+                                                port=puerto_redis, max_connections=64)
+            mongo = pymongo.MongoClient(uri, event_listeners=[_ContadorMongo()])
+
+        connections.use_clients(pool, mongo, uri)
+        pila.callback(connections.close_all)
+        yield uri
+
+
+def generate_personas(n: int, seed: int = 0, start: int = 0) -> Iterator[dict]:
+    """
+    Genera n personas sinteticas con la forma de data.json. La direccion
+    es un punto cercano a la ciudad, asi no se geocodifica, y los dni son
+    unicos (start numera el primero para generar varios lotes).
+    """
+    aleatorio = random.Random(seed)
+    ciudades = list(_CIUDADES)
+    for i in range(start, start + n):
+        ciudad = aleatorio.choice(ciudades)
+        lng, lat = _CIUDADES[ciudad]
+        persona = {
+            "nombre": aleatorio.choice(_NOMBRES),
+            "apellido": aleatorio.choice(_APELLIDOS),
+            "edad": aleatorio.randint(18, 70),
+            "dni": f"{i:08d}{_LETRAS_DNI[i % 23]}",
+            "telefono": aleatorio.randint(600000000, 799999999),
+            "direccion": Point((round(lng + aleatorio.uniform(-0.05, 0.05), 6),
+                                round(lat + aleatorio.uniform(-0.05, 0.05), 6))),
+            "ciudad": ciudad,
+            "descripcion": aleatorio.choice(_DESCRIPCIONES),
+            "trabajos": aleatorio.sample(_EMPRESAS, aleatorio.randint(0, 3)),
+            "estudios": [{"carrera": carrera, "fin": aleatorio.randint(2000, 2024)}
+                         for carrera in aleatorio.sample(_CARRERAS, aleatorio.randint(0, 2))],
+        }
+        if aleatorio.random() < 0.8:
+            persona["universidad"] = aleatorio.choice(_UNIVERSIDADES)
+        yield persona
+
+
+def _resultado(nombre: str, tiempos: list[float], segundos: float, viajes: dict[str, int], operaciones: int,
+               latencia: str = "op") -> dict:
+    """
+    Entrada del informe de una operacion. latencia indica de que son los
+    tiempos de p50_ms y p99_ms: de cada operacion (op) o de cada lote (batch).
+    """
+    percentiles = statistics.quantiles(tiempos, n=100, method="inclusive") if len(tiempos) > 1 else tiempos * 99
+    return {
+        "name": nombre,
+        "ops": operaciones,
+        "seconds": segundos,
+        "ops_per_s": operaciones / segundos if segundos > 0 else None,
+        "p50_ms": percentiles[49] * 1000 if tiempos else None,
+        "p99_ms": percentiles[98] * 1000 if tiempos else None,
+        "latency": latencia,
+        "redis_round_trips_per_op": viajes["redis"] / operaciones if operaciones else None,
+        "mongo_round_trips_per_op": viajes["mongo"] / operaciones if operaciones else None,
+    }
+
+
+@contextlib.contextmanager
+def _viajes_de(viajes: dict[str, int]) -> Iterator[None]:
+    """ Guarda en viajes los viajes a cada servidor dentro del bloque """
+    with _viajes_lock:
+        inicio = dict(_viajes)
+    yield
+    with _viajes_lock:
+        viajes.update({servidor: _viajes[servidor] - inicio[servidor] for servidor in _viajes})
+
+
+def _medir_operaciones(nombre: str, operacion: Callable[[object], object], argumentos: Iterable) -> dict:
+    """
+    Ejecuta operacion con cada argumento y devuelve las operaciones por
+    segundo, las latencias p50 y p99 y los viajes por operacion a redis
+    y a mongo.
+    """
+    argumentos = list(argumentos)
+    tiempos, viajes = [], {}
+    with _viajes_de(viajes):
+        inicio = time.perf_counter()
+        for argumento in argumentos:
+            t = time.perf_counter()
+            operacion(argumento)
+            tiempos.append(time.perf_counter() - t)
+        segundos = time.perf_counter() - inicio
+    return _resultado(nombre, tiempos, segundos, viajes, len(argumentos))
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(backend: str, uri: str, size: int, operaciones: int, seed: int = 0) -> dict:
+    """
+    Mide las operaciones principales del ODM y de RedisManager sobre un
+    conjunto de size personas sinteticas, con operaciones repeticiones
+    de cada una.
+
+    Returns
+    -------
+        dict
+            informe con el backend, los parametros, el commit y una
+            entrada por operacion (ver _resultado)
+    """
+    resultados = []
+    # El ODM y RedisManager escriben mensajes en cada operacion
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.initApp(mongodb_uri=uri, db_name="odm_bench", geocoding_backend=StubBackend(),
+                     manage_indexes=backend != "fake")
+        persona = main.Persona
+        persona.db.delete_many({})
+        persona.cache_clear()
+        manager = RedisManager()
+
+        try:
+            # Carga inicial con save_many
+            viajes = {}
+            with _viajes_de(viajes):
+                carga = persona.save_many(generate_personas(size, seed), batch_size=1000)
+            segundos = sum(lote["seconds"] for lote in carga.batches)
+            # save_many solo mide cada lote, las latencias son por lote
+            tiempos = [lote["seconds"] for lote in carga.batches]
+            resultados.append(_resultado("save_many", tiempos, segundos, viajes, carga.written, latencia="batch"))
+
+            ids = [str(documento["_id"]) for documento in persona.db.find({}, {"_id": 1})]
+            ids = random.Random(seed).sample(ids, min(operaciones, len(ids)))
+
+            persona.cache_clear()
+            resultados.append(_medir_operaciones("find_by_id_miss", persona.find_by_id, ids))
+            resultados.append(_medir_operaciones("find_by_id_hit", persona.find_by_id, ids))
+            resultados.append(_medir_operaciones("find_by_ids_100", persona.find_by_ids,
+                                                 [ids[i:i + 100] for i in range(0, len(ids), 100)]))
+
+            def actualizar(modelo):
+                modelo.edad += 1
+                modelo.save()
+
+            resultados.append(_medir_operaciones("save_update", actualizar, [persona.find_by_id(id) for id in ids]))
+            nuevas = [persona(**datos) for datos in generate_personas(operaciones, seed + 1, start=size)]
+            resultados.append(_medir_operaciones("save_insert", lambda modelo: modelo.save(), nuevas))
+
+            ciudades = list(_CIUDADES)
+            consultas = [ciudades[i % len(ciudades)] for i in range(max(1, operaciones // 100))]
+            resultados.append(_medir_operaciones("find_cursor_1000",
+                                                 lambda ciudad: list(persona.find({"ciudad": ciudad}, limit=1000)),
+                                                 consultas))
+
+            if not manager.user_exists("bench"):
+                manager.register("bench", "Usuario de benchmark", "bench", 0)
+            _, token = manager.login_and_generate_token("bench", "bench")
+            resultados.append(_medir_operaciones("login_with_token", lambda _: manager.login_with_token(token),
+                                                 range(operaciones)))
+            resultados.append(_medir_operaciones("create_ticket",
+                                                 lambda i: manager.create_ticket("bench", f"Ticket {i}", "benchmark", i % 5),
+                                                 range(operaciones)))
+            resultados.append(_medir_operaciones("attend_ticket", lambda _: manager.attend_ticket(timeout=1),
+                                                 range(operaciones)))
+        finally:
+            manager.delete_user("bench")
+            persona.cache_clear()
+            persona.db.database.client.drop_database("odm_bench")
+
+    if backend == "fake":    # mongomock no admite monitorizacion de comandos
+        for resultado in resultados:
+            resultado["mongo_round_trips_per_op"] = None
+
+    return {
+        "backend": backend,
+        "size": size,
+        "operations": operaciones,
+        "seed": seed,
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "results": resultados,
+    }
+
+
+def _mostrar(nombre: str, resultado: dict) -> None:
+    print(f"{nombre:<32} media {resultado['mean_ms']:9.3f} ms   p50 {resultado['p50_ms']:9.3f} ms")
+
+
+def bench_find_by_ids(n: int, repeticiones: int) -> None:
+    """
+    Compara find_by_ids con un bucle de find_by_id para n ids, con la
+    cache caliente (todo aciertos) y fria (todo fallos).
+    """
+    modelo = main.MiModelo
+    resultado = modelo.save_many({"nombre": f"bench{i}", "apellido": "bench", "edad": i} for i in range(n))
+    ids = [str(documento["_id"]) for documento in modelo.db.find({"apellido": "bench"}, {"_id": 1})]
+    ids = ids[:resultado.written]
+
+    def vaciar_cache():
+        modelo.r.delete(*[modelo.cache_key(id) for id in ids])
+
+    try:
+        _mostrar("find_by_id (bucle, caliente)", _medir(lambda: [modelo.find_by_id(id) for id in ids], repeticiones))
+        _mostrar("find_by_ids (caliente)", _medir(lambda: modelo.find_by_ids(ids), repeticiones))
+
+        def bucle_frio():
+            vaciar_cache()
+            return [modelo.find_by_id(id) for id in ids]
+
+        def lote_frio():
+            vaciar_cache()
+            return modelo.find_by_ids(ids)
+
+        _mostrar("find_by_id (bucle, fria)", _medir(bucle_frio, repeticiones))
+        _mostrar("find_by_ids (fria)", _medir(lote_frio, repeticiones))
+    finally:
+        vaciar_cache()
+        modelo.db.delete_many({"apellido": "bench"})
+
+
+def bench_attend_ticket(n: int, workers: list[int]) -> None:
+    """
+    Mide los tickets atendidos por segundo con distinto numero de
+    atendientes concurrentes sobre una cola de n tickets.
+    """
+    manager = RedisManager()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        if not manager.user_exists("bench"):
+            manager.register("bench", "Usuario de benchmark", "bench", 0)
+
+    try:
+        for numero in workers:
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(n):
+                    manager.create_ticket("bench", f"Ticket {i}", "benchmark", i % 5)
+
+                inicio = time.perf_counter()
+                atendidos = manager.serve_tickets(workers=numero, timeout=1)
+                # Cada atendiente espera timeout segundos con la cola vacia antes de terminar
+                segundos = time.perf_counter() - inicio - 1
+
+            print(f"{numero:>3} atendientes: {len(atendidos)} tickets, {len(atendidos) / segundos:10.1f} tickets/s")
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager.delete_user("bench")
+
+
+def bench_login_with_token(n: int, hilos: int) -> None:
+    """
+    Mide las validaciones de token por segundo con varios hilos.
+    """
+    manager = RedisManager()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        if not manager.user_exists("bench"):
+            manager.register("bench", "Usuario de benchmark", "bench", 0)
+        _, token = manager.login_and_generate_token("bench", "bench")
+
+    def validar():
+        for _ in range(n):
+            manager.login_with_token(token)
+
+    try:
+        trabajadores = [threading.Thread(target=validar) for _ in range(hilos)]
+        inicio = time.perf_counter()
+        for trabajador in trabajadores:
+            trabajador.start()
+        for trabajador in trabajadores:
+            trabajador.join()
+        segundos = time.perf_counter() - inicio
+
+        print(f"{hilos:>3} hilos: {n * hilos} validaciones, {n * hilos / segundos:10.1f} validaciones/s")
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            manager.delete_user("bench")
+
+
+def bench_cluster_tickets(n: int, shards: list[int], workers: int, nodos: int) -> None:
+    """
+    Crea y atiende n tickets de varios usuarios en un redis cluster
+    temporal de nodos nodos, con la cola repartida en distinto numero de
+    shards y los indices de usuarios en tantas particiones como nodos.
+    Comprueba que cada ticket se atiende una sola vez.
+    """
+    usuarios = [f"bench{i}" for i in range(10)]
+
+    with _cluster_local(nodos) as puertos:
+        connections.configure(redis_cluster_nodes=[f"127.0.0.1:{puerto}" for puerto in puertos])
+        try:
+            for numero in shards:
+                manager = RedisManager(connections.get_redis_cluster(), ticket_shards=numero, user_partitions=nodos)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for usuario in usuarios:
+                        if not manager.user_exists(usuario):
+                            manager.register(usuario, "Usuario de benchmark", "bench", 0)
+
+                    inicio = time.perf_counter()
+                    creados = {manager.create_ticket(usuarios[i % len(usuarios)], f"Ticket {i}", "benchmark", i % 5)
+                               for i in range(n)}
+                    creacion = time.perf_counter() - inicio
+
+                    inicio = time.perf_counter()
+                    atendidos = manager.serve_tickets(workers=workers, timeout=1)
+                    # Cada atendiente espera timeout segundos con la cola vacia antes de terminar
+                    atencion = time.perf_counter() - inicio - 1
+
+                print(f"{numero:>3} shards: {n / creacion:10.1f} tickets creados/s, "
+                      f"{len(atendidos) / atencion:10.1f} tickets atendidos/s")
+                if len(creados) != n or len(atendidos) != n or manager.ticket_counts()["pendientes"]:
+                    raise ValueError(f"Se han atendido {len(atendidos)} de {n} tickets con {numero} shards")
+        finally:
+            connections.close_all()
+
+
+# python benchmark.py [--backend existing|local|fake] suite --size 100000 --output bench.json
+# Los informes JSON de suite se pueden comparar entre commits
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks del ODM contra mongo y redis locales")
+    parser.add_argument("--backend", choices=["existing", "local", "fake"], default="existing",
+                        help="servidores ya arrancados, temporales o dobles en memoria")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    suite = subparsers.add_parser("suite", help="todas las operaciones con un informe JSON")
+    suite.add_argument("--size", type=int, default=1000, help="personas sinteticas cargadas (10^3 a 10^6)")
+    suite.add_argument("--ops", type=int, default=1000, help="repeticiones de cada operacion")
+    suite.add_argument("--seed", type=int, default=0, help="semilla de los datos generados")
+    suite.add_argument("--output", default="-", help="fichero del informe, - para la salida estandar")
+
+    find_by_ids = subparsers.add_parser("find_by_ids", help="find_by_ids frente a un bucle de find_by_id")
+    find_by_ids.add_argument("-n", type=int, default=100, help="numero de ids por consulta")
+    find_by_ids.add_argument("--repeat", type=int, default=20, help="repeticiones de cada medida")
+
+    attend_ticket = subparsers.add_parser("attend_ticket", help="tickets atendidos por segundo con N atendientes")
+    attend_ticket.add_argument("-n", type=int, default=10000, help="numero de tickets en la cola")
+    attend_ticket.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="numero de atendientes")
+
+    login_with_token = subparsers.add_parser("login_with_token", help="validaciones de token por segundo")
+    login_with_token.add_argument("-n", type=int, default=10000, help="validaciones por hilo")
+    login_with_token.add_argument("--threads", type=int, default=4, help="numero de hilos")
+
+    cluster_tickets = subparsers.add_parser("cluster_tickets", help="cola de tickets repartida en un redis cluster temporal")
+    cluster_tickets.add_argument("-n", type=int, default=10000, help="numero de tickets")
+    cluster_tickets.add_argument("--shards", type=int, nargs="+", default=[1, 3, 6], help="shards de la cola")
+    cluster_tickets.add_argument("--workers", type=int, default=8, help="numero de atendientes")
+    cluster_tickets.add_argument("--nodes", type=int, default=3, help="nodos maestros del cluster")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "cluster_tickets":
+        # Arranca su propio cluster, no usa --backend
+        bench_cluster_tickets(args.n, args.shards, args.workers, args.nodes)
+        sys.exit()
+
+    with _backend(args.backend) as uri:
+        if args.benchmark == "suite":
+            informe = bench_suite(args.backend, uri, args.size, args.ops, args.seed)
+            if args.output == "-":
+                json.dump(informe, sys.stdout, indent=2)
+                print()
+            else:
+                with open(args.output, "w") as f:
+                    json.dump(informe, f, indent=2)
+                for resultado in informe["results"]:
+                    print(f"{resultado['name']:<20} {resultado['ops_per_s'] or 0:12.1f} ops/s   "
+                          f"p50 {resultado['p50_ms'] or 0:8.3f} ms   p99 {resultado['p99_ms'] or 0:8.3f} ms"
+                          f"{'   (por lote)' if resultado['latency'] == 'batch' else ''}")
+        elif args.benchmark == "find_by_ids":
+            main.initApp(mongodb_uri=uri)
+            bench_find_by_ids(args.n, args.repeat)
+        elif args.benchmark == "attend_ticket":
+            bench_attend_ticket(args.n, args.workers)
+        elif args.benchmark == "login_with_token":
+            bench_login_with_token(args.n, args.threads)
@@ -0,0 +1,161 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import datetime
+import zlib
+from collections.abc import Mapping
+from typing import Any
+
+import bson
+from bson import ObjectId
+
+
+class CacheCodec:
+    """
+    Codificador de documentos para la cache de redis.
+    Las subclases convierten un documento (dict) en bytes y viceversa.
+
+    Methods
+    -------
+        encode(document: dict) -> bytes
+            Serializa el documento.
+        decode(data: bytes) -> dict
+            Reconstruye el documento serializado.
+    """
+
+    def encode(self, document: dict) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> dict:
+        raise NotImplementedError
+
+
+class BsonCodec(CacheCodec):
+    """
+    Codificador BSON, el mismo formato que utiliza MongoDB.
+    Conserva los tipos de los documentos (ObjectId, fechas...) sin
+    dependencias adicionales.
+    """
+
+    def encode(self, document: dict) -> bytes:
+        return bson.encode(document)
+
+    def decode(self, data: bytes) -> dict:
+        return bson.decode(data)
+
+
+class MsgpackCodec(CacheCodec):
+    """
+    Codificador msgpack, algo mas compacto y rapido que BSON.
+    Los ObjectId y las fechas se guardan como tipos extendidos.
+    Requiere el paquete msgpack.
+    """
+
+    _EXT_OBJECTID = 1
+    _EXT_DATETIME = 2
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def _default(self, value: Any) -> Any:
+        if isinstance(value, ObjectId):
+            return self._msgpack.ExtType(self._EXT_OBJECTID, value.binary)
+        if isinstance(value, datetime.datetime):
+            return self._msgpack.ExtType(self._EXT_DATETIME, value.isoformat().encode())
+        if isinstance(value, Mapping):     # RawBSONDocument de los cursores lazy
+            return dict(value)
+        raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+    def _ext_hook(self, code: int, data: bytes) -> Any:
+        if code == self._EXT_OBJECTID:
+            return ObjectId(data)
+        if code == self._EXT_DATETIME:
+            return datetime.datetime.fromisoformat(data.decode())
+        return self._msgpack.ExtType(code, data)
+
+    def encode(self, document: dict) -> bytes:
+        return self._msgpack.packb(document, default=self._default, use_bin_type=True)
+
+    def decode(self, data: bytes) -> dict:
+        return self._msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False)
+
+
+class CompressedCodec(CacheCodec):
+    """
+    Envuelve otro codificador y comprime los documentos que superan
+    un tamaño minimo. El primer byte indica si el contenido esta
+    comprimido y con que algoritmo, por lo que los documentos
+    pequeños no pagan el coste de la compresion.
+
+    Attributes
+    ----------
+        codec : CacheCodec
+            codificador de los documentos
+        algorithm : str
+            "zlib" o "lz4" (requiere el paquete lz4)
+        threshold : int
+            tamaño en bytes a partir del cual se comprime
+    """
+
+    _SIN_COMPRIMIR = b"\x00"
+    _ZLIB = b"\x01"
+    _LZ4 = b"\x02"
+
+    def __init__(self, codec: CacheCodec, algorithm: str = "zlib", threshold: int = 1024, level: int = 6):
+        if algorithm == "zlib":
+            self._cabecera = self._ZLIB
+            self._comprimir = lambda data: zlib.compress(data, level)
+        elif algorithm == "lz4":
+            import lz4.frame
+            self._cabecera = self._LZ4
+            self._comprimir = lz4.frame.compress
+        else:
+            raise ValueError(f"Algoritmo de compresión no soportado: {algorithm}")
+
+        self.codec = codec
+        self.algorithm = algorithm
+        self.threshold = threshold
+
+    def encode(self, document: dict) -> bytes:
+        data = self.codec.encode(document)
+        if len(data) < self.threshold:
+            return self._SIN_COMPRIMIR + data
+        return self._cabecera + self._comprimir(data)
+
+    def decode(self, data: bytes) -> dict:
+        cabecera, contenido = data[:1], data[1:]
+        if cabecera == self._ZLIB:
+            contenido = zlib.decompress(contenido)
+        elif cabecera == self._LZ4:
+            import lz4.frame
+            contenido = lz4.frame.decompress(contenido)
+        elif cabecera != self._SIN_COMPRIMIR:
+            raise ValueError("Cabecera de compresión desconocida")
+        return self.codec.decode(contenido)
+
+
+def get_codec(name: str = "bson", compression: str | None = None, threshold: int = 1024) -> CacheCodec:
+    """
+    Construye un codificador a partir de su nombre.
+
+    Parameters
+    ----------
+        name : str
+            "bson" o "msgpack"
+        compression : str | None
+            None, "zlib" o "lz4"
+        threshold : int
+            tamaño en bytes a partir del cual se comprime
+    Returns
+    -------
+        CacheCodec
+            codificador configurado
+    """
+    codecs = {"bson": BsonCodec, "msgpack": MsgpackCodec}
+    if name not in codecs:
+        raise ValueError(f"Codificador no soportado: {name}")
+
+    codec = codecs[name]()
+    if compression is not None:
+        codec = CompressedCodec(codec, algorithm=compression, threshold=threshold)
+    return codec
@@ -0,0 +1,247 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import sys
+import threading
+import time
+from typing import Iterable
+
+import bson
+import redis
+from pymongo.errors import OperationFailure, PyMongoError
+
+import connections
+from ODM import Model, _unlink_matching
+from query_cache import QueryCache
+
+# Operaciones de los change streams que modifican documentos cacheados
+_OPERACIONES_DOCUMENTO = ("insert", "update", "replace", "delete")
+# Operaciones que afectan a una coleccion completa
+_OPERACIONES_COLECCION = ("drop", "rename", "dropDatabase", "invalidate")
+# Codigo de error de MongoDB cuando el resume token ya no esta en el oplog
+_HISTORIAL_PERDIDO = 286
+
+
+class CacheCoherenceWorker:
+    """
+    Mantiene la cache de redis coherente con las escrituras que no pasan
+    por el ODM siguiendo los change streams de MongoDB (requiere un
+    replica set, basta uno de un solo nodo).
+    Los eventos se agrupan en lotes y cada lote se aplica con un unico
+    pipeline MULTI/EXEC que tambien guarda el resume token, de modo que
+    al reiniciar se continua justo despues del ultimo lote aplicado.
+
+    Attributes
+    ----------
+        models : dict[str, type[Model]]
+            modelos por nombre de coleccion
+        database : pymongo.database.Database
+            base de datos de las colecciones de los modelos
+        r : redis.Redis
+            cliente de redis
+        refresh : bool
+            si se reescriben los documentos modificados en la cache en
+            lugar de eliminarlos (necesita leer el documento completo)
+        batch_size : int
+            numero maximo de eventos por lote
+        max_wait : float
+            segundos maximos que se espera a completar un lote
+        resume_key : str
+            clave de redis del resume token
+
+    Methods
+    -------
+        apply(eventos: list[dict]) -> int
+            Aplica un lote de eventos a la cache.
+        run() -> None
+            Sigue los cambios hasta que se llame a stop().
+        start() -> None
+            Ejecuta run() en un hilo.
+        stop() -> None
+            Detiene el seguimiento.
+    """
+
+    def __init__(self, models: Iterable[type[Model]], mongodb_uri: str | None = None,
+                 redis_client: redis.Redis | None = None, refresh: bool = False,
+                 batch_size: int = 100, max_wait: float = 0.5):
+        self.models = {modelo.db.name: modelo for modelo in models}
+        bases = {modelo.db.database.name for modelo in self.models.values()}
+        if len(bases) != 1:
+            raise ValueError("Los modelos deben estar en una unica base de datos")
+
+        # Los modelos pueden ser asincronos, el worker usa sus propios clientes sincronos
+        self.database = connections.get_mongo_client(mongodb_uri)[bases.pop()]
+        self.r = redis_client if redis_client is not None else connections.get_redis()
+        self.refresh = refresh
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.resume_key = f"odm:coherence:{self.database.name}:resume"
+
+        prefijos = {modelo.query_cache.prefix for modelo in self.models.values() if modelo.query_cache is not None}
+        self._consultas = {prefijo: QueryCache(self.r, prefix=prefijo) for prefijo in prefijos}
+        self._parar = threading.Event()
+        self._hilo: threading.Thread | None = None
+
+    def _resume_token(self) -> dict | None:
+        token = self.r.get(self.resume_key)
+        return bson.decode(token) if token else None
+
+    def _watch(self):
+        filtro = [{"$match": {"$or": [{"ns.coll": {"$in": list(self.models)}},
+                                      {"operationType": {"$in": ["dropDatabase", "invalidate"]}}]}}]
+        opciones = {"max_await_time_ms": 1000}
+        if self.refresh:
+            opciones["full_document"] = "updateLookup"
+        token = self._resume_token()
+
+        try:
+            return self.database.watch(filtro, resume_after=token, **opciones)
+        except OperationFailure as e:
+            if token is None or e.code != _HISTORIAL_PERDIDO:
+                raise
+            # Los cambios desde el token ya no estan en el oplog, se han
+            # podido perder invalidaciones y se vacia la cache de los modelos
+            print("Coherencia: resume token caducado, se vacia la caché de los modelos")
+            self._clear_models()
+            self.r.delete(self.resume_key)
+            return self.database.watch(filtro, **opciones)
+
+    def _clear_models(self) -> None:
+        for modelo in self.models.values():
+            self._invalidate_collection(modelo)
+
+    def _invalidate_collection(self, modelo: type[Model]) -> None:
+        # Se usan los clientes del worker: los modelos pueden ser asincronos
+        _unlink_matching(self.r, modelo.cache_key("*"))
+        self._invalidate_collection_queries(modelo)
+        if modelo.local_cache is not None:
+            modelo.local_cache.delete_prefix(modelo.cache_key(""))
+        if modelo.invalidator is not None:
+            modelo.invalidator.publish([modelo.cache_key("*")])
+
+    def apply(self, eventos: list[dict]) -> int:
+        """
+        Aplica un lote de eventos de change streams a la cache y guarda
+        el resume token del ultimo.
+
+        Parameters
+        ----------
+            eventos : list[dict]
+                eventos del change stream
+        Returns
+        -------
+            int
+                numero de documentos invalidados o actualizados
+        """
+        if not eventos:
+            return 0
+
+        pipe = self.r.pipeline(transaction=True)
+        modificadas: dict[str, list[str]] = {}
+        colecciones = set()
+        aplicados = 0
+
+        for evento in eventos:
+            modelo = self.models.get(evento.get("ns", {}).get("coll"))
+            operacion = evento["operationType"]
+
+            if operacion in _OPERACIONES_COLECCION:
+                for modelo in ([modelo] if modelo is not None else self.models.values()):
+                    self._invalidate_collection(modelo)
+                continue
+            if modelo is None or operacion not in _OPERACIONES_DOCUMENTO:
+                continue
+
+            key = modelo.cache_key(str(evento["documentKey"]["_id"]))
+            documento = evento.get("fullDocument")
+            if self.refresh and operacion != "delete" and documento is not None:
+                # Solo se reescriben los documentos que ya estan en la cache,
+                # asi no se supera su numero maximo de entradas
+                pipe.set(key, modelo.codec.encode(documento), ex=modelo._cache_ttl(), xx=True)
+            else:
+                pipe.delete(key)
+
+            modificadas.setdefault(modelo.db.name, []).append(key)
+            colecciones.add(modelo.db.name)
+            aplicados += 1
+
+        # Tras un invalidate el stream no se puede reanudar, se empieza de nuevo
+        if eventos[-1]["operationType"] == "invalidate":
+            pipe.delete(self.resume_key)
+        else:
+            pipe.set(self.resume_key, bson.encode(eventos[-1]["_id"]))
+        pipe.execute()
+
+        # Las copias en memoria y las consultas cacheadas se invalidan despues
+        for coleccion, claves in modificadas.items():
+            modelo = self.models[coleccion]
+            if modelo.local_cache is not None:
+                modelo.local_cache.delete(*claves)
+            if modelo.invalidator is not None:
+                modelo.invalidator.publish(claves)
+        for coleccion in colecciones:
+            self._invalidate_collection_queries(self.models[coleccion])
+
+        return aplicados
+
+    def _invalidate_collection_queries(self, modelo: type[Model]) -> None:
+        if modelo.query_cache is not None:
+            self._consultas[modelo.query_cache.prefix].invalidate(modelo.db.name)
+
+    def run(self) -> None:
+        """
+        Sigue los change streams y aplica los eventos en lotes de hasta
+        batch_size eventos o max_wait segundos desde el primero. Ante un
+        error de conexion se reintenta desde el ultimo resume token guardado.
+        """
+        while not self._parar.is_set():
+            try:
+                with self._watch() as stream:
+                    while not self._parar.is_set() and stream.alive:
+                        self.apply(self._next_batch(stream))
+            except (PyMongoError, redis.ConnectionError, redis.TimeoutError) as e:
+                print(f"Coherencia: error siguiendo los cambios, reintentando ({e})")
+                self._parar.wait(1)
+
+    def _next_batch(self, stream) -> list[dict]:
+        lote = []
+        limite = None
+        while len(lote) < self.batch_size:
+            evento = stream.try_next()    # Espera como mucho max_await_time_ms
+            if evento is not None:
+                lote.append(evento)
+                if limite is None:
+                    limite = time.monotonic() + self.max_wait
+            elif lote or self._parar.is_set() or not stream.alive:
+                break
+            if limite is not None and time.monotonic() >= limite:
+                break
+        return lote
+
+    def start(self) -> None:
+        if self._hilo is None or not self._hilo.is_alive():
+            self._parar.clear()
+            self._hilo = threading.Thread(target=self.run, name="cache-coherence", daemon=True)
+            self._hilo.start()
+
+    def stop(self) -> None:
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join()
+            self._hilo = None
+
+
+# python coherence.py [--refresh]
+# Ejecuta el worker para todos los modelos de models.yml
+if __name__ == "__main__":
+    import main
+
+    main.initApp(manage_indexes=False)
+    modelos = [valor for valor in vars(main).values()
+               if isinstance(valor, type) and issubclass(valor, Model) and "db" in valor.__dict__]
+
+    worker = CacheCoherenceWorker(modelos, refresh="--refresh" in sys.argv)
+    print(f"Siguiendo los cambios de {', '.join(worker.models)}")
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
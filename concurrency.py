@@ -0,0 +1,185 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class TokenBucket:
+    """
+    Limitador de peticiones por cubo de fichas (token bucket).
+    Se rellena a razon de rate fichas por segundo hasta un maximo de
+    capacity fichas. Cada peticion consume una ficha y, si no quedan,
+    espera solo el tiempo necesario hasta que se genere la siguiente.
+
+    Attributes
+    ----------
+        rate : float
+            fichas generadas por segundo
+        capacity : float
+            numero maximo de fichas acumulables (rafaga permitida)
+
+    Methods
+    -------
+        acquire(tokens: float = 1) -> None
+            Consume fichas del cubo, bloqueando hasta que esten disponibles.
+        try_acquire(tokens: float = 1) -> bool
+            Consume fichas del cubo si estan disponibles, sin bloquear.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("rate y capacity deben ser positivos")
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        ahora = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (ahora - self._last) * self.rate)
+        self._last = ahora
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """
+        Consume tokens fichas si estan disponibles.
+
+        Returns
+        -------
+            bool
+                True si se han consumido las fichas, False en caso contrario
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1) -> None:
+        """
+        Consume tokens fichas, esperando lo justo si no hay suficientes.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                espera = (tokens - self._tokens) / self.rate
+
+            time.sleep(espera)
+
+
+class SingleFlight:
+    """
+    Agrupa llamadas concurrentes con la misma clave para que solo una
+    de ellas ejecute la funcion y el resto reciba su mismo resultado
+    (o su misma excepcion).
+
+    Methods
+    -------
+        do(key: Hashable, fn: Callable[[], Any]) -> Any
+            Ejecuta fn una unica vez por clave entre las llamadas en vuelo.
+    """
+
+    class _Call:
+        __slots__ = ("event", "result", "error")
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, SingleFlight._Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Ejecuta fn si no hay otra llamada en vuelo con la misma clave.
+        En caso contrario espera a que termine y devuelve su resultado.
+
+        Parameters
+        ----------
+            key : Hashable
+                clave que identifica la operacion
+            fn : Callable[[], Any]
+                funcion a ejecutar
+        Returns
+        -------
+            Any
+                resultado de fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            lider = call is None
+            if lider:
+                call = self._calls[key] = SingleFlight._Call()
+
+        if not lider:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+
+# Resultado que reciben las corrutinas en espera cuando se cancela la
+# que ejecutaba la operacion: vuelven a intentarlo en lugar de cancelarse
+_REINTENTAR = object()
+
+
+class AsyncSingleFlight:
+    """
+    Version asyncio de SingleFlight: las corrutinas concurrentes con la
+    misma clave esperan al resultado de la primera en lugar de repetir
+    la operacion. Si se cancela la primera, las que esperaban no se
+    cancelan: la siguiente ejecuta la operacion y el resto espera a esta.
+
+    Methods
+    -------
+        do(key: Hashable, fn: Callable[[], Awaitable]) -> Any
+            Espera fn() una unica vez por clave entre las llamadas en vuelo.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]) -> Any:
+        futuro = self._calls.get(key)
+        while futuro is not None:
+            resultado = await asyncio.shield(futuro)
+            if resultado is not _REINTENTAR:
+                return resultado
+            futuro = self._calls.get(key)
+
+        futuro = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            resultado = await fn()
+        except asyncio.CancelledError:
+            futuro.set_result(_REINTENTAR)
+            raise
+        except BaseException as e:
+            futuro.set_exception(e)
+            futuro.exception()      # Evita el aviso si nadie mas la esperaba
+            raise
+        else:
+            futuro.set_result(resultado)
+            return resultado
+        finally:
+            del self._calls[key]
@@ -0,0 +1,286 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import threading
+
+import pymongo
+import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.cluster
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+import instrumentation
+
+# Configuracion de las conexiones compartidas por initApp, RedisManager
+# y el resto de modulos. Se puede modificar con configure() antes de
+# crear la primera conexion.
+_settings = {
+    "redis_host": "localhost",
+    "redis_port": 6379,
+    "redis_db": 0,
+    "redis_password": None,
+    "redis_max_connections": 64,          # conexiones maximas del pool por proceso
+    "redis_pool_timeout": 5,              # segundos esperando una conexion libre del pool
+    "redis_socket_timeout": 5,
+    "redis_socket_connect_timeout": 2,
+    "redis_health_check_interval": 30,    # PING antes de reutilizar una conexion inactiva
+    "redis_retries": 3,
+    "redis_cluster_nodes": None,          # ["host:puerto", ...] de arranque de get_redis_cluster
+    "mongodb_uri": "mongodb://localhost:27017/",
+    "mongo_max_pool_size": 100,
+    "mongo_min_pool_size": 0,
+    "mongo_connect_timeout_ms": 2000,
+    "mongo_socket_timeout_ms": 10000,
+    "mongo_server_selection_timeout_ms": 5000,
+}
+
+_lock = threading.Lock()
+_redis_pool: redis.ConnectionPool | None = None
+_async_redis_pool: redis.asyncio.ConnectionPool | None = None
+_redis_cluster: redis.cluster.RedisCluster | None = None
+_async_redis_cluster: redis.asyncio.cluster.RedisCluster | None = None
+_mongo_clients: dict[str, pymongo.MongoClient] = {}
+_async_mongo_clients: dict[str, pymongo.AsyncMongoClient] = {}
+
+
+def configure(**settings) -> None:
+    """
+    Modifica la configuracion de las conexiones. Las claves admitidas
+    son las de _settings. Las conexiones ya creadas se cierran para que
+    las siguientes utilicen la nueva configuracion.
+
+    Parameters
+    ----------
+        settings : dict
+            valores de configuracion a modificar
+    """
+    desconocidas = set(settings) - set(_settings)
+    if desconocidas:
+        raise ValueError(f"Opciones de conexión desconocidas: {', '.join(sorted(desconocidas))}")
+
+    close_all()
+    _settings.update(settings)
+
+
+def _redis_kwargs() -> dict:
+    # Reintentos con espera exponencial ante errores de conexion o timeouts
+    return {
+        "host": _settings["redis_host"],
+        "port": _settings["redis_port"],
+        "db": _settings["redis_db"],
+        "password": _settings["redis_password"],
+        "max_connections": _settings["redis_max_connections"],
+        "timeout": _settings["redis_pool_timeout"],
+        "socket_timeout": _settings["redis_socket_timeout"],
+        "socket_connect_timeout": _settings["redis_socket_connect_timeout"],
+        "health_check_interval": _settings["redis_health_check_interval"],
+        "retry_on_error": [redis.ConnectionError, redis.TimeoutError],
+    }
+
+
+def get_redis() -> redis.Redis:
+    """
+    Devuelve un cliente de redis sobre el pool compartido del proceso.
+    El pool es bloqueante: si se alcanzan las conexiones maximas se
+    espera a que quede una libre en lugar de abrir otra.
+
+    Returns
+    -------
+        redis.Redis
+            cliente de redis
+    """
+    global _redis_pool
+    with _lock:
+        if _redis_pool is None:
+            _redis_pool = redis.BlockingConnectionPool(
+                retry=Retry(ExponentialBackoff(cap=1, base=0.05), _settings["redis_retries"]),
+                **_redis_kwargs())
+    return redis.Redis(connection_pool=_redis_pool)
+
+
+def get_async_redis() -> redis.asyncio.Redis:
+    """
+    Version asyncio de get_redis, con su propio pool compartido.
+
+    Returns
+    -------
+        redis.asyncio.Redis
+            cliente asincrono de redis
+    """
+    global _async_redis_pool
+    with _lock:
+        if _async_redis_pool is None:
+            from redis.asyncio.retry import Retry as AsyncRetry
+            _async_redis_pool = redis.asyncio.BlockingConnectionPool(
+                retry=AsyncRetry(ExponentialBackoff(cap=1, base=0.05), _settings["redis_retries"]),
+                **_redis_kwargs())
+    return redis.asyncio.Redis(connection_pool=_async_redis_pool)
+
+
+def _cluster_nodes() -> list[tuple[str, int]]:
+    # Nodos de arranque, por defecto el host y puerto de redis configurados
+    nodos = _settings["redis_cluster_nodes"] or [f"{_settings['redis_host']}:{_settings['redis_port']}"]
+    return [(host, int(puerto)) for host, puerto in (nodo.rsplit(":", 1) for nodo in nodos)]
+
+
+def _redis_cluster_kwargs() -> dict:
+    # Un cluster solo tiene la base de datos 0 y un pool por nodo
+    return {
+        "password": _settings["redis_password"],
+        "max_connections": _settings["redis_max_connections"],
+        "socket_timeout": _settings["redis_socket_timeout"],
+        "socket_connect_timeout": _settings["redis_socket_connect_timeout"],
+    }
+
+
+def get_redis_cluster() -> redis.cluster.RedisCluster:
+    """
+    Devuelve el cliente compartido de redis cluster, que descubre los
+    nodos a partir de redis_cluster_nodes y envia cada comando al nodo
+    de su slot. Es seguro entre hilos y mantiene un pool por nodo.
+    Solo lo utiliza RedisManager: las claves de la cache del ODM y de la
+    cache de consultas no llevan hash tags.
+
+    Returns
+    -------
+        redis.cluster.RedisCluster
+            cliente de redis cluster
+    """
+    global _redis_cluster
+    with _lock:
+        if _redis_cluster is None:
+            _redis_cluster = redis.cluster.RedisCluster(
+                startup_nodes=[redis.cluster.ClusterNode(host, puerto) for host, puerto in _cluster_nodes()],
+                retry=Retry(ExponentialBackoff(cap=1, base=0.05), _settings["redis_retries"]),
+                **_redis_cluster_kwargs())
+    return _redis_cluster
+
+
+def get_async_redis_cluster() -> redis.asyncio.cluster.RedisCluster:
+    """
+    Version asyncio de get_redis_cluster.
+    """
+    global _async_redis_cluster
+    with _lock:
+        if _async_redis_cluster is None:
+            from redis.asyncio.retry import Retry as AsyncRetry
+            _async_redis_cluster = redis.asyncio.cluster.RedisCluster(
+                startup_nodes=[redis.asyncio.cluster.ClusterNode(host, puerto) for host, puerto in _cluster_nodes()],
+                retry=AsyncRetry(ExponentialBackoff(cap=1, base=0.05), _settings["redis_retries"]),
+                **_redis_cluster_kwargs())
+    return _async_redis_cluster
+
+
+def _mongo_kwargs() -> dict:
+    # Los comandos solo se monitorizan si la instrumentacion estaba activa al crear el cliente
+    opciones = {"event_listeners": [instrumentation.MONGO_LISTENER]} if instrumentation.metrics.enabled else {}
+    return opciones | {
+        "maxPoolSize": _settings["mongo_max_pool_size"],
+        "minPoolSize": _settings["mongo_min_pool_size"],
+        "connectTimeoutMS": _settings["mongo_connect_timeout_ms"],
+        "socketTimeoutMS": _settings["mongo_socket_timeout_ms"],
+        "serverSelectionTimeoutMS": _settings["mongo_server_selection_timeout_ms"],
+        "retryWrites": True,
+        "retryReads": True,
+    }
+
+
+def get_mongo_client(uri: str | None = None) -> pymongo.MongoClient:
+    """
+    Devuelve el MongoClient compartido para uri. MongoClient ya
+    gestiona su propio pool de conexiones y es seguro entre hilos,
+    por lo que se crea uno solo por uri y proceso.
+
+    Parameters
+    ----------
+        uri : str | None
+            uri de conexion, por defecto la configurada
+    Returns
+    -------
+        pymongo.MongoClient
+            cliente de mongo
+    """
+    uri = uri or _settings["mongodb_uri"]
+    with _lock:
+        if uri not in _mongo_clients:
+            _mongo_clients[uri] = pymongo.MongoClient(uri, **_mongo_kwargs())
+        return _mongo_clients[uri]
+
+
+def get_async_mongo_client(uri: str | None = None) -> pymongo.AsyncMongoClient:
+    """
+    Version asyncio de get_mongo_client.
+    """
+    uri = uri or _settings["mongodb_uri"]
+    with _lock:
+        if uri not in _async_mongo_clients:
+            _async_mongo_clients[uri] = pymongo.AsyncMongoClient(uri, **_mongo_kwargs())
+        return _async_mongo_clients[uri]
+
+
+def use_clients(redis_pool: redis.ConnectionPool | None = None, mongo_client: pymongo.MongoClient | None = None,
+                mongodb_uri: str | None = None) -> None:
+    """
+    Sustituye el pool de redis y el cliente de mongo compartidos por
+    unos creados fuera, por ejemplo instrumentados o dobles en memoria
+    (fakeredis, mongomock) en los benchmarks. Las conexiones anteriores
+    se cierran.
+
+    Parameters
+    ----------
+        redis_pool : redis.ConnectionPool | None
+            pool que usara get_redis, None para crearlo con la configuracion
+        mongo_client : pymongo.MongoClient | None
+            cliente que devolvera get_mongo_client para mongodb_uri
+        mongodb_uri : str | None
+            uri a la que se asocia mongo_client, por defecto la configurada
+    """
+    global _redis_pool
+    close_all()
+    with _lock:
+        _redis_pool = redis_pool
+        if mongo_client is not None:
+            _mongo_clients[mongodb_uri or _settings["mongodb_uri"]] = mongo_client
+
+
+def close_all() -> None:
+    """
+    Cierra los pools y el cluster de redis y los clientes de mongo
+    sincronos. Los recursos asincronos se descartan, deben cerrarse desde
+    el bucle de eventos con aclose_all().
+    """
+    global _redis_pool, _async_redis_pool, _redis_cluster, _async_redis_cluster
+    with _lock:
+        if _redis_pool is not None:
+            _redis_pool.disconnect()
+            _redis_pool = None
+        if _redis_cluster is not None:
+            _redis_cluster.close()
+            _redis_cluster = None
+        for client in _mongo_clients.values():
+            client.close()
+        _mongo_clients.clear()
+        _async_redis_pool = None
+        _async_redis_cluster = None
+        _async_mongo_clients.clear()
+
+
+async def aclose_all() -> None:
+    """
+    Cierra el pool y el cluster asincronos de redis y los clientes
+    asincronos de mongo.
+    """
+    global _async_redis_pool, _async_redis_cluster
+    with _lock:
+        pool, _async_redis_pool = _async_redis_pool, None
+        cluster, _async_redis_cluster = _async_redis_cluster, None
+        clientes = list(_async_mongo_clients.values())
+        _async_mongo_clients.clear()
+
+    if pool is not None:
+        await pool.disconnect()
+    if cluster is not None:
+        await cluster.aclose()
+    for client in clientes:
+        await client.close()
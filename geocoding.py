@@ -0,0 +1,322 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from typing import Iterable
+
+import redis
+
+from concurrency import SingleFlight, TokenBucket
+
+Coordenadas = tuple[float, float]   # (latitud, longitud)
+
+# Valor almacenado en la cache cuando la direccion no existe
+_NO_ENCONTRADA = b""
+
+# Direccion que no esta en la cache en memoria
+_NO_RECORDADA = object()
+
+
+def normalize_address(address: str) -> str:
+    """
+    Normaliza una direccion para utilizarla como clave de cache:
+    forma unicode NFKC, minusculas y espacios colapsados.
+
+    Parameters
+    ----------
+        address : str
+            direccion a normalizar
+    Returns
+    -------
+        str
+            direccion normalizada
+    """
+    address = unicodedata.normalize("NFKC", address).casefold()
+    return re.sub(r"\s+", " ", address).strip(" ,")
+
+
+class NominatimBackend:
+    """
+    Backend de geocodificacion que utiliza la API publica de Nominatim
+    a traves de geopy. Reutiliza un unico cliente y reintenta un numero
+    acotado de veces si la API no responde a tiempo.
+
+    Attributes
+    ----------
+        rate_limiter : TokenBucket
+            limitador de peticiones, la API publica admite 1 peticion/s
+    """
+
+    def __init__(self, user_agent: str = "Alberto Gutierrez", timeout: float = 5,
+                 max_retries: int = 3, rate: float = 1.0):
+        # Importacion diferida para no requerir geopy si se usa otro backend
+        from geopy.geocoders import Nominatim
+
+        # Es necesario proporcionar un user_agent para utilizar la API
+        self._client = Nominatim(user_agent=user_agent, timeout=timeout)
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(rate=rate, capacity=1)
+
+    def geocode(self, address: str) -> Coordenadas | None:
+        """
+        Obtiene las coordenadas de una direccion.
+
+        Returns
+        -------
+            tuple[float, float] | None
+                (latitud, longitud) o None si la direccion no existe
+        """
+        from geopy.exc import GeocoderTimedOut
+
+        for intento in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                location = self._client.geocode(address)
+            except GeocoderTimedOut:
+                # Puede lanzar una excepcion si se supera el tiempo de espera
+                # Volver a intentarlo con una espera creciente
+                if intento == self.max_retries:
+                    raise
+                time.sleep(2 ** intento)
+                continue
+
+            if location is None:
+                return None
+            return location.latitude, location.longitude
+
+
+class StubBackend:
+    """
+    Backend local para pruebas, no realiza peticiones de red.
+    Devuelve las coordenadas de coordinates si la direccion esta en el
+    diccionario o, si no, unas coordenadas deterministas derivadas de
+    la direccion.
+
+    Attributes
+    ----------
+        coordinates : dict[str, tuple[float, float]]
+            coordenadas conocidas indexadas por direccion normalizada
+        calls : int
+            numero de llamadas recibidas por el backend
+    """
+
+    def __init__(self, coordinates: dict[str, Coordenadas] | None = None, deterministic: bool = True):
+        self.coordinates = {normalize_address(k): v for k, v in (coordinates or {}).items()}
+        self.deterministic = deterministic
+        self.calls = 0
+
+    def geocode(self, address: str) -> Coordenadas | None:
+        self.calls += 1
+        normalizada = normalize_address(address)
+
+        if normalizada in self.coordinates:
+            return self.coordinates[normalizada]
+        if not self.deterministic:
+            return None
+
+        digest = hashlib.sha1(normalizada.encode("utf-8")).digest()
+        latitud = int.from_bytes(digest[:4], "big") / 2**32 * 180 - 90
+        longitud = int.from_bytes(digest[4:8], "big") / 2**32 * 360 - 180
+        return round(latitud, 6), round(longitud, 6)
+
+
+class Geocoder:
+    """
+    Capa de geocodificacion con cache en memoria y en Redis.
+    Las direcciones se normalizan antes de consultar la cache, las
+    peticiones concurrentes de una misma direccion se agrupan en una
+    sola llamada al backend y las direcciones no encontradas tambien
+    se cachean.
+
+    Attributes
+    ----------
+        backend : NominatimBackend | StubBackend
+            objeto con un metodo geocode(address) -> (lat, lng) | None
+        r : redis.client.Redis | None
+            cliente de redis para la cache compartida entre procesos
+        ttl : int
+            tiempo de expiracion de las entradas en redis, en segundos
+        max_memory_entries : int
+            numero maximo de direcciones en la cache en memoria
+
+    Methods
+    -------
+        geocode(address: str) -> tuple[float, float]
+            Devuelve las coordenadas de una direccion.
+        geocode_many(addresses: Iterable[str], return_exceptions: bool) -> list[tuple[float, float] | None | Exception]
+            Geocodifica varias direcciones con una sola consulta a redis.
+    """
+
+    key_prefix = "geocode:"
+
+    def __init__(self, backend=None, redis_client: redis.client.Redis | None = None,
+                 ttl: int = 60 * 60 * 24 * 30, max_memory_entries: int = 10000):
+        self.backend = backend if backend is not None else NominatimBackend()
+        self.r = redis_client
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self._memoria: dict[str, Coordenadas | None] = {}
+        self._lock = threading.Lock()      # El geocodificador se comparte entre hilos
+        self._en_vuelo = SingleFlight()
+
+    def _key(self, normalizada: str) -> str:
+        return self.key_prefix + normalizada
+
+    @staticmethod
+    def _encode(coordenadas: Coordenadas | None) -> bytes:
+        if coordenadas is None:
+            return _NO_ENCONTRADA
+        return f"{coordenadas[0]},{coordenadas[1]}".encode()
+
+    @staticmethod
+    def _decode(valor: bytes) -> Coordenadas | None:
+        if valor == _NO_ENCONTRADA:
+            return None
+        latitud, longitud = valor.split(b",")
+        return float(latitud), float(longitud)
+
+    def _recordada(self, normalizada: str) -> Coordenadas | None | object:
+        with self._lock:
+            return self._memoria.get(normalizada, _NO_RECORDADA)
+
+    def _recordar(self, normalizada: str, coordenadas: Coordenadas | None) -> None:
+        with self._lock:
+            if normalizada not in self._memoria and len(self._memoria) >= self.max_memory_entries:
+                # Se descarta la entrada mas antigua (orden de insercion)
+                del self._memoria[next(iter(self._memoria))]
+            self._memoria[normalizada] = coordenadas
+
+    def _resolver(self, address: str, normalizada: str) -> Coordenadas | None:
+        if self.r is not None:
+            valor = self.r.get(self._key(normalizada))
+            if valor is not None:
+                coordenadas = self._decode(valor)
+                self._recordar(normalizada, coordenadas)
+                return coordenadas
+
+        coordenadas = self.backend.geocode(address)
+        if self.r is not None:
+            self.r.setex(self._key(normalizada), self.ttl, self._encode(coordenadas))
+        self._recordar(normalizada, coordenadas)
+        return coordenadas
+
+    def lookup(self, address: str) -> Coordenadas | None:
+        """
+        Devuelve las coordenadas de una direccion o None si no existe.
+        """
+        normalizada = normalize_address(address)
+        coordenadas = self._recordada(normalizada)
+        if coordenadas is not _NO_RECORDADA:
+            return coordenadas
+
+        return self._en_vuelo.do(normalizada, lambda: self._resolver(address, normalizada))
+
+    def geocode(self, address: str) -> Coordenadas:
+        """
+        Devuelve las coordenadas de una direccion.
+
+        Parameters
+        ----------
+            address : str
+                direccion completa de la que obtener las coordenadas
+        Returns
+        -------
+            tuple[float, float]
+                (latitud, longitud) de la direccion
+        """
+        coordenadas = self.lookup(address)
+        if coordenadas is None:
+            raise ValueError(f"Dirección no encontrada: {address}")
+        return coordenadas
+
+    def geocode_many(self, addresses: Iterable[str], return_exceptions: bool = False) -> list[Coordenadas | None | Exception]:
+        """
+        Geocodifica varias direcciones a la vez. Las direcciones repetidas
+        se resuelven una sola vez, las que no estan en memoria se buscan
+        en redis con un unico MGET y las que faltan se piden al backend
+        una a una y se guardan en redis con un unico pipeline. Las
+        direcciones resueltas se guardan aunque falle otra del lote.
+
+        Parameters
+        ----------
+            addresses : Iterable[str]
+                direcciones a geocodificar
+            return_exceptions : bool
+                si se devuelve la excepcion del backend en la posicion de
+                cada direccion que ha fallado en lugar de lanzar la primera
+        Returns
+        -------
+            list[tuple[float, float] | None | Exception]
+                coordenadas de cada direccion en el mismo orden, None
+                para las direcciones no encontradas
+        """
+        addresses = list(addresses)
+        normalizadas = [normalize_address(a) for a in addresses]
+
+        # Resultados por direccion normalizada y pendientes con su forma original
+        resultados: dict[str, Coordenadas | None] = {}
+        pendientes: dict[str, str] = {}
+        for address, normalizada in zip(addresses, normalizadas):
+            if normalizada in resultados or normalizada in pendientes:
+                continue
+            coordenadas = self._recordada(normalizada)
+            if coordenadas is not _NO_RECORDADA:
+                resultados[normalizada] = coordenadas
+            else:
+                pendientes[normalizada] = address
+
+        if pendientes and self.r is not None:
+            claves = list(pendientes)
+            for normalizada, valor in zip(claves, self.r.mget([self._key(n) for n in claves])):
+                if valor is not None:
+                    resultados[normalizada] = self._decode(valor)
+                    self._recordar(normalizada, resultados[normalizada])
+                    del pendientes[normalizada]
+
+        errores: dict[str, Exception] = {}
+        if pendientes:
+            pipe = self.r.pipeline(transaction=False) if self.r is not None else None
+            try:
+                for normalizada, address in pendientes.items():
+                    try:
+                        coordenadas = self._en_vuelo.do(normalizada, lambda: self.backend.geocode(address))
+                    except Exception as e:
+                        # El backend es configurable y puede lanzar cualquier excepcion
+                        errores[normalizada] = e
+                        continue
+                    resultados[normalizada] = coordenadas
+                    self._recordar(normalizada, coordenadas)
+                    if pipe is not None:
+                        pipe.setex(self._key(normalizada), self.ttl, self._encode(coordenadas))
+            finally:
+                if pipe is not None and len(pipe):
+                    pipe.execute()
+
+        if errores and not return_exceptions:
+            raise next(iter(errores.values()))
+        return [errores[n] if n in errores else resultados[n] for n in normalizadas]
+
+
+_geocoder: Geocoder | None = None
+
+
+def get_geocoder() -> Geocoder:
+    """
+    Devuelve el geocodificador por defecto, creandolo si no existe.
+    """
+    global _geocoder
+    if _geocoder is None:
+        _geocoder = Geocoder()
+    return _geocoder
+
+
+def set_geocoder(geocoder: Geocoder) -> None:
+    """
+    Sustituye el geocodificador por defecto, por ejemplo para utilizar
+    la cache de redis o un StubBackend en las pruebas.
+    """
+    global _geocoder
+    _geocoder = geocoder
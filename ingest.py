@@ -0,0 +1,104 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import json
+from typing import Any, Callable, Generator, IO
+
+_ESPACIOS = " \t\r\n"
+
+
+def _iter_json_array(f: IO[str], chunk_size: int,
+                     object_hook: Callable[[dict], Any] | None = None) -> Generator[dict, None, None]:
+    """
+    Recorre los elementos de un array JSON leyendo el fichero por
+    bloques, sin cargar el array completo en memoria.
+    """
+    decoder = json.JSONDecoder(object_hook=object_hook)
+    buffer = ""
+    pos = 0
+    fin = False
+    dentro = False
+
+    while True:
+        # Saltar espacios (y comas entre elementos)
+        separadores = _ESPACIOS + "," if dentro else _ESPACIOS
+        while pos < len(buffer) and buffer[pos] in separadores:
+            pos += 1
+
+        if pos == len(buffer):
+            if fin:
+                raise ValueError("Array JSON incompleto")
+            bloque = f.read(chunk_size)
+            fin = not bloque
+            buffer, pos = bloque, 0
+            continue
+
+        if not dentro:
+            if buffer[pos] != "[":
+                raise ValueError("Se esperaba un array JSON")
+            dentro = True
+            pos += 1
+            continue
+
+        if buffer[pos] == "]":
+            return
+
+        try:
+            documento, final = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if fin:
+                raise
+            final = len(buffer)
+
+        if final == len(buffer) and not fin:
+            # Elemento incompleto o que podria continuar en el siguiente bloque
+            bloque = f.read(chunk_size)
+            fin = not bloque
+            buffer, pos = buffer[pos:] + bloque, 0
+            continue
+
+        yield documento
+        pos = final
+
+
+def iter_documents(path: str, chunk_size: int = 1 << 16,
+                   object_hook: Callable[[dict], Any] | None = None) -> Generator[dict, None, None]:
+    """
+    Devuelve un generador con los documentos de un fichero JSON (un
+    array de objetos, como data.json) o NDJSON (un objeto por linea).
+    El formato se detecta por el primer caracter del fichero y en
+    ambos casos se lee por bloques con memoria acotada.
+
+    Parameters
+    ----------
+        path : str
+            ruta al fichero de documentos
+        chunk_size : int
+            tamaño de los bloques de lectura en caracteres
+        object_hook : Callable[[dict], Any] | None
+            conversion de cada objeto leido, por ejemplo
+            bson.json_util.object_hook para JSON extendido ($oid, $date)
+    Returns
+    -------
+        Generator[dict]
+            documentos del fichero en orden
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        primero = ""
+        while True:
+            primero = f.read(1)
+            if not primero or primero not in _ESPACIOS:
+                break
+
+        if not primero:
+            return
+
+        if primero == "[":
+            f.seek(0)
+            yield from _iter_json_array(f, chunk_size, object_hook)
+            return
+
+        # NDJSON: un documento por linea, se ignoran las lineas vacias
+        yield json.loads(primero + f.readline(), object_hook=object_hook)
+        for linea in f:
+            if linea.strip():
+                yield json.loads(linea, object_hook=object_hook)
@@ -0,0 +1,344 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import contextlib
+import functools
+import http.server
+import inspect
+import threading
+import time
+from typing import Any, Callable
+
+from pymongo import monitoring
+
+# Limites de los histogramas de latencia, en segundos
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+# Metodos cronometrados de cada clase cuando se activa la instrumentacion
+_METODOS_MODELO = ("save", "delete", "save_many", "load_file", "find", "find_by_id", "find_by_ids",
+                   "aggregate", "near", "within", "cache_clear", "ensure_indexes")
+_METODOS_MANAGER = ("register", "login", "generate_token", "login_and_generate_token", "login_with_token",
+                    "logout", "edit_user_info", "delete_user", "get_user_info", "search_users",
+                    "users_by_privileges", "create_ticket", "claim_ticket", "ack_ticket", "attend_ticket",
+                    "requeue_expired_tickets", "user_tickets")
+
+_SIN_SPAN = contextlib.nullcontext()
+
+
+def _etiquetas(etiquetas: dict[str, str]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted(etiquetas.items()))
+
+
+def _escapar(valor: Any) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _formato(nombre: str, etiquetas: tuple[tuple[str, str], ...], valor: float) -> str:
+    if etiquetas:
+        texto = ",".join(f'{clave}="{_escapar(v)}"' for clave, v in etiquetas)
+        return f"{nombre}{{{texto}}} {valor:g}"
+    return f"{nombre} {valor:g}"
+
+
+class Metrics:
+    """
+    Registro de metricas del ODM y de RedisManager: contadores e
+    histogramas con etiquetas, exportables en el formato de texto de
+    Prometheus.
+    Desactivado no tiene coste: los metodos no estan envueltos y los
+    puntos de medida del codigo comprueban enabled antes de llamar a
+    count u observe.
+
+    Attributes
+    ----------
+        enabled : bool
+            si se estan registrando metricas
+        tracer : Any | None
+            tracer de OpenTelemetry para las spans de cada metodo, None
+            para no generarlas
+
+    Methods
+    -------
+        count(nombre: str, cantidad: float, **etiquetas) -> None
+            Incrementa un contador.
+        observe(nombre: str, valor: float, **etiquetas) -> None
+            Añade una observacion a un histograma.
+        span(nombre: str) -> ContextManager
+            Span de OpenTelemetry o un contexto vacio.
+        snapshot() -> dict
+            Valores actuales de contadores e histogramas.
+        export_prometheus() -> str
+            Metricas en el formato de texto de Prometheus.
+        reset() -> None
+            Pone a cero todas las metricas.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.tracer = None
+        self._lock = threading.Lock()
+        self._contadores: dict[str, dict[tuple, float]] = {}
+        self._histogramas: dict[str, dict[tuple, list]] = {}
+
+    def count(self, nombre: str, cantidad: float = 1, **etiquetas: str) -> None:
+        clave = _etiquetas(etiquetas)
+        with self._lock:
+            serie = self._contadores.setdefault(nombre, {})
+            serie[clave] = serie.get(clave, 0) + cantidad
+
+    def observe(self, nombre: str, valor: float, **etiquetas: str) -> None:
+        clave = _etiquetas(etiquetas)
+        with self._lock:
+            serie = self._histogramas.setdefault(nombre, {})
+            # Cubetas no acumuladas, suma y numero de observaciones
+            datos = serie.get(clave)
+            if datos is None:
+                datos = serie[clave] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, limite in enumerate(BUCKETS):
+                if valor <= limite:
+                    datos[0][i] += 1
+                    break
+            datos[1] += valor
+            datos[2] += 1
+
+    def span(self, nombre: str):
+        if self.tracer is None:
+            return _SIN_SPAN
+        return self.tracer.start_as_current_span(nombre)
+
+    def snapshot(self) -> dict:
+        """
+        Returns
+        -------
+            dict
+                "counters" con el valor de cada serie y "histograms" con
+                el numero de observaciones, la suma y las cubetas
+                acumuladas de cada serie, indexadas por sus etiquetas
+        """
+        with self._lock:
+            contadores = {nombre: {clave: valor for clave, valor in serie.items()}
+                          for nombre, serie in self._contadores.items()}
+            histogramas = {}
+            for nombre, serie in self._histogramas.items():
+                histogramas[nombre] = {}
+                for clave, (cubetas, suma, numero) in serie.items():
+                    acumuladas, total = [], 0
+                    for limite, cantidad in zip(BUCKETS, cubetas):
+                        total += cantidad
+                        acumuladas.append((limite, total))
+                    histogramas[nombre][clave] = {"count": numero, "sum": suma, "buckets": acumuladas}
+        return {"counters": contadores, "histograms": histogramas}
+
+    def export_prometheus(self) -> str:
+        """ Metricas en el formato de texto de Prometheus (version 0.0.4) """
+        estado = self.snapshot()
+        lineas = []
+        for nombre, serie in sorted(estado["counters"].items()):
+            lineas.append(f"# TYPE {nombre} counter")
+            lineas += [_formato(nombre, clave, valor) for clave, valor in sorted(serie.items())]
+        for nombre, serie in sorted(estado["histograms"].items()):
+            lineas.append(f"# TYPE {nombre} histogram")
+            for clave, datos in sorted(serie.items()):
+                for limite, total in datos["buckets"]:
+                    le = "+Inf" if limite == float("inf") else f"{limite:g}"
+                    lineas.append(_formato(nombre + "_bucket", clave + (("le", le),), total))
+                lineas.append(_formato(nombre + "_sum", clave, datos["sum"]))
+                lineas.append(_formato(nombre + "_count", clave, datos["count"]))
+        return "\n".join(lineas) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._contadores.clear()
+            self._histogramas.clear()
+
+
+# Registro global, desactivado por defecto
+metrics = Metrics()
+
+# Metodos sustituidos al activar la instrumentacion, para restaurarlos
+_originales: list[tuple[type, str, Any]] = []
+
+
+def _nombre_clase(primero: Any) -> str:
+    # Los metodos de clase reciben la clase, los de instancia el objeto
+    return primero.__name__ if isinstance(primero, type) else type(primero).__name__
+
+
+def _cronometrar(funcion: Callable, metodo: str) -> Callable:
+    """ Envuelve funcion para medir su latencia y contar sus errores """
+    if inspect.iscoroutinefunction(funcion):
+        @functools.wraps(funcion)
+        async def envoltura(primero, *args, **kwargs):
+            clase = _nombre_clase(primero)
+            inicio = time.perf_counter()
+            try:
+                with metrics.span(f"{clase}.{metodo}"):
+                    return await funcion(primero, *args, **kwargs)
+            except BaseException:
+                metrics.count("odm_method_errors_total", **{"class": clase, "method": metodo})
+                raise
+            finally:
+                metrics.observe("odm_method_duration_seconds", time.perf_counter() - inicio,
+                                **{"class": clase, "method": metodo})
+        return envoltura
+
+    @functools.wraps(funcion)
+    def envoltura(primero, *args, **kwargs):
+        clase = _nombre_clase(primero)
+        inicio = time.perf_counter()
+        try:
+            with metrics.span(f"{clase}.{metodo}"):
+                return funcion(primero, *args, **kwargs)
+        except BaseException:
+            metrics.count("odm_method_errors_total", **{"class": clase, "method": metodo})
+            raise
+        finally:
+            metrics.observe("odm_method_duration_seconds", time.perf_counter() - inicio,
+                            **{"class": clase, "method": metodo})
+    return envoltura
+
+
+def _instrumentar_clase(clase: type, metodos: tuple[str, ...]) -> None:
+    # Solo los metodos definidos en la propia clase, los heredados ya
+    # estan envueltos en la clase base
+    for nombre in metodos:
+        original = clase.__dict__.get(nombre)
+        if original is None:
+            continue
+        if isinstance(original, classmethod):
+            envuelto = classmethod(_cronometrar(original.__func__, nombre))
+        elif inspect.isfunction(original):
+            envuelto = _cronometrar(original, nombre)
+        else:
+            continue
+        _originales.append((clase, nombre, original))
+        setattr(clase, nombre, envuelto)
+
+
+def _tamaño(comando: Any) -> int:
+    # Un comando empaquetado es un bloque de bytes o una lista de bloques
+    if isinstance(comando, (bytes, bytearray, memoryview, str)):
+        return len(comando)
+    return sum(len(bloque) for bloque in comando)
+
+
+def _instrumentar_redis() -> None:
+    """ Cuenta los envios a redis (un pipeline es un unico envio) y sus bytes """
+    import redis.connection
+    import redis.asyncio.connection
+
+    for modulo, asincrono in ((redis.connection, False), (redis.asyncio.connection, True)):
+        base = getattr(modulo, "AbstractConnection", modulo.Connection)
+        original = base.__dict__["send_packed_command"]
+
+        if asincrono:
+            async def enviar(self, command, check_health=True, _original=original):
+                metrics.count("odm_redis_round_trips_total")
+                metrics.count("odm_redis_bytes_sent_total", _tamaño(command))
+                return await _original(self, command, check_health)
+        else:
+            def enviar(self, command, check_health=True, _original=original):
+                metrics.count("odm_redis_round_trips_total")
+                metrics.count("odm_redis_bytes_sent_total", _tamaño(command))
+                return _original(self, command, check_health)
+
+        _originales.append((base, "send_packed_command", original))
+        base.send_packed_command = enviar
+
+
+class MongoListener(monitoring.CommandListener):
+    """
+    Cuenta los comandos enviados a mongo y su duracion. Se añade a los
+    clientes que crea connections mientras la instrumentacion esta
+    activa (ver connections.get_mongo_client).
+    """
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        if metrics.enabled:
+            metrics.count("odm_mongo_round_trips_total", command=event.command_name)
+            metrics.observe("odm_mongo_command_duration_seconds", event.duration_micros / 1e6,
+                            command=event.command_name)
+
+    def failed(self, event) -> None:
+        if metrics.enabled:
+            metrics.count("odm_mongo_round_trips_total", command=event.command_name)
+            metrics.count("odm_mongo_command_failures_total", command=event.command_name)
+
+
+MONGO_LISTENER = MongoListener()
+
+
+def enable(spans: bool = False) -> None:
+    """
+    Activa la instrumentacion: envuelve los metodos de los modelos y de
+    RedisManager para medir su latencia y empieza a contar los viajes a
+    redis y a mongo. Los clientes de mongo solo se instrumentan si se
+    crean despues, por lo que conviene llamarla antes de initApp.
+
+    Parameters
+    ----------
+        spans : bool
+            si se genera una span de OpenTelemetry por cada metodo (requiere
+            el paquete opentelemetry-api y un TracerProvider configurado)
+    """
+    if metrics.enabled:
+        return
+
+    from ODM import Model
+    from async_odm import AsyncModel
+    from redis_manager import RedisManager
+    from async_redis_manager import AsyncRedisManager
+
+    if spans:
+        from opentelemetry import trace
+        metrics.tracer = trace.get_tracer("odm")
+
+    for clase in (Model, AsyncModel):
+        _instrumentar_clase(clase, _METODOS_MODELO)
+    for clase in (RedisManager, AsyncRedisManager):
+        _instrumentar_clase(clase, _METODOS_MANAGER)
+    _instrumentar_redis()
+    metrics.enabled = True
+
+
+def disable() -> None:
+    """ Desactiva la instrumentacion y restaura los metodos originales """
+    metrics.enabled = False
+    metrics.tracer = None
+    while _originales:
+        clase, nombre, original = _originales.pop()
+        setattr(clase, nombre, original)
+
+
+def export_prometheus() -> str:
+    """ Metricas del registro global en el formato de texto de Prometheus """
+    return metrics.export_prometheus()
+
+
+class _Exportador(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        cuerpo = export_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def start_http_server(port: int = 9464, addr: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    """
+    Sirve las metricas en http://addr:port/metrics desde un hilo, para
+    que Prometheus las recoja. Se detiene con shutdown() del servidor.
+    """
+    servidor = http.server.ThreadingHTTPServer((addr, port), _Exportador)
+    threading.Thread(target=servidor.serve_forever, name="metrics-exporter", daemon=True).start()
+    return servidor
@@ -0,0 +1,220 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import redis
+
+from instrumentation import metrics
+
+# Canal de pub/sub por el que se anuncian las claves modificadas
+INVALIDATION_CHANNEL = "odm:invalidate"
+
+
+class CacheStats:
+    """
+    Contadores de aciertos y fallos de la cache en memoria (L1) y de
+    redis (L2) de un modelo. Con la instrumentacion activa tambien se
+    registran en odm_cache_requests_total.
+
+    Methods
+    -------
+        count(contador: str, cantidad: int) -> None
+            Incrementa un contador.
+        snapshot() -> dict
+            Contadores y tasas de acierto.
+    """
+
+    def __init__(self, model: str = ""):
+        self.model = model
+        self._lock = threading.Lock()
+        self._contadores = {"l1_hits": 0, "l1_misses": 0, "l2_hits": 0, "l2_misses": 0}
+
+    def count(self, contador: str, cantidad: int = 1) -> None:
+        with self._lock:
+            self._contadores[contador] += cantidad
+        if metrics.enabled:
+            nivel, resultado = contador.split("_")
+            metrics.count("odm_cache_requests_total", cantidad, model=self.model, level=nivel,
+                          result="hit" if resultado == "hits" else "miss")
+
+    def snapshot(self) -> dict:
+        """
+        Returns
+        -------
+            dict
+                aciertos y fallos de cada nivel, su tasa de aciertos y la
+                tasa de aciertos total (lecturas que no llegan a mongo)
+        """
+        with self._lock:
+            estadisticas = dict(self._contadores)
+        l1 = estadisticas["l1_hits"] + estadisticas["l1_misses"]
+        l2 = estadisticas["l2_hits"] + estadisticas["l2_misses"]
+        estadisticas["l1_hit_rate"] = estadisticas["l1_hits"] / l1 if l1 else 0.0
+        estadisticas["l2_hit_rate"] = estadisticas["l2_hits"] / l2 if l2 else 0.0
+        lecturas = estadisticas["l1_hits"] + l2
+        aciertos = estadisticas["l1_hits"] + estadisticas["l2_hits"]
+        estadisticas["hit_rate"] = aciertos / lecturas if lecturas else 0.0
+        return estadisticas
+
+
+class LocalCache:
+    """
+    Cache LRU en memoria del proceso con expiracion, delante de la cache
+    de redis. Guarda los documentos codificados, de modo que cada
+    lectura construye un documento nuevo que el modelo puede modificar.
+    Es segura entre hilos.
+
+    Attributes
+    ----------
+        max_entries : int
+            numero maximo de entradas, se descartan las menos usadas
+        ttl : float
+            segundos que dura una entrada. Acota el tiempo que una
+            entrada puede quedar obsoleta si se pierde una invalidacion
+
+    Methods
+    -------
+        get(key: str) -> bytes | None
+            Valor de una clave o None si no esta o ha caducado.
+        set(key: str, value: bytes) -> None
+            Guarda un valor.
+        delete(*keys: str) -> None
+            Elimina claves.
+        delete_prefix(prefix: str) -> None
+            Elimina las claves que empiezan por prefix.
+        clear() -> None
+            Vacia la cache.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 30):
+        if max_entries <= 0 or ttl <= 0:
+            raise ValueError("max_entries y ttl deben ser positivos")
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entradas: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            entrada = self._entradas.get(key)
+            if entrada is None:
+                return None
+            caduca, valor = entrada
+            if caduca < time.monotonic():
+                del self._entradas[key]
+                return None
+            self._entradas.move_to_end(key)
+            return valor
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._entradas[key] = (time.monotonic() + self.ttl, value)
+            self._entradas.move_to_end(key)
+            while len(self._entradas) > self.max_entries:
+                self._entradas.popitem(last=False)
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._entradas.pop(key, None)
+
+    def delete_prefix(self, prefix: str) -> None:
+        with self._lock:
+            for key in [key for key in self._entradas if key.startswith(prefix)]:
+                del self._entradas[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entradas.clear()
+
+    def __len__(self) -> int:
+        return len(self._entradas)
+
+
+class CacheInvalidator:
+    """
+    Propaga las invalidaciones de la cache en memoria entre procesos por
+    pub/sub de redis. Cada proceso publica las claves que modifica y
+    escucha en un hilo las de los demas para eliminarlas de su LocalCache.
+    Pub/sub no guarda los mensajes: al reconectar se vacia la cache
+    local, ya que se pueden haber perdido invalidaciones.
+
+    Attributes
+    ----------
+        r : redis.Redis
+            cliente de redis
+        local : LocalCache
+            cache en memoria a invalidar
+        channel : str
+            canal de pub/sub
+
+    Methods
+    -------
+        message(keys: list[str]) -> str
+            Mensaje de invalidacion de unas claves.
+        publish(keys: list[str]) -> None
+            Anuncia a los demas procesos que se han modificado unas claves.
+        start() -> None
+            Empieza a escuchar las invalidaciones en un hilo.
+        stop() -> None
+            Deja de escuchar.
+    """
+
+    def __init__(self, redis_client: redis.Redis, local: LocalCache, channel: str = INVALIDATION_CHANNEL):
+        self.r = redis_client
+        self.local = local
+        self.channel = channel
+        self._origen = uuid.uuid4().hex     # Para ignorar los mensajes propios
+        self._parar = threading.Event()
+        self._hilo: threading.Thread | None = None
+
+    def message(self, keys: list[str]) -> str:
+        # Las claves no contienen espacios (nombre del modelo e id). Una
+        # clave terminada en * invalida todas las que empiezan por ella
+        return " ".join([self._origen, *keys])
+
+    def publish(self, keys: list[str]) -> None:
+        if keys:
+            self.r.publish(self.channel, self.message(keys))
+
+    def _procesar(self, mensaje: bytes) -> None:
+        origen, *claves = mensaje.decode("utf-8").split(" ")
+        if origen == self._origen:
+            return
+        for clave in claves:
+            if clave.endswith("*"):
+                self.local.delete_prefix(clave[:-1])
+            else:
+                self.local.delete(clave)
+
+    def _escuchar(self) -> None:
+        while not self._parar.is_set():
+            pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                self.local.clear()
+                while not self._parar.is_set():
+                    mensaje = pubsub.get_message(timeout=1.0)
+                    if mensaje is not None and mensaje["type"] == "message":
+                        self._procesar(mensaje["data"])
+            except (redis.ConnectionError, redis.TimeoutError):
+                self.local.clear()
+                self._parar.wait(1)
+            finally:
+                pubsub.close()
+
+    def start(self) -> None:
+        if self._hilo is None or not self._hilo.is_alive():
+            self._parar.clear()
+            self._hilo = threading.Thread(target=self._escuchar, name="cache-invalidator", daemon=True)
+            self._hilo.start()
+
+    def stop(self) -> None:
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join()
+            self._hilo = None
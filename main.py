@@ -1,15 +1,48 @@
 from ODM import *
 from redis_manager import *
+from geocoding import Geocoder, set_geocoder
+from cache_codecs import get_codec
+from schema import compile_schema
+from query_cache import QueryCache, AsyncQueryCache
+from local_cache import LocalCache, CacheInvalidator
+from async_odm import AsyncModel
+import connections
 import redis
 import yaml
 
-def initApp(definitions_path: str = "./models.yml", mongodb_uri="mongodb://localhost:27017/", db_name="abd") -> None:
+_invalidator: CacheInvalidator | None = None
+
+def _start_local_cache(size: int, ttl: float) -> tuple[LocalCache | None, CacheInvalidator | None]:
+    """ Crea la cache en memoria y arranca su hilo de invalidaciones """
+    global _invalidator
+    if _invalidator is not None:
+        _invalidator.stop()
+        _invalidator = None
+    if not size:
+        return None, None
+
+    local_cache = LocalCache(max_entries=size, ttl=ttl)
+    # El hilo de escucha usa el cliente sincrono tambien en initAppAsync
+    _invalidator = CacheInvalidator(connections.get_redis(), local_cache)
+    _invalidator.start()
+    return local_cache, _invalidator
+
+def _print_indexes(nombre_coleccion: str, resultado: dict[str, list]) -> None:
+    """ Muestra los cambios de ensure_indexes en una coleccion """
+    for accion, texto in (("created", "creado"), ("modified", "modificado"), ("dropped", "eliminado")):
+        for nombre in resultado[accion]:
+            print(f"Indice {nombre} de {nombre_coleccion} {texto}")
+    for nombre, mensaje in resultado["errors"]:
+        print(f"No se ha podido crear el indice {nombre} de {nombre_coleccion}: {mensaje}")
+
+def initApp(definitions_path: str = "./models.yml", mongodb_uri="mongodb://localhost:27017/", db_name="abd", geocoding_backend=None, cache_codec: str = "bson", cache_compression: str | None = None, negative_cache_ttl: int | None = None, connection_settings: dict | None = None, manage_indexes: bool = True, query_cache_ttl: int | None = None, local_cache_size: int = 0, local_cache_ttl: float = 30, redis_maxmemory: str | None = None) -> None:
     """ 
     Declara las clases que heredan de Model para cada uno de los 
     modelos de las colecciones definidas en definitions_path.
     Inicializa las clases de los modelos proporcionando las variables 
-    admitidas y requeridas para cada una de ellas y la conexión a la
-    collecion de la base de datos.
+    admitidas y requeridas para cada una de ellas, sus tipos y valores
+    por defecto (ver schema.py) y la conexión a la collecion de la base
+    de datos.
     
     Parameters
     ----------
@@ -19,20 +52,64 @@ def initApp(definitions_path: str = "./models.yml", mongodb_uri="mongodb://local
             uri de conexion a la base de datos
         db_name : str
             nombre de la base de datos
+        geocoding_backend : NominatimBackend | StubBackend | None
+            backend de geocodificacion, por defecto Nominatim
+        cache_codec : str
+            formato de los documentos en la cache, "bson" o "msgpack"
+        cache_compression : str | None
+            compresion de los documentos grandes en la cache, "zlib" o "lz4"
+        negative_cache_ttl : int | None
+            segundos que find_by_id recuerda los ids inexistentes, None
+            para consultar siempre mongo
+        connection_settings : dict | None
+            configuracion de los pools de conexiones (ver connections.py)
+        manage_indexes : bool
+            si se crean o actualizan los indices declarados en models.yml
+        query_cache_ttl : int | None
+            segundos que se guardan por defecto los resultados de find y
+            aggregate con cache_results, None para desactivar la cache
+            de consultas
+        local_cache_size : int
+            documentos de la cache en memoria del proceso delante de
+            redis, 0 para desactivarla
+        local_cache_ttl : float
+            segundos que dura un documento en la cache en memoria
+        redis_maxmemory : str | None
+            limite de memoria de redis (por ejemplo "150mb") con politica
+            volatile-lru. Afecta a todo el servidor, sesiones incluidas,
+            por lo que por defecto no se modifica la configuracion. El ttl,
+            jitter y maximo de documentos de cada modelo se declaran en la
+            seccion cache de models.yml
     """
-    # Inicializar base de datos:
-    base_de_datos = pymongo.MongoClient(mongodb_uri)[db_name]
+    if connection_settings:
+        connections.configure(**connection_settings)
+
+    # Inicializar base de datos (cliente y pool compartidos):
+    base_de_datos = connections.get_mongo_client(mongodb_uri)[db_name]
     
     # Inicializar cache:
-    r = redis.StrictRedis(host='localhost', port=6379, db=0)
-    r.config_set('maxmemory', '150mb')                    #Esta linea limita la memoria máxima que puede tener la caché
-    r.config_set('maxmemory-policy', 'volatile-lru')  
+    r = connections.get_redis()
+    if redis_maxmemory:
+        r.config_set('maxmemory', redis_maxmemory)            #Esta linea limita la memoria máxima que puede tener la caché
+        r.config_set('maxmemory-policy', 'volatile-lru')  
     
     try:                                        #Aqui podemos comprobar el estado de la conexión
         r.ping()
         print("Se ha establecido conexión con el servidor Redis")
     except redis.ConnectionError:
         print("Error de conexión con el servidor Redis")
+
+    # Geocodificacion de direcciones cacheada en redis
+    set_geocoder(Geocoder(backend=geocoding_backend, redis_client=r))
+
+    # Codificador de los documentos cacheados, compartido por todos los modelos
+    codec = get_codec(cache_codec, compression=cache_compression)
+
+    # Cache de resultados de consultas, compartida por todos los modelos
+    query_cache = QueryCache(r, codec, ttl=query_cache_ttl) if query_cache_ttl else None
+
+    # Cache en memoria, invalidada por pub/sub cuando otro proceso modifica un documento
+    local_cache, invalidator = _start_local_cache(local_cache_size, local_cache_ttl)
     
     # Obtener las definiciones de modelos del fichero yaml
     with open(definitions_path, "r") as f:
@@ -46,22 +123,71 @@ def initApp(definitions_path: str = "./models.yml", mongodb_uri="mongodb://local
     
     for nombre_coleccion in modelos.keys():
         globals()[nombre_coleccion] = type(nombre_coleccion, (Model,), {})   
-        modelo = modelos[nombre_coleccion]
-        globals()[nombre_coleccion].init_class(db_collection=base_de_datos[nombre_coleccion], redis_client=r, required_vars=modelo["required_vars"], admissible_vars=modelo["admissible_vars"])
+        # Las definiciones se compilan una sola vez por modelo
+        schema = compile_schema(nombre_coleccion, modelos[nombre_coleccion])
+        globals()[nombre_coleccion].init_class(db_collection=base_de_datos[nombre_coleccion], redis_client=r, required_vars=schema.required, admissible_vars=schema.admissible, codec=codec, negative_ttl=negative_cache_ttl, schema=schema, query_cache=query_cache, local_cache=local_cache, invalidator=invalidator)
+        if manage_indexes:
+            _print_indexes(nombre_coleccion, globals()[nombre_coleccion].ensure_indexes())
     
     # Ignorar el warning de Pylance sobre MiModelo, es incapaz de detectar
     # que se ha declarado la clase en la linea anterior ya que se hace
     # en tiempo de ejecucion.
 
 
-if __name__ == "__main__":
+async def initAppAsync(definitions_path: str = "./models.yml", mongodb_uri="mongodb://localhost:27017/", db_name="abd", geocoding_backend=None, cache_codec: str = "bson", cache_compression: str | None = None, negative_cache_ttl: int | None = None, connection_settings: dict | None = None, manage_indexes: bool = True, query_cache_ttl: int | None = None, local_cache_size: int = 0, local_cache_ttl: float = 30, redis_maxmemory: str | None = None) -> None:
+    """ 
+    Version asincrona de initApp. Declara las clases de los modelos de
+    definitions_path heredando de AsyncModel, conectadas a mongo con
+    pymongo.AsyncMongoClient y a redis con redis.asyncio.
+    Los parametros son los mismos que los de initApp. Las clases se
+    declaran con el mismo nombre, por lo que una aplicacion debe usar
+    initApp o initAppAsync, no ambas.
+    """
+    if connection_settings:
+        connections.configure(**connection_settings)
+
+    # Inicializar base de datos:
+    base_de_datos = connections.get_async_mongo_client(mongodb_uri)[db_name]
+    
+    # Inicializar cache:
+    r = connections.get_async_redis()
+    if redis_maxmemory:
+        await r.config_set('maxmemory', redis_maxmemory)
+        await r.config_set('maxmemory-policy', 'volatile-lru')
+    
+    try:
+        await r.ping()
+        print("Se ha establecido conexión con el servidor Redis")
+    except redis.ConnectionError:
+        print("Error de conexión con el servidor Redis")
+
+    # La geocodificacion se realiza en __setattr__, que es sincrono
+    set_geocoder(Geocoder(backend=geocoding_backend, redis_client=connections.get_redis()))
+
+    codec = get_codec(cache_codec, compression=cache_compression)
+    query_cache = AsyncQueryCache(r, codec, ttl=query_cache_ttl) if query_cache_ttl else None
+    local_cache, invalidator = _start_local_cache(local_cache_size, local_cache_ttl)
+    
+    with open(definitions_path, "r") as f:
+        modelos = yaml.load(f, Loader=yaml.FullLoader)
     
-    # Limpiamos la caché
-    r = redis.StrictRedis(host='localhost', port=6379, db=0)
-    r.flushall()
+    for nombre_coleccion in modelos.keys():
+        globals()[nombre_coleccion] = type(nombre_coleccion, (AsyncModel,), {})   
+        # Las definiciones se compilan una sola vez por modelo
+        schema = compile_schema(nombre_coleccion, modelos[nombre_coleccion])
+        globals()[nombre_coleccion].init_class(db_collection=base_de_datos[nombre_coleccion], redis_client=r, required_vars=schema.required, admissible_vars=schema.admissible, codec=codec, negative_ttl=negative_cache_ttl, schema=schema, query_cache=query_cache, local_cache=local_cache, invalidator=invalidator)
+        if manage_indexes:
+            _print_indexes(nombre_coleccion, await globals()[nombre_coleccion].ensure_indexes())
+
+
+if __name__ == "__main__":
     
     initApp()
 
+    # Limpiamos la caché del modelo, sin tocar sesiones ni tickets
+    r = connections.get_redis()
+    MiModelo.cache_clear()
+
     # Creamos un modelo de pruebas
     modelo = MiModelo(nombre="Alex", apellido="gomez", edad="20")
     
@@ -71,7 +197,7 @@ if __name__ == "__main__":
     #Primero salvamos y vemos que lo guarda en la caché
     print("\nGuardamos el modelo en la base de datos y en la caché")
     modelo.save()                                                                 
-    print("Contenido de caché:" , r.get(str(modelo.__dict__.get('_id'))))   #Comrpobamos que se almacenó en caché
+    print("Contenido de caché:" , r.get(MiModelo.cache_key(str(modelo.__dict__.get('_id')))))   #Comrpobamos que se almacenó en caché
 
     #Buscamos por id el modelo
     print("\nCuando buscamos por id, lo cogerá de la caché")
@@ -79,18 +205,18 @@ if __name__ == "__main__":
 
     #Borramos el modelo de la caché
     print("\nBorramos el modelo de la caché")
-    r.delete(str(modelo.__dict__.get('_id')))
-    print("Contenido de caché:" , r.get(str(modelo.__dict__.get('_id'))))   #Comrpobamos que se borró de la caché
+    r.delete(MiModelo.cache_key(str(modelo.__dict__.get('_id'))))
+    print("Contenido de caché:" , r.get(MiModelo.cache_key(str(modelo.__dict__.get('_id')))))   #Comrpobamos que se borró de la caché
 
     #Buscamos por id el modelo, como no está en caché, lo buscará en mongo y lo subirá a la caché
     print("\nSi no está en cache, lo buscará en mongo y lo subirá a la caché")
     print("Buscado mediante id:" , modelo.find_by_id(str(modelo.__dict__.get('_id'))))
-    print("Contenido de caché:" , r.get(str(modelo.__dict__.get('_id'))))   #Comrpobamos que se almacenó en caché
+    print("Contenido de caché:" , r.get(MiModelo.cache_key(str(modelo.__dict__.get('_id')))))   #Comrpobamos que se almacenó en caché
 
     #Borramos el modelo para que se borre de la caché también
     print("\nBorramos el modelo de la base de datos y de la caché")
     modelo.delete()                                                    
-    print("Contenido de caché:" , r.get(str(modelo.__dict__.get('_id'))))   #Comrpobamos que se almacenó en caché
+    print("Contenido de caché:" , r.get(MiModelo.cache_key(str(modelo.__dict__.get('_id')))))   #Comrpobamos que se almacenó en caché
 
     #Comprobamos que si no está ni en caché ni en mongo, devuelve None
     print("\nSi no está en caché ni en mongo, devuelve None")
@@ -102,6 +228,11 @@ if __name__ == "__main__":
     
     manager = RedisManager()
 
+    # Eliminamos los usuarios de una ejecucion anterior de la demo
+    for nombre_usuario in ("antonio", "juan"):
+        if manager.user_exists(nombre_usuario):
+            manager.delete_user(nombre_usuario)
+
     manager.register("antonio", "Antonio Cabrera", "1234", 1) # Registrar un usuario
     print("Información de usuario: ", manager.get_user_info("antonio"))
 
@@ -144,5 +275,5 @@ if __name__ == "__main__":
         print("Usuario del ticket: " + manager.attend_ticket()) # Atender ticket
 
     print("\nAtender ticket sin tickets: ")
-    manager.attend_ticket() # Atender ticket sin tickets
+    manager.attend_ticket(timeout=5) # Atender ticket sin tickets, espera como maximo 5 segundos
     
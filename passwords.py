@@ -0,0 +1,59 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import hashlib
+import hmac
+import os
+
+# Iteraciones de PBKDF2-HMAC-SHA256 recomendadas por OWASP
+ITERACIONES = 600_000
+_ALGORITMO = "pbkdf2_sha256"
+
+
+def hash_password(contraseña: str, iteraciones: int = ITERACIONES) -> str:
+    """
+    Calcula el hash con sal de una contraseña.
+
+    Parameters
+    ----------
+        contraseña : str
+            contraseña en texto plano
+        iteraciones : int
+            iteraciones de PBKDF2
+    Returns
+    -------
+        str
+            "pbkdf2_sha256$<iteraciones>$<sal>$<hash>" con sal y hash en hexadecimal
+    """
+    sal = os.urandom(16)
+    resumen = hashlib.pbkdf2_hmac("sha256", contraseña.encode("utf-8"), sal, iteraciones)
+    return f"{_ALGORITMO}${iteraciones}${sal.hex()}${resumen.hex()}"
+
+
+def is_hashed(almacenada: str) -> bool:
+    """ Indica si una contraseña almacenada ya esta en formato hash """
+    return almacenada.startswith(_ALGORITMO + "$")
+
+
+def verify_password(contraseña: str, almacenada: str) -> bool:
+    """
+    Comprueba una contraseña contra su hash almacenado en tiempo
+    constante. Las contraseñas antiguas guardadas en texto plano
+    tambien se aceptan para poder migrarlas al iniciar sesion.
+
+    Parameters
+    ----------
+        contraseña : str
+            contraseña en texto plano
+        almacenada : str
+            hash generado por hash_password (o contraseña antigua en claro)
+    Returns
+    -------
+        bool
+            True si la contraseña es correcta
+    """
+    if not is_hashed(almacenada):
+        return hmac.compare_digest(contraseña.encode("utf-8"), almacenada.encode("utf-8"))
+
+    _, iteraciones, sal, resumen = almacenada.split("$")
+    calculado = hashlib.pbkdf2_hmac("sha256", contraseña.encode("utf-8"), bytes.fromhex(sal), int(iteraciones))
+    return hmac.compare_digest(calculado, bytes.fromhex(resumen))
@@ -0,0 +1,284 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import hashlib
+import threading
+from collections.abc import Mapping
+from typing import Any
+
+import bson
+from bson.errors import InvalidDocument
+
+from cache_codecs import CacheCodec, BsonCodec
+
+# Lectura de una consulta cacheada y de las generaciones de sus
+# colecciones en un unico viaje
+# KEYS: entrada, generacion de cada coleccion
+LOOKUP_SCRIPT = """
+local resultado = {redis.call('GET', KEYS[1]) or false}
+for i = 2, #KEYS do
+    resultado[i] = redis.call('GET', KEYS[i]) or '0'
+end
+return resultado
+"""
+
+# Guarda el resultado solo si ninguna de sus colecciones ha cambiado
+# desde la lectura, asi una escritura concurrente nunca deja en la cache
+# un resultado anterior a ella
+# KEYS: entrada, (generacion, etiquetas) de cada coleccion
+# ARGV: resultado, ttl, generacion leida de cada coleccion
+STORE_SCRIPT = """
+local colecciones = (#KEYS - 1) / 2
+for i = 1, colecciones do
+    if (redis.call('GET', KEYS[2 * i]) or '0') ~= ARGV[2 + i] then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+for i = 1, colecciones do
+    redis.call('SADD', KEYS[2 * i + 1], KEYS[1])
+    -- Las etiquetas duran al menos tanto como sus entradas
+    if redis.call('TTL', KEYS[2 * i + 1]) < tonumber(ARGV[2]) then
+        redis.call('EXPIRE', KEYS[2 * i + 1], ARGV[2])
+    end
+end
+return 1
+"""
+
+# Invalida las consultas de una coleccion: incrementa su generacion y
+# elimina las entradas etiquetadas. Devuelve el numero de entradas
+# KEYS: generacion, etiquetas
+INVALIDATE_SCRIPT = """
+redis.call('INCR', KEYS[1])
+local entradas = redis.call('SMEMBERS', KEYS[2])
+for i = 1, #entradas, 500 do
+    redis.call('UNLINK', unpack(entradas, i, math.min(i + 499, #entradas)))
+end
+redis.call('DEL', KEYS[2])
+return #entradas
+"""
+
+# Etapas de aggregate que leen otras colecciones y las que escriben
+_ETAPAS_LOOKUP = ("$lookup", "$graphLookup")
+_ETAPAS_ESCRITURA = ("$out", "$merge")
+
+
+def _colecciones(pipeline: list[dict]) -> tuple[set[str], bool]:
+    """
+    Colecciones que lee un pipeline de aggregate, incluidos los
+    subpipelines de $lookup, $unionWith y $facet, y si escribe en alguna.
+    """
+    leidas, escribe = set(), False
+    for etapa in pipeline:
+        for operador, argumento in etapa.items():
+            if operador in _ETAPAS_ESCRITURA:
+                escribe = True
+            elif operador in _ETAPAS_LOOKUP and "from" in argumento:
+                leidas.add(argumento["from"])
+            elif operador == "$unionWith":
+                leidas.add(argumento if isinstance(argumento, str) else argumento["coll"])
+            if operador == "$facet":
+                subpipelines = list(argumento.values())
+            elif isinstance(argumento, dict) and "pipeline" in argumento:
+                subpipelines = [argumento["pipeline"]]
+            else:
+                subpipelines = []
+            for subpipeline in subpipelines:
+                sub_leidas, sub_escribe = _colecciones(subpipeline)
+                leidas |= sub_leidas
+                escribe = escribe or sub_escribe
+    return leidas, escribe
+
+
+def _sort(sort: Any) -> list[list] | None:
+    """
+    Criterios de ordenacion como lista de [campo, direccion] en todas las
+    formas que acepta pymongo: un campo, un diccionario o una lista de
+    campos o de pares (campo, direccion).
+    """
+    if not sort:
+        return None
+    if isinstance(sort, str):
+        return [[sort, 1]]
+    if isinstance(sort, Mapping):
+        return [[campo, direccion] for campo, direccion in sort.items()]
+    return [[criterio, 1] if isinstance(criterio, str) else list(criterio) for criterio in sort]
+
+
+class QueryCache:
+    """
+    Cache de resultados de consultas find y aggregate en redis.
+    Cada consulta se identifica por el hash de su representacion BSON,
+    que conserva el orden de las claves (en MongoDB {a: 1, b: 1} y
+    {b: 1, a: 1} no son equivalentes en $sort ni en subdocumentos) y los
+    tipos (un ObjectId no es su cadena).
+    Las entradas se etiquetan con las colecciones que leen, de modo que
+    una escritura en una coleccion solo invalida sus consultas.
+
+    Attributes
+    ----------
+        r : redis.Redis
+            cliente de redis
+        codec : CacheCodec
+            codificador de los resultados
+        ttl : int
+            segundos que se guarda un resultado por defecto
+        max_bytes : int
+            tamaño maximo de un resultado codificado, los mayores no se cachean
+        prefix : str
+            prefijo de las claves en redis
+
+    Methods
+    -------
+        find_key(collection: str, filter, projection, limit, skip, sort) -> tuple[str, list[str]] | None
+            Clave y colecciones de una consulta find, None si no se puede cachear.
+        aggregate_key(collection: str, pipeline: list[dict]) -> tuple[str, list[str]] | None
+            Clave y colecciones de un aggregate, None si no se puede cachear.
+        get(key: str, collections: list[str]) -> tuple[list[dict] | None, list[bytes]]
+            Resultado cacheado y generaciones de las colecciones.
+        set(key: str, collections: list[str], generations, documents, ttl) -> bool
+            Guarda un resultado si sus colecciones no han cambiado.
+        invalidate(collection: str) -> int
+            Elimina las consultas cacheadas de una coleccion.
+        stats() -> dict
+            Aciertos, fallos y tasa de aciertos.
+    """
+
+    def __init__(self, redis_client, codec: CacheCodec | None = None, ttl: int = 300,
+                 max_bytes: int = 1 << 20, prefix: str = "qcache"):
+        self.r = redis_client
+        self.codec = codec or BsonCodec()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self._lookup = redis_client.register_script(LOOKUP_SCRIPT)
+        self._store = redis_client.register_script(STORE_SCRIPT)
+        self._invalidate = redis_client.register_script(INVALIDATE_SCRIPT)
+        self._lock = threading.Lock()
+        self._contadores = {"hits": 0, "misses": 0, "stores": 0, "skipped": 0, "invalidations": 0}
+
+    def _key(self, collection: str, tipo: str, consulta: dict) -> str | None:
+        try:
+            resumen = hashlib.sha1(bson.encode(consulta)).hexdigest()
+        except InvalidDocument:
+            # La consulta tiene valores sin representacion BSON, no se cachea
+            # y sera MongoDB quien informe del error al ejecutarla
+            self._count("skipped")
+            return None
+        return f"{self.prefix}:{collection}:{tipo}:{resumen}"
+
+    def _generation_key(self, collection: str) -> str:
+        return f"{self.prefix}:{collection}:gen"
+
+    def _tag_key(self, collection: str) -> str:
+        return f"{self.prefix}:{collection}:tag"
+
+    def find_key(self, collection: str, filter: dict, projection: Any = None, limit: int = 0,
+                 skip: int = 0, sort: Any = None) -> tuple[str, list[str]] | None:
+        """ Clave de una consulta find y colecciones que lee, None si no se puede cachear """
+        consulta = {"filter": filter, "projection": projection, "limit": limit, "skip": skip, "sort": _sort(sort)}
+        clave = self._key(collection, "find", consulta)
+        return (clave, [collection]) if clave is not None else None
+
+    def aggregate_key(self, collection: str, pipeline: list[dict]) -> tuple[str, list[str]] | None:
+        """ Clave de un aggregate y colecciones que lee, None si escribe ($out, $merge) o no se puede cachear """
+        leidas, escribe = _colecciones(pipeline)
+        if escribe:
+            return None
+        clave = self._key(collection, "aggregate", {"pipeline": pipeline})
+        return (clave, sorted(leidas | {collection})) if clave is not None else None
+
+    def _count(self, contador: str, cantidad: int = 1) -> None:
+        with self._lock:
+            self._contadores[contador] += cantidad
+
+    def _decode(self, valor: bytes | None) -> list[dict] | None:
+        if valor is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return self.codec.decode(valor)["r"]
+
+    def _store_args(self, key: str, collections: list[str], generations: list[bytes],
+                    documents: list[dict], ttl: int | None) -> tuple[list[str], list] | None:
+        valor = self.codec.encode({"r": documents})
+        if len(valor) > self.max_bytes:
+            self._count("skipped")
+            return None
+        claves = [key]
+        for collection in collections:
+            claves += [self._generation_key(collection), self._tag_key(collection)]
+        return claves, [valor, ttl or self.ttl, *generations]
+
+    def _stored(self, guardado: int) -> bool:
+        self._count("stores" if guardado else "skipped")
+        return bool(guardado)
+
+    def get(self, key: str, collections: list[str]) -> tuple[list[dict] | None, list[bytes]]:
+        """
+        Busca un resultado en la cache.
+
+        Returns
+        -------
+            tuple[list[dict] | None, list[bytes]]
+                documentos del resultado (None si no esta) y generaciones
+                de las colecciones, que se pasan a set()
+        """
+        valor, *generaciones = self._lookup(keys=[key] + [self._generation_key(c) for c in collections])
+        return self._decode(valor), generaciones
+
+    def set(self, key: str, collections: list[str], generations: list[bytes],
+            documents: list[dict], ttl: int | None = None) -> bool:
+        """
+        Guarda un resultado si ninguna de sus colecciones se ha modificado
+        desde get(). Devuelve si se ha guardado.
+        """
+        argumentos = self._store_args(key, collections, generations, documents, ttl)
+        if argumentos is None:
+            return False
+        claves, args = argumentos
+        return self._stored(self._store(keys=claves, args=args))
+
+    def invalidate(self, collection: str) -> int:
+        """ Elimina las consultas cacheadas que leen collection """
+        self._count("invalidations")
+        return self._invalidate(keys=[self._generation_key(collection), self._tag_key(collection)])
+
+    def stats(self) -> dict:
+        """
+        Estadisticas de uso desde el arranque del proceso.
+
+        Returns
+        -------
+            dict
+                hits, misses, stores, skipped (resultados no guardados por
+                tamaño o por una escritura concurrente), invalidations y
+                hit_rate
+        """
+        with self._lock:
+            estadisticas = dict(self._contadores)
+        consultas = estadisticas["hits"] + estadisticas["misses"]
+        estadisticas["hit_rate"] = estadisticas["hits"] / consultas if consultas else 0.0
+        return estadisticas
+
+
+class AsyncQueryCache(QueryCache):
+    """
+    Version asyncio de QueryCache sobre redis.asyncio, con las mismas
+    claves, por lo que ambas pueden compartir la cache.
+    """
+
+    async def get(self, key: str, collections: list[str]) -> tuple[list[dict] | None, list[bytes]]:
+        valor, *generaciones = await self._lookup(keys=[key] + [self._generation_key(c) for c in collections])
+        return self._decode(valor), generaciones
+
+    async def set(self, key: str, collections: list[str], generations: list[bytes],
+                  documents: list[dict], ttl: int | None = None) -> bool:
+        argumentos = self._store_args(key, collections, generations, documents, ttl)
+        if argumentos is None:
+            return False
+        claves, args = argumentos
+        return self._stored(await self._store(keys=claves, args=args))
+
+    async def invalidate(self, collection: str) -> int:
+        self._count("invalidations")
+        return await self._invalidate(keys=[self._generation_key(collection), self._tag_key(collection)])
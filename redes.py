@@ -0,0 +1,366 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+import bson
+import yaml
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+from ingest import iter_documents
+from ODM import Model, BulkResult, _geocode_documents
+from schema import ModelSchema, compile_schema
+
+# Formatos de los ficheros de importacion y exportacion. Al importar,
+# ndjson admite tambien un array JSON
+FORMATOS = ("ndjson", "bson")
+
+# Esquema del modelo que valida cada proceso del pool
+_esquema: ModelSchema | None = None
+
+
+def _formato(path: str, formato: str | None) -> str:
+    """ Formato indicado o deducido de la extension del fichero """
+    if formato is None:
+        formato = "bson" if os.path.splitext(path)[1].lower() == ".bson" else "ndjson"
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato desconocido: {formato}")
+    return formato
+
+
+def read_documents(path: str, formato: str | None = None) -> Iterator[dict]:
+    """
+    Lee en streaming los documentos de un fichero NDJSON, JSON (array
+    de objetos) o BSON (documentos concatenados, como los de mongodump).
+    El JSON puede estar en JSON extendido de MongoDB ($oid, $date), que
+    se convierte a los tipos de BSON.
+
+    Parameters
+    ----------
+        path : str
+            ruta al fichero de documentos
+        formato : str | None
+            "ndjson" o "bson", por defecto segun la extension
+    Returns
+    -------
+        Iterator[dict]
+            documentos del fichero
+    """
+    if _formato(path, formato) == "bson":
+        with open(path, "rb") as f:
+            yield from bson.decode_file_iter(f)
+    else:
+        yield from iter_documents(path, object_hook=json_util.object_hook)
+
+
+def validate_documents(esquema: ModelSchema, lote: list[dict],
+                       inicio: int) -> tuple[list[dict], list[int], list[tuple[int, str]]]:
+    """
+    Valida un lote de documentos contra la definicion de un modelo con
+    las mismas comprobaciones que Model.__init__ (variables requeridas y
+    admitidas, valores por defecto y tipos). Las direcciones en texto no
+    se validan, se geocodifican despues al escribir el lote.
+
+    Parameters
+    ----------
+        esquema : ModelSchema
+            definicion compilada del modelo
+        lote : list[dict]
+            documentos a validar
+        inicio : int
+            posicion del primer documento del lote en la entrada
+    Returns
+    -------
+        tuple[list[dict], list[int], list[tuple[int, str]]]
+            documentos validos, su posicion en la entrada y (posicion,
+            mensaje) de los erroneos
+    """
+    variables = esquema.required | esquema.admissible
+    # Como en Model, las requeridas con valor por defecto pueden faltar
+    requeridas = esquema.required - esquema.defaults.keys()
+    documentos, indices, errores = [], [], []
+
+    for i, documento in enumerate(lote, inicio):
+        try:
+            if not isinstance(documento, dict):
+                raise ValueError("El documento no es un objeto")
+            faltan = requeridas - documento.keys()
+            if faltan:
+                raise ValueError(f"Faltan variables requeridas: {', '.join(sorted(faltan))}")
+            desconocidas = documento.keys() - variables
+            if desconocidas:
+                raise ValueError(f"Variables no admitidas: {', '.join(sorted(desconocidas))}")
+
+            documento = esquema.apply_defaults(documento)
+            for nombre, valor in documento.items():
+                validar = esquema.validators.get(nombre)
+                if validar is not None and not (nombre == "direccion" and isinstance(valor, str)):
+                    validar(valor)
+        except (ValueError, TypeError) as e:
+            errores.append((i, str(e)))
+            continue
+        documentos.append(documento)
+        indices.append(i)
+
+    return documentos, indices, errores
+
+
+def _iniciar_trabajador(definitions_path: str, nombre: str) -> None:
+    # Cada proceso compila el esquema una vez, los validadores no se
+    # pueden enviar entre procesos
+    global _esquema
+    with open(definitions_path, "r") as f:
+        modelos = yaml.load(f, Loader=yaml.FullLoader)
+    if nombre not in modelos:
+        raise ValueError(f"El modelo {nombre} no esta definido en {definitions_path}")
+    _esquema = compile_schema(nombre, modelos[nombre])
+
+
+def _validar_lote(lote: list[dict], inicio: int) -> tuple[list[dict], list[int], list[tuple[int, str]]]:
+    return validate_documents(_esquema, lote, inicio)
+
+
+def _lotes(documentos: Iterable[dict], batch_size: int) -> Iterator[tuple[int, list[dict]]]:
+    documentos = iter(documentos)
+    inicio = 0
+    while True:
+        lote = list(islice(documentos, batch_size))
+        if not lote:
+            return
+        yield inicio, lote
+        inicio += len(lote)
+
+
+def _geocodificar(documentos: list[dict], indices: list[int],
+                  resultado: BulkResult) -> tuple[list[dict], list[int]]:
+    """
+    Sustituye las direcciones en texto por su punto (ver
+    ODM._geocode_documents) y descarta los documentos que fallan. Se hace
+    en el proceso principal: el geocodificador comparte su cache en redis
+    y respeta el limite de peticiones de la API publica.
+    """
+    descartados = _geocode_documents(documentos, indices, resultado)
+    if not descartados:
+        return documentos, indices
+    return ([documento for i, documento in enumerate(documentos) if i not in descartados],
+            [indice for i, indice in enumerate(indices) if i not in descartados])
+
+
+def _escribir_lote(modelo: type[Model], documentos: list[dict], indices: list[int],
+                   resultado: BulkResult, warm_cache: bool) -> int:
+    """ Escribe un lote validado con bulk_write y actualiza la cache. Devuelve los escritos """
+    documentos, indices = _geocodificar(documentos, indices, resultado)
+    modelos = [modelo._from_document(documento) for documento in documentos]
+    reemplazados = [str(documento["_id"]) for documento in documentos if documento.get("_id") is not None]
+
+    operaciones = Model._bulk_operations(modelos)
+    fallidos = set()
+    if operaciones:
+        try:
+            modelo.db.bulk_write(operaciones, ordered=False)
+        except BulkWriteError as e:
+            fallidos = Model._bulk_failures(e, indices, resultado)
+
+    if warm_cache:
+        pipe = modelo.r.pipeline(transaction=False)
+        escritos = modelo._cache_written(pipe, modelos, fallidos)
+        pipe.execute()
+        modificados = [str(m._id) for i, m in enumerate(modelos) if i not in fallidos]
+    else:
+        # Sin precargar la cache solo hay que descartar las copias de los
+        # documentos con _id (tambien los ids inexistentes recordados), los
+        # demas reciben un _id nuevo y no pueden estar cacheados
+        escritos = len(modelos) - len(fallidos)
+        modificados = reemplazados
+        if modificados:
+            modelo.r.unlink(*[modelo.cache_key(id) for id in modificados])
+            for id in modificados:
+                modelo._local_delete(id)
+
+    modelo._publish_invalidation(modificados)
+    if escritos:
+        modelo._invalidate_queries()
+    return escritos
+
+
+def import_file(modelo: type[Model], path: str, definitions_path: str = "./models.yml",
+                formato: str | None = None, batch_size: int = 1000, processes: int | None = None,
+                warm_cache: bool = False, progress: Callable[[dict], None] | None = None) -> BulkResult:
+    """
+    Importa los documentos de un fichero en la coleccion de un modelo.
+    El fichero se lee en streaming y sus lotes se validan en paralelo en
+    un pool de procesos contra models.yml. El proceso principal
+    geocodifica las direcciones en texto y escribe cada lote con un
+    bulk_write no ordenado, en el orden del fichero. Como mucho hay dos
+    lotes por proceso en vuelo, de modo que la memoria no depende del
+    tamaño del fichero.
+
+    Parameters
+    ----------
+        modelo : type[Model]
+            modelo inicializado con initApp
+        path : str
+            fichero NDJSON, JSON o BSON
+        definitions_path : str
+            fichero de definiciones de modelos usado en initApp
+        formato : str | None
+            "ndjson" o "bson", por defecto segun la extension
+        batch_size : int
+            documentos por lote
+        processes : int | None
+            procesos de validacion, por defecto uno por CPU. Con 0 se
+            valida en el proceso principal
+        warm_cache : bool
+            si se añaden los documentos escritos a la cache de redis
+        progress : Callable[[dict], None] | None
+            funcion a la que se pasan las estadisticas de cada lote
+    Returns
+    -------
+        BulkResult
+            documentos escritos, errores por posicion en el fichero y
+            estadisticas de cada lote
+    """
+    if batch_size <= 0:
+        raise ValueError("batch_size debe ser positivo")
+
+    resultado = BulkResult()
+    lotes = _lotes(read_documents(path, formato), batch_size)
+    anterior = time.perf_counter()
+
+    def escribir(cantidad: int, validado: tuple[list[dict], list[int], list[tuple[int, str]]]) -> None:
+        nonlocal anterior
+        documentos, indices, errores = validado
+        resultado.errors.extend(errores)
+        escritos = _escribir_lote(modelo, documentos, indices, resultado, warm_cache) if documentos else 0
+        # Con el pool los lotes se solapan, se mide el tiempo entre lotes terminados
+        ahora = time.perf_counter()
+        estadisticas = resultado.add_batch(cantidad, escritos, ahora - anterior)
+        anterior = ahora
+        if progress is not None:
+            progress(estadisticas)
+
+    if processes == 0:
+        for inicio, lote in lotes:
+            escribir(len(lote), validate_documents(modelo.schema, lote, inicio))
+        return resultado
+
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(processes, initializer=_iniciar_trabajador,
+                             initargs=(definitions_path, modelo.__name__)) as pool:
+        en_vuelo: deque[tuple[int, Future]] = deque()
+        for inicio, lote in lotes:
+            en_vuelo.append((len(lote), pool.submit(_validar_lote, lote, inicio)))
+            if len(en_vuelo) >= 2 * processes:
+                cantidad, futuro = en_vuelo.popleft()
+                escribir(cantidad, futuro.result())
+        while en_vuelo:
+            cantidad, futuro = en_vuelo.popleft()
+            escribir(cantidad, futuro.result())
+
+    return resultado
+
+
+def export_collection(modelo: type[Model], path: str, formato: str | None = None, filter: dict | None = None,
+                      batch_size: int = 1000, warm_cache: bool = False) -> int:
+    """
+    Exporta los documentos de la coleccion de un modelo a un fichero
+    NDJSON (JSON extendido relajado de MongoDB) o BSON. Los documentos
+    se leen con Model.find en lotes de batch_size y se escriben segun
+    llegan, sin cargar la coleccion en memoria.
+
+    Parameters
+    ----------
+        modelo : type[Model]
+            modelo inicializado con initApp
+        path : str
+            fichero de salida
+        formato : str | None
+            "ndjson" o "bson", por defecto segun la extension
+        filter : dict | None
+            criterio de busqueda de los documentos a exportar
+        batch_size : int
+            documentos por lote de lectura
+        warm_cache : bool
+            si se añaden los documentos exportados a la cache de redis
+    Returns
+    -------
+        int
+            numero de documentos exportados
+    """
+    formato = _formato(path, formato)
+    exportados = 0
+    cursor = modelo.find(filter or {}, batch_size=batch_size, cache=warm_cache)
+
+    with open(path, "wb" if formato == "bson" else "w", encoding=None if formato == "bson" else "utf-8") as f:
+        for documento in cursor:
+            if formato == "bson":
+                f.write(bson.encode(documento.__dict__))
+            else:
+                f.write(json_util.dumps(documento.__dict__, json_options=json_util.RELAXED_JSON_OPTIONS))
+                f.write("\n")
+            exportados += 1
+
+    return exportados
+
+
+def _modelo(nombre: str) -> type[Model]:
+    import main
+    modelo = getattr(main, nombre, None)
+    if not (isinstance(modelo, type) and issubclass(modelo, Model) and "db" in modelo.__dict__):
+        raise ValueError(f"El modelo {nombre} no esta definido")
+    return modelo
+
+
+# python -m redes import Persona personas.ndjson [--processes 8] [--warm-cache]
+# python -m redes export Persona personas.bson [--filter '{"ciudad": "Madrid"}']
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Importacion y exportacion de las colecciones de los modelos")
+    parser.add_argument("--definitions", default="./models.yml", help="fichero de definiciones de modelos")
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017/", help="uri de conexion a mongo")
+    parser.add_argument("--db", default="abd", help="nombre de la base de datos")
+    parser.add_argument("--geocoder", choices=["nominatim", "stub"], default="nominatim",
+                        help="backend de geocodificacion de las direcciones en texto")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    importar = subparsers.add_parser("import", help="carga un fichero NDJSON, JSON o BSON")
+    exportar = subparsers.add_parser("export", help="vuelca la coleccion a NDJSON o BSON")
+    for subparser in (importar, exportar):
+        subparser.add_argument("model", help="nombre del modelo en models.yml")
+        subparser.add_argument("path", help="fichero de entrada o salida")
+        subparser.add_argument("--format", choices=FORMATOS, help="por defecto segun la extension")
+        subparser.add_argument("--batch-size", type=int, default=1000, help="documentos por lote")
+        subparser.add_argument("--warm-cache", action="store_true", help="añade los documentos a la cache de redis")
+    importar.add_argument("--processes", type=int, default=None,
+                          help="procesos de validacion, por defecto uno por CPU, 0 para no usar el pool")
+    exportar.add_argument("--filter", type=json_util.loads, default=None, help="criterio de busqueda en JSON extendido")
+
+    args = parser.parse_args()
+
+    from geocoding import StubBackend
+    import main
+    main.initApp(args.definitions, mongodb_uri=args.mongodb_uri, db_name=args.db, manage_indexes=False,
+                 geocoding_backend=StubBackend() if args.geocoder == "stub" else None)
+    modelo = _modelo(args.model)
+
+    inicio = time.perf_counter()
+    if args.comando == "import":
+        resultado = import_file(modelo, args.path, args.definitions, args.format, args.batch_size,
+                                args.processes, args.warm_cache)
+        segundos = time.perf_counter() - inicio
+        print(f"{resultado.written} documentos escritos, {len(resultado.errors)} errores, "
+              f"{(resultado.written + len(resultado.errors)) / segundos if segundos > 0 else 0:.1f} docs/s")
+        for posicion, mensaje in sorted(resultado.errors)[:10]:
+            print(f"  documento {posicion}: {mensaje}")
+        if resultado.errors:
+            sys.exit(1)
+    else:
+        exportados = export_collection(modelo, args.path, args.format, args.filter, args.batch_size, args.warm_cache)
+        segundos = time.perf_counter() - inicio
+        print(f"{exportados} documentos exportados, {exportados / segundos if segundos > 0 else 0:.1f} docs/s")
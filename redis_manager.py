@@ -1,166 +1,1089 @@
+import heapq
+import io
+import itertools
 import redis
+import redis.asyncio.cluster
+import redis.cluster
 import uuid
 import pickle
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+import connections
+from instrumentation import metrics
+from passwords import hash_password, is_hashed, verify_password
+
+# Segundos maximos de cada espera bloqueante en redis, menor que el
+# socket_timeout de las conexiones para no confundir la espera con un fallo
+BLOQUEO_MAXIMO = 1
+
+# Las sesiones caducan tras 30 días sin usarse
+SESSION_TTL = 60 * 60 * 24 * 30
+
+# Cada sesion es un hash session:<token> con el usuario, sus privilegios
+# y la version del usuario al crearla. user_sessions:<usuario> es el
+# conjunto de tokens del usuario para actualizarlos o cerrarlos en bloque
+def session_key(token):
+    return "session:" + token
+
+def user_sessions_key(nombre_usuario):
+    return "user_sessions:" + nombre_usuario
+
+# Actualiza los privilegios de una sesion si su version es anterior, asi
+# dos modificaciones concurrentes del usuario no dejan la mas antigua
+# KEYS: session:<token>   ARGV: privilegios, version
+REFRESH_SESSION_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 or tonumber(redis.call('HGET', KEYS[1], 'version') or '0') >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'privilegios', ARGV[1], 'version', ARGV[2])
+return 1
+"""
+
+# Cada usuario es un hash user:<usuario> con un campo por dato, asi se
+# leen y modifican solo los campos necesarios. "users" es el conjunto
+# de nombres de usuario registrados
+USERS_KEY = "users"
+
+def user_key(nombre_usuario):
+    return "user:" + nombre_usuario
+
+# Indices secundarios, sorted sets con puntuacion 0 ordenados por orden
+# lexicografico para poder paginar con ZRANGE BYLEX:
+#  - users:privilegios:<n> con los nombres de usuario con privilegios n
+#  - users:nombre con "<nombre completo normalizado>\0<usuario>" para
+#    buscar por prefijo del nombre completo
+USERS_BY_NAME_KEY = "users:nombre"
+
+def normalize_name(nombre_completo):
+    # Minusculas y sin tildes para que la busqueda no dependa de ellas
+    nombre_completo = unicodedata.normalize("NFKD", nombre_completo.casefold())
+    return "".join(c for c in nombre_completo if not unicodedata.combining(c)).strip()
+
+def _name_entry(nombre_usuario, nombre_completo):
+    return normalize_name(nombre_completo) + "\0" + nombre_usuario
+
+# Rango lexicografico de las entradas que empiezan por prefijo. El byte
+# 0xff no aparece en UTF-8, asi que acota todas sus continuaciones
+def prefix_range(prefijo):
+    prefijo = normalize_name(prefijo).encode("utf-8")
+    return b"[" + prefijo, b"[" + prefijo + b"\xff"
+
+def name_entry_user(entrada):
+    return entrada.decode("utf-8").rsplit("\0", 1)[1]
+
+# Campos de los usuarios en redis convertidos a sus tipos
+def decode_user(campos):
+    user_info = {campo.decode("utf-8"): valor.decode("utf-8") for campo, valor in campos.items()}
+    for campo in ("privilegios", "version"):
+        if campo in user_info:
+            user_info[campo] = int(user_info[campo])
+    return user_info
+
+# Alta atomica: solo crea el usuario si no existe y, si se pasan sus
+# claves, lo añade a los indices (ver Keyspace.register_args)
+# KEYS: user:<usuario>[, users, users:privilegios:<n>, users:nombre]
+# ARGV: usuario, entrada de users:nombre, campo1, valor1, ...
+REGISTER_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+if KEYS[2] then
+    redis.call('SADD', KEYS[2], ARGV[1])
+    redis.call('ZADD', KEYS[3], 0, ARGV[1])
+    redis.call('ZADD', KEYS[4], 0, ARGV[2])
+end
+return 1
+"""
+
+# Modificacion atomica de campos de un usuario existente. Si ARGV[1] es
+# "1" se incrementa su version. Si se pasan las claves de los indices se
+# actualizan en el mismo script (ver Keyspace.edit_args): las entradas se
+# calculan con los privilegios y nombre anteriores leidos antes, y si ya
+# no son los del usuario devuelve {-2} para que se vuelvan a leer.
+# Devuelve {version, privilegios anteriores, nombre completo anterior}
+# o {-1} si no existe
+# KEYS: user:<usuario>[, users:nombre, users:privilegios:<anteriores>, users:privilegios:<nuevos>]
+# ARGV: incrementar, usuario, privilegios anteriores, nombre anterior,
+#       entrada anterior de users:nombre, entrada nueva, campo1, valor1, ...
+EDIT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-1}
+end
+local anterior = redis.call('HMGET', KEYS[1], 'privilegios', 'nombre_completo')
+if KEYS[2] and ((anterior[1] or '') ~= ARGV[3] or (anterior[2] or '') ~= ARGV[4]) then
+    return {-2}
+end
+if #ARGV > 6 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 7))
+end
+local version
+if ARGV[1] == '1' then
+    version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+else
+    version = tonumber(redis.call('HGET', KEYS[1], 'version'))
+end
+if KEYS[2] then
+    if ARGV[5] ~= ARGV[6] then
+        redis.call('ZREM', KEYS[2], ARGV[5])
+        redis.call('ZADD', KEYS[2], 0, ARGV[6])
+    end
+    if KEYS[3] ~= KEYS[4] then
+        redis.call('ZREM', KEYS[3], ARGV[2])
+        redis.call('ZADD', KEYS[4], 0, ARGV[2])
+    end
+end
+return {version, anterior[1] or false, anterior[2] or false}
+"""
+
+# Tickets. Cada ticket tiene un id estable (contador tickets:id) y sus
+# datos en el hash ticket:<id>. Colas (con la cola repartida en shards,
+# ver Keyspace, cada shard tiene las suyas):
+#  - "tickets": sorted set de ids pendientes. La puntuacion es
+#    prioridad * 10^12 - id, asi se atiende antes la mayor prioridad y,
+#    a igual prioridad, el ticket mas antiguo (FIFO)
+#  - "tickets:claimed": sorted set de ids en atencion, con el instante
+#    (ms) en que caduca la reclamacion. Los caducados vuelven a la cola
+#  - tickets:user:<usuario>: ids de los tickets abiertos de cada usuario
+#  - "tickets:notify": lista para despertar con BLPOP a los atendientes
+#    que esperan a que llegue un ticket
+TICKETS_KEY = "tickets"
+TICKETS_ID_KEY = "tickets:id"
+CLAIMED_TICKETS_KEY = "tickets:claimed"
+TICKETS_NOTIFY_KEY = "tickets:notify"
+TICKET_PREFIX = "ticket:"
+USER_TICKETS_PREFIX = "tickets:user:"
+
+# Segundos que un atendiente tiene para confirmar un ticket reclamado
+TICKET_VISIBILITY = 60
+
+# Las puntuaciones deben ser enteros exactos en un double (< 2^53)
+PRIORIDAD_MAXIMA = 9000
+
+# Avisos maximos acumulados en tickets:notify
+AVISOS_MAXIMOS = 1000
+
+def user_tickets_key(nombre_usuario):
+    return USER_TICKETS_PREFIX + nombre_usuario
+
+def check_priority(prioridad):
+    if isinstance(prioridad, bool) or not isinstance(prioridad, int) or abs(prioridad) >= PRIORIDAD_MAXIMA:
+        raise ValueError("La prioridad debe ser un entero entre " + str(1 - PRIORIDAD_MAXIMA) + " y " + str(PRIORIDAD_MAXIMA - 1))
+
+# Campos de los tickets en redis convertidos a sus tipos
+def decode_ticket(campos):
+    if isinstance(campos, list):
+        campos = dict(zip(campos[::2], campos[1::2]))
+    ticket_info = {campo.decode("utf-8"): valor.decode("utf-8") for campo, valor in campos.items()}
+    for campo in ("prioridad", "intentos"):
+        if campo in ticket_info:
+            ticket_info[campo] = int(ticket_info[campo])
+    ticket_info.pop("puntuacion", None)
+    return ticket_info
+
+# Alta de un ticket si existe el usuario, con el id ya reservado con INCR
+# en tickets:id para poder declarar su clave. Devuelve 1 o 0 si el usuario
+# no existe. Con hash tags el usuario y sus tickets estan en otro slot: no
+# se pasan sus claves, se comprueba antes y el indice se actualiza despues
+# KEYS: ticket:<id>, tickets, tickets:notify[, user:<usuario>, tickets:user:<usuario>]
+# ARGV: id, usuario, prioridad, titulo, descripcion, avisos maximos
+CREATE_TICKET_SCRIPT = """
+if KEYS[4] and redis.call('EXISTS', KEYS[4]) == 0 then
+    return 0
+end
+local puntuacion = string.format('%.0f', tonumber(ARGV[3]) * 1e12 - tonumber(ARGV[1]))
+redis.call('HSET', KEYS[1], 'titulo', ARGV[4], 'descripcion', ARGV[5], 'usuario', ARGV[2],
+           'prioridad', ARGV[3], 'puntuacion', puntuacion, 'estado', 'pendiente', 'intentos', 0)
+redis.call('ZADD', KEYS[2], puntuacion, ARGV[1])
+if KEYS[5] then
+    redis.call('ZADD', KEYS[5], ARGV[1], ARGV[1])
+end
+redis.call('RPUSH', KEYS[3], ARGV[1])
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[6]), -1)
+return 1
+"""
+
+# Devuelve a la cola las reclamaciones caducadas (como mucho 100 por
+# llamada para no bloquear redis). Se usa al principio de otros scripts
+# KEYS: tickets, tickets:claimed   ARGV[1]: prefijo de los tickets
+_REQUEUE_LUA = """
+local tiempo = redis.call('TIME')
+local ahora = tonumber(tiempo[1]) * 1000 + math.floor(tonumber(tiempo[2]) / 1000)
+local caducados = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ahora, 'LIMIT', 0, 100)
+for _, id in ipairs(caducados) do
+    local clave = ARGV[1] .. id
+    redis.call('ZREM', KEYS[2], id)
+    local puntuacion = redis.call('HGET', clave, 'puntuacion')
+    if puntuacion then
+        redis.call('ZADD', KEYS[1], puntuacion, id)
+        redis.call('HSET', clave, 'estado', 'pendiente')
+        redis.call('HDEL', clave, 'reclamacion')
+    end
+end
+"""
+
+# KEYS: tickets, tickets:claimed   ARGV: prefijo de los tickets
+# Devuelve el numero de tickets devueltos a la cola
+REQUEUE_SCRIPT = _REQUEUE_LUA + """
+return #caducados
+"""
+
+# Reclama el ticket pendiente de mayor prioridad durante ARGV[2] ms con
+# la reclamacion ARGV[3]. Devuelve {id, campos del ticket} o nil.
+# Cada ticket reclamado consume un aviso de tickets:notify y con la cola
+# vacia se descartan todos, asi los atendientes que esperan con BLPOP no
+# despiertan por avisos de tickets que ya se han atendido.
+# El id del ticket se obtiene de la cola dentro del script, por lo que su
+# clave no se puede declarar: comparte el hash tag del shard con KEYS
+# KEYS: tickets, tickets:claimed, tickets:notify
+# ARGV: prefijo de los tickets, ms, reclamacion
+CLAIM_SCRIPT = _REQUEUE_LUA + """
+local ticket = redis.call('ZPOPMAX', KEYS[1])
+if #ticket == 0 then
+    redis.call('DEL', KEYS[3])
+    return false
+end
+redis.call('LPOP', KEYS[3])
+local id = ticket[1]
+local clave = ARGV[1] .. id
+redis.call('ZADD', KEYS[2], ahora + tonumber(ARGV[2]), id)
+redis.call('HSET', clave, 'estado', 'atendiendo', 'reclamacion', ARGV[3])
+redis.call('HINCRBY', clave, 'intentos', 1)
+return {id, redis.call('HGETALL', clave)}
+"""
+
+# Confirma un ticket atendido si la reclamacion sigue siendo la suya y
+# lo elimina. Devuelve el usuario del ticket, 0 si la reclamacion ya no
+# es valida o -1 si el ticket no es de ARGV[3]. Sin tickets:user:<usuario>
+# (con hash tags) el indice del usuario se actualiza fuera del script
+# KEYS: tickets:claimed, ticket:<id>[, tickets:user:<usuario>]
+# ARGV: id, reclamacion, usuario
+ACK_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'reclamacion') ~= ARGV[2] then
+    return 0
+end
+local usuario = redis.call('HGET', KEYS[2], 'usuario') or ''
+if KEYS[3] and usuario ~= ARGV[3] then
+    return -1
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('DEL', KEYS[2])
+if KEYS[3] then
+    redis.call('ZREM', KEYS[3], ARGV[1])
+end
+return usuario
+"""
+
+# Limite de peticiones por usuario con un token bucket: se admiten
+# rafagas de hasta capacidad peticiones y se recupera una cada intervalo
+# ms. Devuelve 0 si se admite la peticion o los ms hasta la siguiente
+# KEYS: ratelimit:<accion>:<usuario>   ARGV: capacidad, intervalo
+RATE_LIMIT_SCRIPT = """
+local tiempo = redis.call('TIME')
+local ahora = tonumber(tiempo[1]) * 1000 + math.floor(tonumber(tiempo[2]) / 1000)
+local capacidad = tonumber(ARGV[1])
+local intervalo = tonumber(ARGV[2])
+local estado = redis.call('HMGET', KEYS[1], 'tokens', 'instante')
+local tokens = tonumber(estado[1]) or capacidad
+local instante = tonumber(estado[2]) or ahora
+tokens = math.min(capacidad, tokens + math.max(ahora - instante, 0) / intervalo)
+local espera = 0
+if tokens < 1 then
+    espera = math.ceil((1 - tokens) * intervalo)
+else
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'instante', ahora)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacidad * intervalo))
+return espera
+"""
+
+# Acciones con limite de peticiones por usuario
+RATE_LIMITED_ACTIONS = ("create_ticket", "login")
+
+def rate_limit_key(accion, nombre_usuario):
+    return "ratelimit:" + accion + ":" + nombre_usuario
+
+# rate_limits: {accion: (peticiones, segundos)}, como mucho peticiones
+# cada segundos por usuario. Devuelve {accion: [capacidad, intervalo en ms]}
+def parse_rate_limits(rate_limits):
+    limites = {}
+    for accion, (peticiones, segundos) in (rate_limits or {}).items():
+        if accion not in RATE_LIMITED_ACTIONS:
+            raise ValueError("Accion sin limite de peticiones: " + str(accion))
+        if peticiones < 1 or segundos <= 0:
+            raise ValueError("El limite de " + accion + " debe ser positivo")
+        limites[accion] = [int(peticiones), segundos * 1000 / peticiones]
+    return limites
+
+class RateLimitExceeded(ValueError):
+    # retry_after: segundos hasta que se admite la siguiente peticion
+    def __init__(self, accion, retry_after):
+        super().__init__("Demasiadas peticiones de " + accion + ", reintentar en " + format(retry_after, ".1f") + " s")
+        self.retry_after = retry_after
+
+# Prioridad de un ticket a partir de su puntuacion en la cola
+def score_priority(puntuacion):
+    return -(-int(puntuacion) // 10**12)
+
+# Orden en que se intenta reclamar en los shards: primero los que tienen
+# pendiente el ticket de mayor prioridad y, a igual prioridad, por turnos
+# para repartir la atencion entre shards. Despues los que solo tienen
+# reclamaciones caducadas, que el script devuelve a la cola al reclamar
+# cimas: [(id, puntuacion)] del primer ticket de cada shard, vacia si no tiene
+# caducadas: numero de reclamaciones caducadas de cada shard
+def claim_order(cimas, caducadas, turno):
+    shards = len(cimas)
+    rotacion = lambda shard: (shard - turno) % shards
+    pendientes = sorted((shard for shard in range(shards) if cimas[shard]),
+                        key=lambda shard: (-score_priority(cimas[shard][0][1]), rotacion(shard)))
+    solo_caducadas = sorted((shard for shard in range(shards) if not cimas[shard] and caducadas[shard]), key=rotacion)
+    return pendientes + solo_caducadas
+
+# Pagina offset, count de la union de varios rangos ordenados, cada uno
+# leido con sus primeros offset + count elementos
+def merge_page(rangos, offset, count):
+    return list(itertools.islice(heapq.merge(*rangos), offset, offset + count))
+
+# Nombres de las claves de usuarios y tickets segun su reparto, para
+# repartir la carga entre los nodos de un redis cluster:
+#  - user_partitions: los indices de usuarios (users, users:nombre,
+#    users:privilegios:<n>) se reparten en tantas particiones segun el
+#    crc32 del nombre de usuario, con el sufijo :<particion>
+#  - ticket_shards: la cola de tickets se reparte en colas independientes.
+#    Las claves de cada una y sus tickets llevan el hash tag {tickets:<n>}
+#    para que sus scripts se ejecuten en un solo nodo, y los ids de los
+#    tickets son <shard>:<n>
+# Con una particion y un shard fuera de un cluster se usan las claves
+# originales. Cambiar las particiones requiere rebuild_user_indexes
+# Fuera de un cluster los indices se actualizan en los mismos scripts que
+# los usuarios. En un cluster estan en otros slots y se actualizan despues
+# en un pipeline: son eventualmente consistentes y, si falla el pipeline,
+# pueden no reflejar un alta o una modificacion hasta rebuild_user_indexes
+class Keyspace():
+    def __init__(self, ticket_shards=1, user_partitions=1, cluster=False):
+        if ticket_shards < 1 or user_partitions < 1:
+            raise ValueError("ticket_shards y user_partitions deben ser positivos")
+        self.ticket_shards = ticket_shards
+        self.user_partitions = user_partitions
+        self.tagged = cluster or ticket_shards > 1
+        self.script_indexes = not cluster
+    
+    # Usuarios
+    
+    def user_partition(self, nombre_usuario):
+        return zlib.crc32(nombre_usuario.encode("utf-8")) % self.user_partitions
+    
+    def _partitioned(self, clave, particion):
+        return clave if self.user_partitions == 1 else clave + ":" + str(particion)
+    
+    def users_key(self, particion):
+        return self._partitioned(USERS_KEY, particion)
+    
+    def users_by_name_key(self, particion):
+        return self._partitioned(USERS_BY_NAME_KEY, particion)
+    
+    def users_by_privileges_key(self, privilegios, particion):
+        return self._partitioned("users:privilegios:" + str(privilegios), particion)
+    
+    # (KEYS, ARGV sin los campos) de REGISTER_SCRIPT
+    def register_args(self, nombre_usuario, nombre_completo, privilegios):
+        entrada = _name_entry(nombre_usuario, nombre_completo)
+        if not self.script_indexes:
+            return [user_key(nombre_usuario)], [nombre_usuario, entrada]
+        particion = self.user_partition(nombre_usuario)
+        return [user_key(nombre_usuario), self.users_key(particion), self.users_by_privileges_key(privilegios, particion),
+                self.users_by_name_key(particion)], [nombre_usuario, entrada]
+    
+    # Si la edicion cambia los indices y se actualizan en el script hay que
+    # leer antes los privilegios y el nombre anteriores del usuario
+    def edit_reads_previous(self, nombre_completo=None, privilegios=None):
+        return self.script_indexes and (nombre_completo is not None or privilegios is not None)
+    
+    # (KEYS, ARGV sin incrementar ni los campos) de EDIT_SCRIPT
+    # anterior: (privilegios, nombre_completo) leidos antes de la modificacion
+    def edit_args(self, nombre_usuario, anterior, nombre_completo=None, privilegios=None):
+        if not self.edit_reads_previous(nombre_completo, privilegios):
+            return [user_key(nombre_usuario)], [nombre_usuario, "", "", "", ""]
+        privilegios_anteriores, nombre_anterior = anterior
+        particion = self.user_partition(nombre_usuario)
+        entrada_anterior = _name_entry(nombre_usuario, nombre_anterior or "")
+        entrada = _name_entry(nombre_usuario, nombre_completo) if nombre_completo is not None else entrada_anterior
+        nuevos = privilegios if privilegios is not None else privilegios_anteriores
+        return ([user_key(nombre_usuario), self.users_by_name_key(particion),
+                 self.users_by_privileges_key(privilegios_anteriores, particion), self.users_by_privileges_key(nuevos, particion)],
+                [nombre_usuario, privilegios_anteriores or "", nombre_anterior or "", entrada_anterior, entrada])
+    
+    # Operaciones de mantenimiento de los indices, se añaden a un pipeline
+    # (sincrono o asincrono) ya abierto
+    def add_user_to_indexes(self, pipe, nombre_usuario, nombre_completo, privilegios):
+        particion = self.user_partition(nombre_usuario)
+        pipe.sadd(self.users_key(particion), nombre_usuario)
+        pipe.zadd(self.users_by_privileges_key(privilegios, particion), {nombre_usuario: 0})
+        pipe.zadd(self.users_by_name_key(particion), {_name_entry(nombre_usuario, nombre_completo): 0})
+    
+    def remove_user_from_indexes(self, pipe, nombre_usuario, nombre_completo, privilegios):
+        particion = self.user_partition(nombre_usuario)
+        pipe.srem(self.users_key(particion), nombre_usuario)
+        if privilegios is not None:
+            pipe.zrem(self.users_by_privileges_key(privilegios, particion), nombre_usuario)
+        if nombre_completo is not None:
+            pipe.zrem(self.users_by_name_key(particion), _name_entry(nombre_usuario, nombre_completo))
+    
+    def update_user_indexes(self, pipe, nombre_usuario, anterior, nombre_completo=None, privilegios=None):
+        # anterior: (privilegios, nombre_completo) antes de la modificacion
+        privilegios_anteriores, nombre_anterior = anterior
+        particion = self.user_partition(nombre_usuario)
+        if privilegios is not None and str(privilegios) != privilegios_anteriores:
+            pipe.zrem(self.users_by_privileges_key(privilegios_anteriores, particion), nombre_usuario)
+            pipe.zadd(self.users_by_privileges_key(privilegios, particion), {nombre_usuario: 0})
+        if nombre_completo is not None and nombre_completo != nombre_anterior:
+            pipe.zrem(self.users_by_name_key(particion), _name_entry(nombre_usuario, nombre_anterior or ""))
+            pipe.zadd(self.users_by_name_key(particion), {_name_entry(nombre_usuario, nombre_completo): 0})
+    
+    # Tickets
+    
+    # Claves de un shard: (pendientes, reclamados, avisos, contador, prefijo de los tickets)
+    def ticket_shard(self, shard):
+        if not self.tagged:
+            return TICKETS_KEY, CLAIMED_TICKETS_KEY, TICKETS_NOTIFY_KEY, TICKETS_ID_KEY, TICKET_PREFIX
+        etiqueta = "{tickets:" + str(shard) + "}"
+        return etiqueta, etiqueta + ":claimed", etiqueta + ":notify", etiqueta + ":id", TICKET_PREFIX + etiqueta + ":"
+    
+    def ticket_id(self, shard, numero):
+        return str(numero) if not self.tagged else str(shard) + ":" + str(numero)
+    
+    # (shard, numero dentro del shard) de un id de ticket
+    def split_ticket_id(self, ticket_id):
+        if not self.tagged:
+            return 0, str(ticket_id)
+        shard, numero = str(ticket_id).split(":", 1)
+        if not 0 <= int(shard) < self.ticket_shards:
+            raise ValueError("Ticket de un shard inexistente: " + str(ticket_id))
+        return int(shard), numero
+    
+    def ticket_key(self, ticket_id):
+        shard, numero = self.split_ticket_id(ticket_id)
+        return self.ticket_shard(shard)[4] + numero
+    
+    # KEYS de CREATE_TICKET_SCRIPT para el ticket numero del shard. Con
+    # hash tags no se pasan las claves del usuario, que estan en otro slot
+    def create_ticket_keys(self, shard, numero, nombre_usuario):
+        pendientes, _, avisos, _, prefijo = self.ticket_shard(shard)
+        claves = [prefijo + str(numero), pendientes, avisos]
+        if not self.tagged:
+            claves += [user_key(nombre_usuario), user_tickets_key(nombre_usuario)]
+        return claves
+    
+    # KEYS de ACK_SCRIPT, igual que en create_ticket_keys
+    def ack_keys(self, ticket_id, nombre_usuario):
+        shard, numero = self.split_ticket_id(ticket_id)
+        _, reclamados, _, _, prefijo = self.ticket_shard(shard)
+        claves = [reclamados, prefijo + numero]
+        if not self.tagged:
+            claves.append(user_tickets_key(nombre_usuario))
+        return claves
+    
+    # Claves de espera de BLPOP: en un cluster no puede esperar en claves de
+    # varios slots, se espera por turnos en las de un shard
+    def notify_keys(self, turno, cluster):
+        if cluster:
+            return [self.ticket_shard(turno % self.ticket_shards)[2]]
+        return [self.ticket_shard(shard)[2] for shard in range(self.ticket_shards)]
+    
+    def shards(self):
+        return [(shard, self.ticket_shard(shard)) for shard in range(self.ticket_shards)]
+
+def is_cluster(cliente):
+    return isinstance(cliente, (redis.cluster.RedisCluster, redis.asyncio.cluster.RedisCluster))
+
+
+# Eventos de usuarios, sesiones y tickets, se registran solo con la
+# instrumentacion activa (ver instrumentation.py)
+def count_event(evento):
+    if metrics.enabled:
+        metrics.count("odm_manager_events_total", event=evento)
+
+
+# Deserializador de los usuarios antiguos que solo admite los tipos
+# basicos que guardaba RedisManager, nunca clases arbitrarias
+class _LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Tipo no permitido en usuario antiguo: {module}.{name}")
+
+def load_legacy_user(datos):
+    user_info = _LegacyUnpickler(io.BytesIO(datos)).load()
+    if not isinstance(user_info, dict):
+        raise pickle.UnpicklingError("Usuario antiguo con formato desconocido")
+    return user_info
 
 class RedisManager():
-    def __init__(self):
-        self.db = redis.Redis(host='localhost', port=6379, db=0)
+    # db: cliente de redis, por defecto el del pool compartido de connections.
+    #     Admite un redis.cluster.RedisCluster (ver connections.get_redis_cluster)
+    # ticket_shards, user_partitions: reparto de las claves (ver Keyspace)
+    # rate_limits: {accion: (peticiones, segundos)} por usuario para
+    #     create_ticket y login, por ejemplo {"login": (5, 60)}
+    def __init__(self, db=None, ticket_shards=1, user_partitions=1, rate_limits=None):
+        self.db = db if db is not None else connections.get_redis()
+        self.cluster = is_cluster(self.db)
+        self.keys = Keyspace(ticket_shards, user_partitions, self.cluster)
+        self.rate_limits = parse_rate_limits(rate_limits)
+        self._turno = itertools.count()     # Reparto de tickets y esperas entre shards
+        self._register = self.db.register_script(REGISTER_SCRIPT)
+        self._edit = self.db.register_script(EDIT_SCRIPT)
+        self._create_ticket = self.db.register_script(CREATE_TICKET_SCRIPT)
+        self._claim = self.db.register_script(CLAIM_SCRIPT)
+        self._ack = self.db.register_script(ACK_SCRIPT)
+        self._requeue = self.db.register_script(REQUEUE_SCRIPT)
+        self._rate_limit = self.db.register_script(RATE_LIMIT_SCRIPT)
+    
+    # Lanza RateLimitExceeded si el usuario ha superado su limite de peticiones
+    def _check_rate(self, accion, nombre_usuario):
+        limite = self.rate_limits.get(accion)
+        if limite is None:
+            return
+        espera = self._rate_limit(keys=[rate_limit_key(accion, nombre_usuario)], args=limite)
+        if espera:
+            count_event(accion + "_rate_limited")
+            raise RateLimitExceeded(accion, espera / 1000)
         
     def register(self, nombre_usuario, nombre_completo, contraseña, privilegios):
-        if(self.db.hexists("usuarios", nombre_usuario)):
-            raise("El usuario ya existe")
-        else:
-            user_info = {"nombre_completo": nombre_completo, "contraseña": contraseña, "privilegios": privilegios}
-            self.db.hset("usuarios", nombre_usuario, pickle.dumps(user_info))
-            print("Usuario registrado correctamente")
-     
-    def generate_token(self, nombre_usuario, contraseña):
+        # La contraseña se guarda como hash con sal, nunca en claro
+        if not self._create_user(nombre_usuario, nombre_completo, hash_password(contraseña), privilegios, 0):
+            raise ValueError("El usuario ya existe")
         
-        if not self.db.hexists("usuarios", nombre_usuario):
-            raise("El usuario no existe")
+        count_event("user_registered")
+    
+    # Crea el usuario si no existe y lo añade a los indices, en el mismo
+    # script salvo en un cluster
+    def _create_user(self, nombre_usuario, nombre_completo, contraseña, privilegios, version):
+        campos = ["nombre_completo", nombre_completo, "contraseña", contraseña, "privilegios", privilegios, "version", version]
+        claves, argumentos = self.keys.register_args(nombre_usuario, nombre_completo, privilegios)
         
-        user_info = pickle.loads(self.db.hget("usuarios", nombre_usuario))
+        if not self._register(keys=claves, args=argumentos + campos):
+            return False
         
+        if not self.keys.script_indexes:
+            pipe = self.db.pipeline(transaction=False)
+            self.keys.add_user_to_indexes(pipe, nombre_usuario, nombre_completo, privilegios)
+            pipe.execute()
+        return True
+    
+    def user_exists(self, nombre_usuario):
+        return self.db.exists(user_key(nombre_usuario)) == 1
+    
+    # Devuelve la informacion del usuario si la contraseña es correcta o None
+    def _verify(self, nombre_usuario, contraseña):
+        self._check_rate("login", nombre_usuario)
         
-        if(user_info["contraseña"] == contraseña):
-            token = str(uuid.uuid4())
-            ttl = 60 * 60 * 24 * 30 # 30 días
-            
-            login_info = {"nombre_usuario": nombre_usuario, "contraseña": contraseña}
-            
-            self.db.setex(token, ttl, pickle.dumps(login_info))
+        # Se leen solo los campos necesarios en un unico HMGET
+        almacenada, privilegios, version = self.db.hmget(user_key(nombre_usuario), "contraseña", "privilegios", "version")
+        
+        # Ver si existe el usuario
+        if almacenada is None:
+            count_event("login_unknown_user")
+            return None
+        
+        almacenada = almacenada.decode("utf-8")
+        
+        if not verify_password(contraseña, almacenada):
+            count_event("login_wrong_password")
+            return None
+        
+        # Las contraseñas antiguas en claro se migran a hash al iniciar sesion
+        if not is_hashed(almacenada):
+            self.db.hset(user_key(nombre_usuario), "contraseña", hash_password(contraseña))
+        
+        return {"privilegios": int(privilegios), "version": int(version or 0)}
+    
+    # Crea la sesion con los datos leidos en _verify. El token se añade a
+    # las sesiones del usuario antes que la sesion, asi las modificaciones
+    # posteriores del usuario la actualizan. Si el usuario ha cambiado
+    # desde _verify (su version es otra) la sesion puede tener privilegios
+    # anteriores o ser de una contraseña ya cambiada: se descarta y
+    # devuelve None
+    def _create_session(self, nombre_usuario, user_info):
+        token = str(uuid.uuid4())
+        sesion = {"nombre_usuario": nombre_usuario, "privilegios": user_info["privilegios"], "version": user_info.get("version", 0)}
+        
+        pipe = self.db.pipeline()
+        pipe.sadd(user_sessions_key(nombre_usuario), token)
+        pipe.hset(session_key(token), mapping=sesion)
+        pipe.expire(session_key(token), SESSION_TTL)
+        pipe.execute()
+        
+        privilegios, version = self.db.hmget(user_key(nombre_usuario), "privilegios", "version")
+        if privilegios is None or int(version or 0) != sesion["version"]:
+            pipe = self.db.pipeline()
+            pipe.delete(session_key(token))
+            pipe.srem(user_sessions_key(nombre_usuario), token)
+            pipe.execute()
+            return None
+        
+        return token
+    
+    # Inicio de sesion con token, se repite si el usuario cambia mientras
+    # tanto. Devuelve (informacion del usuario, token) o None
+    def _login_session(self, nombre_usuario, contraseña):
+        while True:
+            user_info = self._verify(nombre_usuario, contraseña)
+            if user_info is None:
+                return None
             
-            return token
-        else:
-            raise("Usuario o contraseña incorrectos")
+            token = self._create_session(nombre_usuario, user_info)
+            if token is not None:
+                return user_info, token
+     
+    def generate_token(self, nombre_usuario, contraseña):
+        sesion = self._login_session(nombre_usuario, contraseña)
+        
+        if sesion is None:
+            raise ValueError("Usuario o contraseña incorrectos")
+        
+        return sesion[1]
      
     def login(self, nombre_usuario, contraseña):
+        user_info = self._verify(nombre_usuario, contraseña)
         
-        # Ver si existe el usuario
-        if not self.db.hexists("usuarios", nombre_usuario):
-            print("El usuario no existe")
+        if user_info is None:
             return -1
-         
-        user_info = pickle.loads(self.db.hget("usuarios", nombre_usuario))
         
-        if user_info["contraseña"] == contraseña:
-            
-            privilegios = user_info["privilegios"]
-            
-            return privilegios   
-        else:
-            print("Contraseña incorrecta")
-            return -1
+        return user_info["privilegios"]
      
     def login_and_generate_token(self, nombre_usuario, contraseña):
+        sesion = self._login_session(nombre_usuario, contraseña)
         
-        # Ver si existe el usuario
-        if not self.db.hexists("usuarios", nombre_usuario):
-            print("El usuario no existe")
+        if sesion is None:
             return -1
         
-        user_info = pickle.loads(self.db.hget("usuarios", nombre_usuario))
-        
+        user_info, token = sesion
+        return user_info["privilegios"], token
+    
+    # Validacion de la sesion en un unico viaje a redis: se leen sus datos
+    # y se renueva su expiracion (expiracion deslizante)
+    def login_with_token(self, token):
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hgetall(session_key(token))
+        pipe.expire(session_key(token), SESSION_TTL)
+        sesion = pipe.execute()[0]
         
-        if user_info["contraseña"] == contraseña:
-            
-            privilegios = user_info["privilegios"] 
-            token = self.generate_token(nombre_usuario, contraseña)
-            
-            return privilegios, token
-            
-        else:
-            print("Contraseña incorrecta")
+        if b"nombre_usuario" not in sesion:
             return -1
         
-    def login_with_token(self, token):
-        if(self.db.exists(token)):
-            user_info = pickle.loads(self.db.get(token))
-            
-            return self.login(user_info["nombre_usuario"], user_info["contraseña"])       
-
-        else:
-            return -1
+        return int(sesion[b"privilegios"])
+    
+    # Tokens de las sesiones activas del usuario, se olvidan las caducadas
+    def _active_sessions(self, nombre_usuario):
+        tokens = [token.decode("utf-8") for token in self.db.smembers(user_sessions_key(nombre_usuario))]
+        if not tokens:
+            return []
+        
+        pipe = self.db.pipeline(transaction=False)
+        for token in tokens:
+            pipe.exists(session_key(token))
+        existe = pipe.execute()
+        
+        caducadas = [token for token, activa in zip(tokens, existe) if not activa]
+        if caducadas:
+            self.db.srem(user_sessions_key(nombre_usuario), *caducadas)
+        
+        return [token for token, activa in zip(tokens, existe) if activa]
+    
+    # Actualiza los privilegios de todas las sesiones del usuario que
+    # tengan una version anterior
+    def _refresh_sessions(self, nombre_usuario, privilegios, version):
+        tokens = self._active_sessions(nombre_usuario)
+        if not tokens:
+            return
+        
+        # EVAL en lugar de un Script registrado: los pipelines de un
+        # cluster no cargan los scripts en sus nodos
+        pipe = self.db.pipeline(transaction=False)
+        for token in tokens:
+            pipe.eval(REFRESH_SESSION_SCRIPT, 1, session_key(token), privilegios, version)
+        pipe.execute()
+    
+    # Cierra todas las sesiones del usuario
+    def _invalidate_sessions(self, nombre_usuario):
+        tokens = [token.decode("utf-8") for token in self.db.smembers(user_sessions_key(nombre_usuario))]
+        
+        pipe = self.db.pipeline(transaction=False)
+        for token in tokens:
+            pipe.delete(session_key(token))
+        pipe.delete(user_sessions_key(nombre_usuario))
+        pipe.execute()
         
     def edit_user_info(self, nombre_usuario, nombre_completo=None, contraseña=None, privilegios=None):
-        if(self.db.hexists("usuarios", nombre_usuario)):
-            user_info = pickle.loads(self.db.hget("usuarios", nombre_usuario))
-            
-            if(nombre_completo != None):
-                user_info["nombre_completo"] = nombre_completo
-                
-            if(contraseña != None):
-                user_info["contraseña"] = contraseña
-            
-            if(privilegios != None):
-                user_info["privilegios"] = privilegios
+        campos = []
+        
+        if(nombre_completo != None):
+            campos += ["nombre_completo", nombre_completo]
             
-            self.db.hset("usuarios", nombre_usuario, pickle.dumps(user_info))
-            print("Información de usuario actualizada correctamente")
-        else:
-            raise("El usuario no existe")
+        if(contraseña != None):
+            campos += ["contraseña", hash_password(contraseña)]
+        
+        if(privilegios != None):
+            campos += ["privilegios", privilegios]
+        
+        # La version cambia con los datos que afectan a las sesiones. Los
+        # campos y los indices se modifican de forma atomica e individual,
+        # por lo que dos ediciones concurrentes no se pisan entre si
+        incrementar = "1" if contraseña != None or privilegios != None else "0"
+        version = -2
+        while version == -2:
+            anterior = None
+            if self.keys.edit_reads_previous(nombre_completo, privilegios):
+                anterior = self.db.hmget(user_key(nombre_usuario), "privilegios", "nombre_completo")
+                anterior = [valor.decode("utf-8") if valor is not None else None for valor in anterior]
+            claves, argumentos = self.keys.edit_args(nombre_usuario, anterior, nombre_completo, privilegios)
+            version, *anterior = self._edit(keys=claves, args=[incrementar] + argumentos + campos)
+        
+        if version == -1:
+            raise ValueError("El usuario no existe")
+        
+        if not self.keys.script_indexes:
+            anterior = [valor.decode("utf-8") if valor is not None else None for valor in anterior]
+            pipe = self.db.pipeline(transaction=False)
+            self.keys.update_user_indexes(pipe, nombre_usuario, anterior, nombre_completo, privilegios)
+            if len(pipe):
+                pipe.execute()
+        
+        # Un cambio de contraseña cierra todas las sesiones, un cambio de
+        # privilegios se aplica a las sesiones abiertas
+        if contraseña != None:
+            self._invalidate_sessions(nombre_usuario)
+        elif privilegios != None:
+            self._refresh_sessions(nombre_usuario, privilegios, version)
+        
+        count_event("user_updated")
         
     # Funciones Help Desk
     
     # Función de petición de ayuda con prioridad
+    # Se reserva el id y despues el alta del ticket, su entrada en la cola
+    # y en el indice del usuario se hacen en un unico script. Con la cola
+    # repartida en shards los tickets se reparten por turnos y el indice
+    # del usuario, en otro slot, se actualiza despues. Devuelve el id del ticket
     def create_ticket(self, nombre_usuario, titulo, descripcion, prioridad):
-        if(self.db.hexists("usuarios", nombre_usuario)): # Ver si existe el usuario
-            ticket_info = {"titulo": titulo, "descripcion": descripcion, "usuario": nombre_usuario}
+        check_priority(prioridad)
+        self._check_rate("create_ticket", nombre_usuario)
+        
+        shard = next(self._turno) % self.keys.ticket_shards
+        if self.keys.tagged and not self.user_exists(nombre_usuario):
+            raise ValueError("El usuario no existe")
+        
+        numero = self.db.incr(self.keys.ticket_shard(shard)[3])
+        if not self._create_ticket(keys=self.keys.create_ticket_keys(shard, numero, nombre_usuario),
+                                   args=[numero, nombre_usuario, prioridad, titulo, descripcion, AVISOS_MAXIMOS]):
+            raise ValueError("El usuario no existe")
+        
+        ticket_id = self.keys.ticket_id(shard, numero)
+        if self.keys.tagged:
+            # Los ids de distintos shards no son comparables, se ordenan por su alta
+            self.db.zadd(user_tickets_key(nombre_usuario), {ticket_id: time.time()})
+        
+        count_event("ticket_created")
+        return ticket_id
+    
+    # Orden en que se intenta reclamar en los shards (ver claim_order)
+    def _claim_order(self, turno):
+        if self.keys.ticket_shards == 1:
+            return [0]
+        
+        ahora = int(time.time() * 1000)
+        pipe = self.db.pipeline(transaction=False)
+        for _, (pendientes, reclamados, _, _, _) in self.keys.shards():
+            pipe.zrange(pendientes, -1, -1, withscores=True)
+            pipe.zcount(reclamados, "-inf", ahora)
+        resultados = pipe.execute()
+        return claim_order(resultados[::2], resultados[1::2], turno)
+    
+    # Reclama el ticket pendiente de mayor prioridad (el mas antiguo a igual
+    # prioridad) durante visibility segundos. Si no se confirma con
+    # ack_ticket en ese tiempo vuelve a la cola para otro atendiente.
+    # Con la cola repartida se elige el shard con el ticket de mayor
+    # prioridad y, entre shards con la misma, se turnan.
+    # timeout: None para no esperar, segundos de espera si no hay tickets
+    # o 0 para esperar indefinidamente.
+    # Devuelve (id, reclamacion, informacion del ticket) o None
+    def claim_ticket(self, timeout=None, visibility=TICKET_VISIBILITY):
+        reclamacion = str(uuid.uuid4())
+        limite = None if not timeout else time.monotonic() + timeout
+        
+        while True:
+            turno = next(self._turno)
+            for shard in self._claim_order(turno):
+                pendientes, reclamados, avisos, _, prefijo = self.keys.ticket_shard(shard)
+                ticket = self._claim(keys=[pendientes, reclamados, avisos], args=[prefijo, int(visibility * 1000), reclamacion])
+                if ticket is not None:
+                    numero, campos = ticket
+                    return self.keys.ticket_id(shard, numero.decode("utf-8")), reclamacion, decode_ticket(campos)
             
-            self.db.zadd("tickets", {pickle.dumps(ticket_info): prioridad})
+            if timeout is None:
+                return None
             
-            print("Ticket creado correctamente")
-        else:
-            raise("El usuario no existe")
-
+            # Espera bloqueado en redis a que se cree un ticket, en esperas
+            # cortas para recuperar tambien las reclamaciones caducadas
+            espera = BLOQUEO_MAXIMO
+            if limite is not None:
+                espera = min(espera, limite - time.monotonic())
+                if espera <= 0:
+                    return None
+            self.db.blpop(self.keys.notify_keys(turno, self.cluster), espera)
+    
+    # Confirma un ticket reclamado y lo elimina. Devuelve False si la
+    # reclamacion habia caducado y el ticket lo ha reclamado otro atendiente.
+    # nombre_usuario: usuario del ticket (lo devuelve claim_ticket), si no
+    # se indica se lee antes para declarar el indice de sus tickets
+    def ack_ticket(self, ticket_id, reclamacion, nombre_usuario=None):
+        if nombre_usuario is None and not self.keys.tagged:
+            nombre_usuario = self.db.hget(self.keys.ticket_key(ticket_id), "usuario")
+            if nombre_usuario is None:
+                return False
+            nombre_usuario = nombre_usuario.decode("utf-8")
+        
+        usuario = self._ack(keys=self.keys.ack_keys(ticket_id, nombre_usuario),
+                            args=[self.keys.split_ticket_id(ticket_id)[1], reclamacion, nombre_usuario or ""])
+        if usuario == -1:
+            raise ValueError("El ticket no es del usuario " + nombre_usuario)
+        if usuario == 0:
+            return False
+        
+        if self.keys.tagged:
+            self.db.zrem(user_tickets_key(usuario.decode("utf-8")), ticket_id)
+        return True
+    
+    # Devuelve a la cola las reclamaciones caducadas. claim_ticket ya lo hace
+    # en cada llamada, solo es necesario si no hay atendientes activos
+    def requeue_expired_tickets(self):
+        return sum(self._requeue(keys=[pendientes, reclamados], args=[prefijo])
+                   for _, (pendientes, reclamados, _, _, prefijo) in self.keys.shards())
+    
     # Función de atención a usuarios
-    def attend_ticket(self):
+    # timeout: segundos de espera si no hay tickets, 0 para esperar indefinidamente
+    def attend_ticket(self, timeout=0):
         
-        # Si no hay tickets se queda en espera
+        # Se atienden primero los tickets con mayor valor de prioridad.
+        # La reclamacion es atomica, por lo que varios atendientes nunca
+        # obtienen el mismo ticket
         
-        if(self.db.zcard("tickets") == 0):
-            print("No quedan tickets por atender, esperando...")
-
-            while(self.db.zcard("tickets") == 0):
-                pass
+        ticket = self.claim_ticket()
         
-        # Se atienden primero los tickets con mayor valor de prioridad
-
-        ticket = self.db.zrevrange("tickets", 0, 0)[0]
-                
-        ticket = pickle.loads(ticket)
+        if ticket is None:
+            # Si no hay tickets se queda en espera bloqueado en redis
+            count_event("tickets_empty_wait")
+            ticket = self.claim_ticket(timeout)
+            
+            if ticket is None:
+                count_event("tickets_empty")
+                return None
+        
+        ticket_id, reclamacion, ticket_info = ticket
+        self.ack_ticket(ticket_id, reclamacion, ticket_info["usuario"])
         
-        self.db.zrem("tickets", pickle.dumps(ticket))
-                
-        id_usuario = ticket["usuario"]
+        count_event("ticket_attended")
         
-        print("Ticket:" + ticket["titulo"] + ", atendido correctamente")
+        return ticket_info["usuario"]
+    
+    # Tickets abiertos de un usuario, del mas antiguo al mas reciente
+    def user_tickets(self, nombre_usuario, offset=0, count=50):
+        ids = [ticket_id.decode("utf-8") for ticket_id in self.db.zrange(user_tickets_key(nombre_usuario), offset, offset + count - 1)]
         
-        return id_usuario
+        pipe = self.db.pipeline(transaction=False)
+        for ticket_id in ids:
+            pipe.hgetall(self.keys.ticket_key(ticket_id))
+        
+        return [(ticket_id, decode_ticket(ticket_info)) for ticket_id, ticket_info in zip(ids, pipe.execute()) if ticket_info]
+    
+    # Numero de tickets pendientes y en atencion
+    def ticket_counts(self):
+        pipe = self.db.pipeline(transaction=False)
+        for _, (pendientes, reclamados, _, _, _) in self.keys.shards():
+            pipe.zcard(pendientes)
+            pipe.zcard(reclamados)
+        cantidades = pipe.execute()
+        return {"pendientes": sum(cantidades[::2]), "atendiendo": sum(cantidades[1::2])}
+    
+    # Atiende tickets con varios atendientes concurrentes hasta que la cola
+    # quede vacia durante timeout segundos. Devuelve los usuarios atendidos
+    def serve_tickets(self, workers=4, timeout=1):
+        atendidos = []
+        
+        def atendiente():
+            while True:
+                id_usuario = self.attend_ticket(timeout)
+                if id_usuario is None:
+                    return
+                atendidos.append(id_usuario)
+        
+        hilos = [threading.Thread(target=atendiente) for _ in range(workers)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        
+        return atendidos
         
         
     # Funciones extra    
     
     def get_user_info(self, nombre_usuario):
-        if(self.db.hexists("usuarios", nombre_usuario)):
-            user_info = pickle.loads(self.db.hget("usuarios", nombre_usuario))
-            return user_info
-        else:
-            raise("El usuario no existe")
+        user_info = self.db.hgetall(user_key(nombre_usuario))
+        if not user_info:
+            raise ValueError("El usuario no existe")
+        return decode_user(user_info)
         
     def get_all_users(self):
-        users = self.db.hgetall("usuarios")
+        for nombre, user_info in self.iter_users():
+            print(nombre, user_info)
+    
+    # Recorre los usuarios por lotes con SSCAN, sin bloquear redis ni
+    # cargar todos los usuarios en memoria. Devuelve (usuario, informacion)
+    def iter_users(self, batch=100):
+        lote = []
+        for particion in range(self.keys.user_partitions):
+            for nombre in self.db.sscan_iter(self.keys.users_key(particion), count=batch):
+                lote.append(nombre.decode("utf-8"))
+                if len(lote) == batch:
+                    yield from self._fetch_users(lote)
+                    lote = []
+        
+        if lote:
+            yield from self._fetch_users(lote)
+    
+    # Informacion de varios usuarios en un unico pipeline
+    def _fetch_users(self, nombres):
+        pipe = self.db.pipeline(transaction=False)
+        for nombre in nombres:
+            pipe.hgetall(user_key(nombre))
         
-        for user in users:
-            print(user.decode("utf-8"), pickle.loads(users[user]))
+        return [(nombre, decode_user(user_info)) for nombre, user_info in zip(nombres, pipe.execute()) if user_info]
+    
+    # Pagina de un rango lexicografico de los indices de todas las
+    # particiones. Con varias se leen las primeras offset + count entradas
+    # de cada una en un unico pipeline y se mezclan
+    def _lex_page(self, claves, inicio, fin, offset, count):
+        if len(claves) == 1:
+            return self.db.zrange(claves[0], inicio, fin, bylex=True, offset=offset, num=count)
+        
+        pipe = self.db.pipeline(transaction=False)
+        for clave in claves:
+            pipe.zrange(clave, inicio, fin, bylex=True, offset=0, num=offset + count)
+        return merge_page(pipe.execute(), offset, count)
+    
+    # Pagina de los usuarios con unos privilegios, ordenados por nombre de usuario
+    def users_by_privileges(self, privilegios, offset=0, count=50):
+        claves = [self.keys.users_by_privileges_key(privilegios, particion) for particion in range(self.keys.user_partitions)]
+        nombres = self._lex_page(claves, "-", "+", offset, count)
+        return self._fetch_users([nombre.decode("utf-8") for nombre in nombres])
+    
+    def count_users_by_privileges(self, privilegios):
+        pipe = self.db.pipeline(transaction=False)
+        for particion in range(self.keys.user_partitions):
+            pipe.zcard(self.keys.users_by_privileges_key(privilegios, particion))
+        return sum(pipe.execute())
+    
+    # Pagina de los usuarios cuyo nombre completo empieza por prefijo,
+    # sin distinguir mayusculas ni tildes
+    def search_users(self, prefijo, offset=0, count=50):
+        inicio, fin = prefix_range(prefijo)
+        claves = [self.keys.users_by_name_key(particion) for particion in range(self.keys.user_partitions)]
+        entradas = self._lex_page(claves, inicio, fin, offset, count)
+        return self._fetch_users([name_entry_user(entrada) for entrada in entradas])
+    
+    # Reconstruye los indices secundarios a partir de los hashes de los
+    # usuarios, tambien tras cambiar el numero de particiones. Se eliminan
+    # los indices de cualquier particion (users y users:*)
+    def rebuild_user_indexes(self, batch=100):
+        pipe = self.db.pipeline(transaction=False)
+        pipe.unlink(USERS_KEY)
+        for clave in self.db.scan_iter(match=USERS_KEY + ":*", count=batch):
+            pipe.unlink(clave)
+        pipe.execute()
+        
+        lote = []
+        for clave in self.db.scan_iter(match=user_key("*"), count=batch):
+            lote.append(clave.decode("utf-8")[len(user_key("")):])
+            if len(lote) == batch:
+                self._index_users(pipe, lote)
+                lote = []
+        self._index_users(pipe, lote)
+    
+    def _index_users(self, pipe, nombres):
+        for nombre, user_info in self._fetch_users(nombres):
+            self.keys.add_user_to_indexes(pipe, nombre, user_info.get("nombre_completo", ""), user_info["privilegios"])
+        pipe.execute()
         
     def logout(self, token):
-        self.db.delete(token)
-        print("Sesión cerrada correctamente")
+        nombre_usuario = self.db.hget(session_key(token), "nombre_usuario")
+        
+        pipe = self.db.pipeline()
+        pipe.delete(session_key(token))
+        if nombre_usuario is not None:
+            pipe.srem(user_sessions_key(nombre_usuario.decode("utf-8")), token)
+        pipe.execute()
+        count_event("logout")
         
     def delete_user(self, nombre_usuario):
-        if(self.db.hexists("usuarios", nombre_usuario)):
-            self.db.hdel("usuarios", nombre_usuario)
-            print("Usuario eliminado correctamente")
+        pipe = self.db.pipeline()
+        pipe.hmget(user_key(nombre_usuario), "nombre_completo", "privilegios")
+        pipe.delete(user_key(nombre_usuario))
+        (nombre_completo, privilegios), eliminado = pipe.execute()
+        
+        if(eliminado):
+            pipe = self.db.pipeline()
+            self.keys.remove_user_from_indexes(pipe, nombre_usuario,
+                                     nombre_completo.decode("utf-8") if nombre_completo is not None else None,
+                                     privilegios.decode("utf-8") if privilegios is not None else None)
+            pipe.execute()
+            self._invalidate_sessions(nombre_usuario)
+            count_event("user_deleted")
         else:
-            raise("El usuario no existe")
\ No newline at end of file
+            raise ValueError("El usuario no existe")
+    
+    # Migracion de los usuarios del hash "usuarios", donde cada usuario era
+    # un diccionario serializado con pickle, a un hash por usuario.
+    # Con hash_passwords las contraseñas en claro se guardan ya con hash
+    # (es lento, PBKDF2 es costoso a proposito); si no, se migran al
+    # iniciar sesion. Con delete_legacy se borra del hash cada usuario
+    # migrado; los que ya existian se quedan en el para revisarlos a mano.
+    # Devuelve el numero de usuarios migrados
+    def migrate_legacy_users(self, hash_passwords=True, batch=100, delete_legacy=True):
+        migrados = 0
+        omitidos = []
+        
+        for nombre, datos in self.db.hscan_iter("usuarios", count=batch):
+            nombre = nombre.decode("utf-8")
+            user_info = load_legacy_user(datos)
+            
+            contraseña = str(user_info["contraseña"])
+            if hash_passwords and not is_hashed(contraseña):
+                contraseña = hash_password(contraseña)
+            
+            if self._create_user(nombre, user_info.get("nombre_completo", ""), contraseña,
+                                 int(user_info.get("privilegios", 0)), int(user_info.get("version", 0))):
+                migrados += 1
+                # Borrar durante HSCAN es seguro, no se salta otros campos
+                if delete_legacy:
+                    self.db.hdel("usuarios", nombre)
+            else:
+                omitidos.append(nombre)
+                print("El usuario " + nombre + " ya existe, no se migra")
+        
+        print(str(migrados) + " usuarios migrados correctamente")
+        if omitidos:
+            print(str(len(omitidos)) + " usuarios sin migrar siguen en el hash usuarios: " + ", ".join(omitidos))
+        return migrados
+
+
+# python redis_manager.py migrate [--keep-plaintext] [--keep-legacy]
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("Uso: python redis_manager.py migrate [--keep-plaintext] [--keep-legacy]")
+        sys.exit(1)
+    
+    RedisManager().migrate_legacy_users(hash_passwords="--keep-plaintext" not in sys.argv,
+                                        delete_legacy="--keep-legacy" not in sys.argv)
@@ -0,0 +1,387 @@
+__author__ = 'Antonio Cabrera y Alejandro Gómez'
+
+import copy
+import datetime
+from typing import Any, Callable
+
+from bson import ObjectId
+
+# Tipos admitidos en la seccion fields de models.yml
+_TIPOS_SIMPLES = {
+    "str": str,
+    "float": (int, float),
+    "dict": dict,
+    "objectid": ObjectId,
+    "datetime": datetime.datetime,
+}
+
+# Claves admitidas en la definicion de un modelo y de un campo
+_CLAVES_MODELO = {"required_vars", "admissible_vars", "fields", "indexes", "cache"}
+_CLAVES_CAMPO = {"type", "required", "default", "items"}
+_CLAVES_INDICE = {"keys", "name", "unique", "sparse", "expire_after", "partial"}
+_CLAVES_CACHE = {"ttl", "jitter", "max_entries"}
+
+# Tipos de indice admitidos ademas de 1 y -1
+_TIPOS_INDICE = {"2dsphere", "2d", "text", "hashed"}
+
+
+def _es_punto(value: Any) -> bool:
+    # geojson.Point es un dict, se aceptan tambien los dict equivalentes
+    return (isinstance(value, dict) and value.get("type") == "Point"
+            and isinstance(value.get("coordinates"), (list, tuple)) and len(value["coordinates"]) == 2)
+
+
+def _comprobador(tipo: str | dict, ruta: str) -> Callable[[Any], bool] | None:
+    """
+    Compila la comprobacion de un tipo de models.yml en una funcion que
+    indica si un valor es de ese tipo. Devuelve None para "any".
+    Un diccionario como tipo describe un subdocumento con sus campos.
+    """
+    if isinstance(tipo, dict):
+        campos = {nombre: _comprobador(subtipo, f"{ruta}.{nombre}") for nombre, subtipo in tipo.items()}
+        campos = {nombre: comprobar for nombre, comprobar in campos.items() if comprobar is not None}
+
+        def subdocumento(value: Any) -> bool:
+            return isinstance(value, dict) and all(
+                nombre not in value or comprobar(value[nombre]) for nombre, comprobar in campos.items())
+        return subdocumento
+
+    if tipo == "any":
+        return None
+    if tipo == "int":   # bool es subclase de int pero no es un entero valido
+        return lambda value: isinstance(value, int) and not isinstance(value, bool)
+    if tipo == "bool":
+        return lambda value: isinstance(value, bool)
+    if tipo == "point":
+        return _es_punto
+    if tipo == "list":
+        return lambda value: isinstance(value, list)
+    if tipo in _TIPOS_SIMPLES:
+        clase = _TIPOS_SIMPLES[tipo]
+        return lambda value: isinstance(value, clase)
+
+    raise ValueError(f"Tipo desconocido en {ruta}: {tipo}")
+
+
+class Field:
+    """
+    Definicion compilada de un campo de un modelo.
+
+    Attributes
+    ----------
+        name : str
+            nombre del campo
+        type : str | dict
+            tipo declarado en models.yml
+        required : bool
+            si el campo es obligatorio
+        default : Any
+            valor por defecto, se copia en cada modelo nuevo
+        has_default : bool
+            si el campo tiene valor por defecto
+        check : Callable[[Any], bool] | None
+            comprobacion del tipo, None si admite cualquier valor
+    """
+    __slots__ = ("name", "type", "required", "default", "has_default", "check")
+
+    def __init__(self, name: str, definicion: str | dict | None, required: bool = False):
+        if definicion is None or isinstance(definicion, str):
+            definicion = {"type": definicion or "any"}
+        desconocidas = set(definicion) - _CLAVES_CAMPO
+        if desconocidas:
+            raise ValueError(f"Opciones desconocidas en el campo {name}: {', '.join(sorted(desconocidas))}")
+
+        self.name = name
+        self.type = definicion.get("type", "any")
+        self.required = required or bool(definicion.get("required", False))
+        self.has_default = "default" in definicion
+        self.default = definicion.get("default")
+
+        comprobar = _comprobador(self.type, name)
+        if self.type == "list" and "items" in definicion:
+            elemento = _comprobador(definicion["items"], name + "[]")
+            if elemento is not None:
+                comprobar = lambda value: isinstance(value, list) and all(elemento(item) for item in value)
+        self.check = comprobar
+
+        if self.has_default and self.default is not None and self.check is not None and not self.check(self.default):
+            raise ValueError(f"Valor por defecto de {name} no es de tipo {self.type}")
+
+    def validator(self) -> Callable[[Any], None] | None:
+        """ Funcion que lanza ValueError si el valor no es del tipo del campo """
+        comprobar = self.check
+        if comprobar is None:
+            return None
+        nombre, tipo = self.name, self.type
+
+        def validar(value: Any) -> None:
+            if not comprobar(value):
+                raise ValueError(f"Valor de tipo incorrecto para {nombre}, se esperaba {tipo}")
+        return validar
+
+
+class IndexSpec:
+    """
+    Definicion de un indice de models.yml.
+
+    Attributes
+    ----------
+        keys : list[tuple[str, int | str]]
+            campos del indice y su direccion o tipo (1, -1, "2dsphere"...)
+        name : str
+            nombre del indice, por defecto el que genera MongoDB
+        options : dict
+            opciones del indice en el formato de create_index (unique,
+            sparse, expireAfterSeconds, partialFilterExpression)
+    """
+    __slots__ = ("keys", "name", "options")
+
+    # Opciones que se comparan con los indices existentes y su valor por defecto
+    _OPCIONES = {"unique": False, "sparse": False, "expireAfterSeconds": None, "partialFilterExpression": None}
+
+    def __init__(self, definicion: str | list | dict, modelo: str = ""):
+        if not isinstance(definicion, dict) or "keys" not in definicion:
+            definicion = {"keys": definicion}
+        desconocidas = set(definicion) - _CLAVES_INDICE
+        if desconocidas:
+            raise ValueError(f"Opciones desconocidas en un indice de {modelo}: {', '.join(sorted(desconocidas))}")
+
+        claves = definicion["keys"]
+        if isinstance(claves, str):
+            claves = [(claves, 1)]
+        elif isinstance(claves, dict):
+            claves = list(claves.items())
+        else:
+            claves = [(clave, 1) if isinstance(clave, str) else tuple(clave) for clave in claves]
+
+        for campo, tipo in claves:
+            if tipo not in (1, -1) and tipo not in _TIPOS_INDICE:
+                raise ValueError(f"Tipo de indice desconocido en {modelo}.{campo}: {tipo}")
+        if not claves:
+            raise ValueError(f"Indice sin campos en {modelo}")
+
+        self.keys = claves
+        self.name = definicion.get("name") or "_".join(f"{campo}_{tipo}" for campo, tipo in claves)
+        self.options = {}
+        if definicion.get("unique"):
+            self.options["unique"] = True
+        if definicion.get("sparse"):
+            self.options["sparse"] = True
+        if definicion.get("expire_after") is not None:
+            if len(claves) != 1:
+                raise ValueError(f"Los indices TTL deben tener un unico campo ({modelo}.{self.name})")
+            self.options["expireAfterSeconds"] = int(definicion["expire_after"])
+        if definicion.get("partial") is not None:
+            self.options["partialFilterExpression"] = definicion["partial"]
+
+    def matches(self, informacion: dict) -> bool:
+        """ Indica si un indice de index_information() es este mismo indice """
+        return [tuple(clave) for clave in informacion["key"]] == self.keys and all(
+            informacion.get(opcion, defecto) == self.options.get(opcion, defecto)
+            for opcion, defecto in self._OPCIONES.items())
+
+    def only_ttl_differs(self, informacion: dict) -> bool:
+        """ Indica si solo cambia la expiracion, que se modifica sin recrear el indice """
+        return ("expireAfterSeconds" in informacion and "expireAfterSeconds" in self.options
+                and [tuple(clave) for clave in informacion["key"]] == self.keys
+                and all(informacion.get(opcion, defecto) == self.options.get(opcion, defecto)
+                        for opcion, defecto in self._OPCIONES.items() if opcion != "expireAfterSeconds"))
+
+    @property
+    def geo_field(self) -> str | None:
+        """ Campo del indice 2dsphere, None si no es un indice geoespacial """
+        for campo, tipo in self.keys:
+            if tipo == "2dsphere":
+                return campo
+        return None
+
+
+def plan_indexes(declarados: list[IndexSpec], existentes: dict[str, dict],
+                 drop_unknown: bool = False) -> dict[str, list]:
+    """
+    Compara los indices declarados con los de la coleccion
+    (index_information()) y devuelve los cambios necesarios.
+
+    Parameters
+    ----------
+        declarados : list[IndexSpec]
+            indices declarados en models.yml
+        existentes : dict[str, dict]
+            indices de la coleccion por nombre
+        drop_unknown : bool
+            si se eliminan los indices que no estan declarados
+    Returns
+    -------
+        dict[str, list]
+            "create": indices a crear, "drop": nombres de indices a
+            eliminar y "ttl": (nombre, segundos) de los indices TTL a
+            modificar con collMod
+    """
+    plan = {"create": [], "drop": [], "ttl": []}
+    nombres = set()
+
+    for indice in declarados:
+        nombres.add(indice.name)
+        informacion = existentes.get(indice.name)
+        if informacion is None:
+            plan["create"].append(indice)
+        elif indice.only_ttl_differs(informacion):
+            plan["ttl"].append((indice.name, indice.options["expireAfterSeconds"]))
+        elif not indice.matches(informacion):
+            plan["drop"].append(indice.name)
+            plan["create"].append(indice)
+
+    if drop_unknown:
+        plan["drop"] += [nombre for nombre in existentes if nombre != "_id_" and nombre not in nombres]
+
+    return plan
+
+
+class CachePolicy:
+    """
+    Politica de la cache de documentos de un modelo en redis.
+
+    Attributes
+    ----------
+        ttl : int
+            segundos que se guarda un documento en la cache
+        jitter : float
+            variacion aleatoria del ttl, como fraccion (0.1 es ±10%), para
+            que los documentos cacheados a la vez no caduquen a la vez
+        max_entries : int | None
+            numero maximo de documentos del modelo en la cache, se
+            descartan los escritos hace mas tiempo. None para no limitarlo
+    """
+    __slots__ = ("ttl", "jitter", "max_entries")
+
+    def __init__(self, definicion: dict | None = None, modelo: str = ""):
+        definicion = definicion or {}
+        desconocidas = set(definicion) - _CLAVES_CACHE
+        if desconocidas:
+            raise ValueError(f"Opciones desconocidas en la cache de {modelo}: {', '.join(sorted(desconocidas))}")
+
+        self.ttl = int(definicion.get("ttl", 86400))
+        self.jitter = float(definicion.get("jitter", 0))
+        self.max_entries = definicion.get("max_entries")
+        if self.ttl <= 0:
+            raise ValueError(f"El ttl de la cache de {modelo} debe ser positivo")
+        if not 0 <= self.jitter < 1:
+            raise ValueError(f"El jitter de la cache de {modelo} debe estar entre 0 y 1")
+        if self.max_entries is not None and int(self.max_entries) <= 0:
+            raise ValueError(f"max_entries de la cache de {modelo} debe ser positivo")
+        if self.max_entries is not None:
+            self.max_entries = int(self.max_entries)
+
+
+class ModelSchema:
+    """
+    Definicion compilada de un modelo de models.yml. Se construye una
+    vez por clase en initApp, de modo que las comprobaciones de cada
+    asignacion son busquedas en frozensets y diccionarios.
+
+    Attributes
+    ----------
+        name : str
+            nombre del modelo
+        fields : dict[str, Field]
+            campos declarados
+        required : frozenset[str]
+            variables requeridas
+        admissible : frozenset[str]
+            variables admitidas no requeridas
+        defaults : dict[str, Any]
+            valores por defecto de los campos que lo tienen
+        validators : dict[str, Callable[[Any], None]]
+            validadores de tipo de los campos tipados
+        indexes : list[IndexSpec]
+            indices declarados de la coleccion
+        geo_field : str | None
+            campo con indice 2dsphere, usado por Model.near y Model.within
+        cache : CachePolicy
+            politica de la cache de documentos del modelo
+    """
+    __slots__ = ("name", "fields", "required", "admissible", "defaults", "validators", "indexes", "geo_field", "cache")
+
+    def __init__(self, name: str, fields: dict[str, Field], indexes: list[IndexSpec] | None = None,
+                 cache: CachePolicy | None = None):
+        self.name = name
+        self.fields = fields
+        self.indexes = indexes or []
+        self.cache = cache or CachePolicy()
+        self.geo_field = next((indice.geo_field for indice in self.indexes if indice.geo_field), None)
+        self.required = frozenset(nombre for nombre, campo in fields.items() if campo.required)
+        self.admissible = frozenset(fields) - self.required
+        self.defaults = {nombre: campo.default for nombre, campo in fields.items() if campo.has_default}
+        self.validators = {nombre: validar for nombre, campo in fields.items()
+                           if (validar := campo.validator()) is not None}
+
+    def apply_defaults(self, valores: dict) -> dict:
+        """ Añade a valores una copia de los valores por defecto que falten """
+        for nombre, defecto in self.defaults.items():
+            if nombre not in valores:
+                valores[nombre] = copy.deepcopy(defecto) if isinstance(defecto, (list, dict)) else defecto
+        return valores
+
+
+def compile_schema(name: str, definicion: dict) -> ModelSchema:
+    """
+    Compila la definicion de un modelo de models.yml. Se admite el
+    formato original, solo con las listas required_vars y
+    admissible_vars, y la seccion fields con el tipo, si es requerido y
+    el valor por defecto de cada campo:
+
+        Persona:
+          required_vars: [nombre, edad]
+          fields:
+            edad: int
+            estudios:
+              type: list
+              items: {carrera: str, fin: int}
+              default: []
+
+    Los campos de fields que no aparecen en las listas son admitidos,
+    salvo que se marquen con required: true. _id siempre es admitido.
+
+    La seccion indexes declara los indices de la coleccion, que initApp
+    crea o modifica (ver Model.ensure_indexes):
+
+          indexes:
+            - keys: dni
+              unique: true
+            - keys: [ciudad, [edad, -1]]
+            - keys: {direccion: 2dsphere}
+            - keys: creado
+              expire_after: 86400
+
+    La seccion cache configura la cache de documentos del modelo en
+    redis (ver CachePolicy):
+
+          cache:
+            ttl: 3600
+            jitter: 0.1
+            max_entries: 50000
+
+    Parameters
+    ----------
+        name : str
+            nombre del modelo
+        definicion : dict
+            definicion del modelo leida de models.yml
+    Returns
+    -------
+        ModelSchema
+            definicion compilada
+    """
+    desconocidas = set(definicion) - _CLAVES_MODELO
+    if desconocidas:
+        raise ValueError(f"Opciones desconocidas en el modelo {name}: {', '.join(sorted(desconocidas))}")
+
+    requeridos = set(definicion.get("required_vars") or [])
+    declarados = definicion.get("fields") or {}
+    nombres = list(dict.fromkeys([*(definicion.get("required_vars") or []),
+                                  *(definicion.get("admissible_vars") or []), *declarados, "_id"]))
+
+    fields = {nombre: Field(nombre, declarados.get(nombre), nombre in requeridos) for nombre in nombres}
+    indexes = [IndexSpec(indice, name) for indice in definicion.get("indexes") or []]
+    cache = CachePolicy(definicion.get("cache"), name)
+    return ModelSchema(name, fields, indexes, cache)
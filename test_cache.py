@@ -0,0 +1,50 @@
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from ODM import CAPPED_SET_SCRIPT
+
+
+def capped_set(r, maximo, ahora, caducadas, *claves):
+    argumentos = [maximo, ahora, caducadas]
+    for clave in claves:
+        argumentos += [b"valor de " + clave.encode(), 60]
+    return r.eval(CAPPED_SET_SCRIPT, 1 + len(claves), "indice", *claves, *argumentos)
+
+
+def test_capped_set_descarta_las_mas_antiguas():
+    r = fakeredis.FakeRedis()
+    capped_set(r, 3, 1, 0, "a")
+    capped_set(r, 3, 2, 0, "b")
+    capped_set(r, 3, 3, 0, "c")
+
+    assert capped_set(r, 3, 4, 0, "d", "e") == 2
+
+    assert r.zrange("indice", 0, -1) == [b"c", b"d", b"e"]
+    assert r.exists("a", "b") == 0
+    assert r.get("e") == b"valor de e"
+
+
+def test_capped_set_reescribir_renueva_la_entrada():
+    r = fakeredis.FakeRedis()
+    capped_set(r, 2, 1, 0, "a")
+    capped_set(r, 2, 2, 0, "b")
+    capped_set(r, 2, 3, 0, "a")
+
+    assert capped_set(r, 2, 4, 0, "c") == 1
+
+    assert r.zrange("indice", 0, -1) == [b"a", b"c"]
+    assert r.exists("b") == 0
+
+
+def test_capped_set_quita_del_indice_las_caducadas():
+    r = fakeredis.FakeRedis()
+    capped_set(r, 2, 1, 0, "a")
+    capped_set(r, 2, 5, 0, "b")
+
+    # a ya ha caducado en redis: sale del indice sin contar para el maximo
+    assert capped_set(r, 2, 6, 2, "c") == 0
+
+    assert r.zrange("indice", 0, -1) == [b"b", b"c"]
+    assert r.exists("b", "c") == 2
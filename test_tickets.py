@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from redis_manager import RedisManager
+
+
+@pytest.fixture
+def manager():
+    manager = RedisManager(db=fakeredis.FakeRedis())
+    manager.register("ana", "Ana Lopez", "contraseña", 0)
+    manager.register("luis", "Luis Gil", "contraseña", 0)
+    return manager
+
+
+def test_claim_prioridad_y_orden_de_llegada(manager):
+    baja = manager.create_ticket("ana", "baja", "", 1)
+    primero = manager.create_ticket("ana", "primero", "", 5)
+    segundo = manager.create_ticket("luis", "segundo", "", 5)
+    urgente = manager.create_ticket("luis", "urgente", "", 9)
+
+    reclamados = [manager.claim_ticket()[0] for _ in range(4)]
+
+    assert reclamados == [urgente, primero, segundo, baja]
+    assert manager.claim_ticket() is None
+
+
+def test_reclamacion_caducada_vuelve_a_la_cola(manager):
+    ticket_id = manager.create_ticket("ana", "ticket", "", 3)
+    _, reclamacion, info = manager.claim_ticket(visibility=0.05)
+    assert info["estado"] == "atendiendo"
+    assert manager.claim_ticket() is None
+
+    time.sleep(0.1)
+    assert manager.requeue_expired_tickets() == 1
+
+    otro_id, otra_reclamacion, info = manager.claim_ticket()
+    assert otro_id == ticket_id
+    assert info["intentos"] == 2
+    # La reclamacion caducada ya no confirma el ticket
+    assert manager.ack_ticket(ticket_id, reclamacion, "ana") is False
+    assert manager.ack_ticket(ticket_id, otra_reclamacion, "ana") is True
+
+
+def test_claim_recupera_caducadas_sin_requeue(manager):
+    ticket_id = manager.create_ticket("ana", "ticket", "", 3)
+    manager.claim_ticket(visibility=0.05)
+    time.sleep(0.1)
+
+    assert manager.claim_ticket()[0] == ticket_id
+
+
+def test_ack_de_otro_usuario(manager):
+    ticket_id = manager.create_ticket("ana", "ticket", "", 3)
+    _, reclamacion, _ = manager.claim_ticket()
+
+    with pytest.raises(ValueError, match="no es del usuario luis"):
+        manager.ack_ticket(ticket_id, reclamacion, "luis")
+
+    # El ticket sigue reclamado y su usuario puede confirmarlo
+    assert manager.ack_ticket(ticket_id, reclamacion, "ana") is True
+    assert manager.user_tickets("ana") == []